@@ -1,53 +1,141 @@
-from geogear.functions import coverages, resample, presence_absence
+from geogear.functions import coverages, resample, presence_absence, grid_statistics, download_layers, _share_run, _table_formats
 import os
-from prov.dot import prov_to_dot
-from prov.model import ProvDocument
+import threading
+from concurrent import futures
+from functools import partial
+from geogear import provenance, metrics
 
-def analysis(projection, layers_dict, grd_json, path, prov):
+def _run_graph(steps, after, on_done, workers=None):
+    
+    # steps maps each node to a callable and after maps a node to the nodes it
+    # depends on; a node starts as soon as its dependencies have finished and
+    # on_done is called with its result in the order the nodes complete
+    pending = dict(steps)
+    running = {}
+    done = set()
+    
+    with futures.ThreadPoolExecutor(workers or max(len(steps), 1)) as pool:
+        while pending or running:
+            for node in [n for n in pending if set(after.get(n, ())) <= done]:
+                running[pool.submit(pending.pop(node))] = node
+            if not running:
+                raise ValueError("Unresolvable dependencies for " + ", ".join(pending))
+            finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for task in finished:
+                node = running.pop(task)
+                on_done(node, task.result())
+                done.add(node)
 
-    docs = []
 
-    for i in layers_dict.keys():
+def _product_steps(layers_dict, projection, path, max_workers=None, engine="saga", table_format="csv"):
 
-        if i == "presence_absence":
-            layers = []
-            for j in layers_dict[i]:
-                layers.append(list(j.items())[0])
-            docs.append(presence_absence(layers, projection, path))
+    funcs = {"presence_absence": presence_absence,
+             "coverages": coverages,
+             "resample": resample,
+             "grid_statistics": grid_statistics}
 
-        elif i == "coverages":
+    steps = {}
+    for i in layers_dict.keys():
+        if i in funcs:
             layers = []
             for j in layers_dict[i]:
                 layers.append(list(j.items())[0])
-            docs.append(coverages(layers, projection, path))
+            if i == "grid_statistics":
+                # computed with NumPy whatever the engine
+                run = partial(funcs[i], layers, projection, path, max_workers, table_format=table_format)
+            else:
+                run = partial(funcs[i], layers, projection, path, max_workers, engine, table_format)
+            steps[i] = partial(_measured, path, i, run)
+    return steps
 
-        elif i == "resample":
-            layers = []
-            for j in layers_dict[i]:
-                layers.append(list(j.items())[0])
-            docs.append(resample(layers, projection, path))
 
-            
-    grd_doc = ProvDocument.deserialize(content=grd_json)
-    
-    for i in docs:
-        grd_doc.update(i)
+def _check_layers(layers_dict):
+
+    # every layer is downloaded to input/<file name>, so one file name with
+    # two URLs would leave both functions with whichever came last
+    urls = {}
+    for i in ("coverages", "resample", "presence_absence"):
+        for j in layers_dict.get(i, []):
+            layer, url = list(j.items())[0]
+            urls.setdefault(layer, set()).add(url)
+    clashes = sorted(i for i in urls if len(urls[i]) > 1)
+    if clashes:
+        raise ValueError("Layers with the same file name but different URLs: " + ", ".join(clashes))
+
+
+def _plan_layers(layers_dict, path, max_workers=None, slots=None):
+
+    # every layer is downloaded once before the functions start, and a layer
+    # listed under several functions is harmonized once and shared by them;
+    # grid_statistics only names outputs of the others. The per-layer steps of
+    # all functions share slots, max_workers (all cores by default) of them
+    # unless a batch passes its own for every product
+    _check_layers(layers_dict)
+    users = {}
+    for i in ("coverages", "resample", "presence_absence"):
+        for j in layers_dict.get(i, []):
+            users.setdefault(list(j.items())[0], set()).add(i)
+    names = [layer for layer, url in users]
+    shared = [layer for (layer, url), funcs in users.items() if len(funcs) > 1]
+
+    with metrics.step(path, "download"):
+        failed = download_layers(names, [url for layer, url in users], path, max_workers)
+    _share_run(path, shared, [i for i in users if i[0] not in failed],
+               slots or threading.BoundedSemaphore(max_workers or os.cpu_count()))
+
+
+def _measured(path, name, run):
+
+    # the whole function as one step, next to the tool calls and stages inside it
+    with metrics.step(path, name):
+        return run()
+
+
+def _product_after(steps):
+
+    # grid_statistics summarizes the outputs of the other functions
+    return {i: [j for j in steps if j != "grid_statistics"] if i == "grid_statistics" else [] for i in steps}
+
+
+def analysis(projection, layers_dict, grd_json, path, prov, max_workers=None, engine="saga", table_format="csv", background=False, on_step=None):
+
+    # grid -> one branch per function, branches run side by side and their
+    # provenance goes to the journal as soon as each one finishes;
+    # grid_statistics runs once the other branches are done
+    steps = {"grid": lambda: grd_json}
+    after = {}
+
+    product_steps = _product_steps(layers_dict, projection, path, max_workers, engine, table_format)
+    product_after = _product_after(product_steps)
+    for i, step in product_steps.items():
+        steps[i] = step
+        after[i] = ["grid"] + product_after[i]
+
+    # on_step is told about every finished step as well, after its journal entry
+    def on_done(step, doc):
+        provenance.append(path, step, doc)
+        if on_step is not None:
+            on_step(step, doc)
+
+    # bad settings are refused before any layer is downloaded
+    if engine not in ("saga", "native"):
+        raise ValueError("Unknown engine " + engine)
+    _table_formats(table_format)
+    _check_layers(layers_dict)
     
+    # every run starts its own metrics journal from the records of the grid,
+    # so the summary covers this run only
+    provenance.start(path)
+    metrics.start(path, grid=True)
+    _plan_layers(layers_dict, path, max_workers)
+    try:
+        _run_graph(steps, after, on_done)
+    finally:
+        _share_run(path)
+        metrics.summarize(path)
     
-    if not os.path.exists(path + '/output/provenance'): os.makedirs(path + '/output/provenance')
-
-    for i in list(prov):
-        if i in ["PNG","PDF"]:
-            dot = prov_to_dot(grd_doc, direction="BT")
-            if i == "PNG":
-                dot.write(path + '/output/provenance/GEOGEAR-prov.png', format='png')
-            else:
-                dot.write_pdf(path + '/output/provenance/GEOGEAR-prov.pdf', )
-        elif i == "JSON":
-             grd_doc.serialize(path + '/output/provenance/GEOGEAR-prov.json')
-        elif i == "XML":
-            grd_doc.serialize(path + '/output/provenance/GEOGEAR-prov.xml', format='xml')
-        elif i == "RDF":
-            grd_doc.serialize(path + '/output/provenance/GEOGEAR-prov.ttl', format='rdf', rdf_format='ttl')
-
-    return grd_doc
\ No newline at end of file
+    # merging and rendering can wait: with background the data product is
+    # returned right away together with a future of the provenance document
+    if background:
+        return provenance.render_later(path, prov)
+    return provenance.render(path, prov)
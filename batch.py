@@ -0,0 +1,176 @@
+"""GEOGEAR batch mode: many data products built headless against one shared grid.
+
+Run ``python -m geogear.batch products.json``. The configuration file holds the
+settings every product shares and a list of products, each with the layers of
+its analysis functions in the notebook's ``layers_dict`` form::
+
+    {
+      "workdir": "products",
+      "mask": "mask.gpkg",
+      "projection": "EPSG:3035",
+      "cellsize": 100,
+      "engine": "native",
+      "table_format": "csv",
+      "max_workers": 4,
+      "provenance": ["JSON"],
+      "products": [
+        {"name": "habitat",
+         "layers": {"coverages": [{"landcover.tif": "https://..."}],
+                    "presence_absence": [{"observations.gpkg": "https://..."}]}},
+        {"name": "terrain",
+         "layers": {"resample": [{"elevation.tif": "https://..."}]}}
+      ]
+    }
+
+The grid is built once and copied into every product. Downloads and reprojected
+layers are shared through the cache: a layer two products need is fetched and
+harmonized once, the other product waits for it and restores it. Every
+analysis function of every product is one node of a single graph, and the
+per-layer steps of all of them share ``max_workers`` slots, so at most that
+many layers are processed at a time. Each product gets its own directory with
+its outputs and provenance.
+"""
+
+import os
+import json
+import shutil
+import argparse
+import threading
+
+products_dir = "products"
+
+
+def load(config_path):
+    """Read a batch configuration, resolving relative file paths against its directory."""
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(config_path))
+    for k in ("workdir", "mask"):
+        if k in config:
+            config[k] = os.path.join(base, config[k])
+    config.setdefault("workdir", os.path.join(base, products_dir))
+
+    for k in ("mask", "projection", "cellsize", "products"):
+        if k not in config:
+            raise ValueError(config_path + " has no " + k)
+    if config.get("engine", "saga") not in ("saga", "native"):
+        raise ValueError(config_path + ": unknown engine " + str(config["engine"]))
+    if config.get("table_format", "csv") not in ("csv", "parquet", "both"):
+        raise ValueError(config_path + ": unknown table format " + str(config["table_format"]))
+    names = [i["name"] for i in config["products"]]
+    if len(set(names)) != len(names):
+        raise ValueError("Product names in " + config_path + " are not unique")
+    for i in names:
+        if not i or os.sep in i or i.startswith((".", "_")):
+            raise ValueError(repr(i) + " is not a valid product name")
+    return config
+
+
+def _prepare(path):
+    for i in ("input", "analysis"):
+        if not os.path.exists(path + "/" + i): os.makedirs(path + "/" + i)
+
+
+def run(config):
+    """Build every product of config and return the provenance document of each one."""
+
+    import geopandas as gpd
+    from geogear import cache, functions, backend, provenance, metrics
+
+    if not cache.enabled:
+        print("The cache is disabled, layers shared by several products are processed once per product")
+
+    workdir = config["workdir"]
+    engine = config.get("engine", "saga")
+    table_format = config.get("table_format", "csv")
+    max_workers = config.get("max_workers")
+    formats = config.get("provenance", ["JSON"])
+    # a clash in a later product would stop the batch after the grid and
+    # the downloads of the products before it
+    for product in config["products"]:
+        backend._check_layers(product["layers"])
+
+    # the shared grid lives next to the products, each product gets a copy
+    # because the analysis functions read and write under their own path
+    shared = os.path.join(workdir, "_grid")
+    _prepare(shared)
+    mask = gpd.read_file(config["mask"]).to_crs(config["projection"])
+    grd_doc = functions.grid(mask, config["cellsize"], shared, engine, table_format)
+    grd_json = grd_doc.serialize()
+
+    steps = {}
+    after = {}
+    left = {}
+    slots = threading.BoundedSemaphore(max_workers or os.cpu_count())
+    for product in config["products"]:
+        path = os.path.join(workdir, product["name"])
+        _prepare(path)
+        if os.path.exists(path + "/output/grid"): shutil.rmtree(path + "/output/grid")
+        shutil.copytree(shared + "/output/grid", path + "/output/grid")
+        shutil.copyfile(shared + "/input/mask.gpkg", path + "/input/mask.gpkg")
+        metrics.start(path)
+        shutil.copyfile(metrics.journal(shared), metrics.journal(path))
+        provenance.start(path)
+        provenance.append(path, "grid", grd_json)
+
+        product_steps = backend._product_steps(product["layers"], config["projection"], path,
+                                               max_workers, engine, table_format)
+        product_after = backend._product_after(product_steps)
+        backend._plan_layers(product["layers"], path, max_workers, slots)
+        for name, step in product_steps.items():
+            steps[(product["name"], name)] = step
+            after[(product["name"], name)] = [(product["name"], i) for i in product_after[name]]
+        left[product["name"]] = len(product_steps)
+
+    # one pool for all products; a product is rendered as soon as its last
+    # function finishes, while the others are still running
+    rendered = {}
+
+    def on_done(node, doc):
+        name, step = node
+        path = os.path.join(workdir, name)
+        provenance.append(path, step, doc)
+        left[name] -= 1
+        if left[name] == 0:
+            metrics.summarize(path)
+            rendered[name] = provenance.render_later(path, formats)
+
+    for product in config["products"]:
+        if left[product["name"]] == 0:
+            metrics.summarize(os.path.join(workdir, product["name"]))
+            rendered[product["name"]] = provenance.render_later(os.path.join(workdir, product["name"]), formats)
+
+    try:
+        backend._run_graph(steps, after, on_done, max_workers)
+    finally:
+        for product in config["products"]:
+            functions._share_run(os.path.join(workdir, product["name"]))
+    return {name: rendered[name].result() for name in rendered}
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m geogear.batch", description=__doc__.splitlines()[0])
+    parser.add_argument("config", help="JSON file with the shared settings and the products")
+    parser.add_argument("--max-workers", type=int, help="size of the shared worker pool, overrides the configuration")
+    parser.add_argument("--only", action="append", metavar="NAME", help="build only this product, can be repeated")
+    args = parser.parse_args(argv)
+
+    config = load(args.config)
+    if args.max_workers:
+        config["max_workers"] = args.max_workers
+    if args.only:
+        unknown = set(args.only) - {i["name"] for i in config["products"]}
+        if unknown:
+            parser.error("unknown products: " + ", ".join(sorted(unknown)))
+        config["products"] = [i for i in config["products"] if i["name"] in args.only]
+
+    docs = run(config)
+    for name in docs:
+        print(name + ": " + os.path.join(config["workdir"], name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""GEOGEAR benchmarks: synthetic layers at configurable sizes, timed per function and per step.
+
+Run ``python -m geogear.benchmark --help``. Results are written as JSON so runs
+of different commits can be compared. Without SAGA GIS and the GDAL command
+line tools, ``--standin`` puts small numpy/rasterio stand-ins for
+``saga_cmd``, ``gdal_translate`` and ``ogrinfo`` on the PATH; their timings
+say nothing about SAGA itself, only about everything around it.
+"""
+
+import os
+import re
+import sys
+import json
+import stat
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from time import time
+from datetime import datetime
+import numpy as np
+
+
+def make_data(root, extent=20000, raster_res=10, classes=10, points=100000, polygons=500, seed=0):
+    """Write a mask, categorical and continuous GeoTIFFs, polygons and points under root."""
+
+    import rasterio
+    import geopandas as gpd
+    from rasterio.transform import from_origin
+    from shapely.geometry import Polygon
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(root + "/layers", exist_ok=True)
+    crs = "EPSG:28992"
+    x0, y0 = 100000, 400000
+
+    # an irregular mask inside the layer extent
+    angles = np.sort(rng.random(24)) * 2 * np.pi
+    radius = extent * (0.35 + 0.1 * rng.random(24))
+    mask = Polygon(zip(x0 + extent / 2 + radius * np.cos(angles), y0 + extent / 2 + radius * np.sin(angles)))
+    gpd.GeoDataFrame(geometry=[mask], crs=crs).to_file(root + "/mask.gpkg", driver="GPKG")
+
+    size = int(extent / raster_res)
+    profile = dict(driver='GTiff', width=size, height=size, count=1, crs=crs, tiled=True,
+                   transform=from_origin(x0, y0 + extent, raster_res, raster_res), compress='deflate')
+    with rasterio.open(root + "/layers/landcover.tif", 'w', **dict(profile, dtype='int16', nodata=-1)) as dst:
+        for _, window in dst.block_windows(1):
+            dst.write(rng.integers(1, classes + 1, (window.height, window.width)).astype('int16'), 1, window=window)
+    with rasterio.open(root + "/layers/elevation.tif", 'w', **dict(profile, dtype='float32', nodata=-9999)) as dst:
+        for _, window in dst.block_windows(1):
+            dst.write((rng.random((window.height, window.width)) * 100).astype('float32'), 1, window=window)
+
+    side = extent / np.sqrt(polygons)
+    corners = rng.random((polygons, 2)) * (extent - side)
+    gpd.GeoDataFrame({'cls': rng.integers(1, classes + 1, polygons)},
+                     geometry=gpd.GeoSeries.from_xy(x0 + corners[:, 0], y0 + corners[:, 1]).buffer(side / 2, 3),
+                     crs=crs).to_file(root + "/layers/landuse.gpkg", driver="GPKG")
+    xy = rng.random((points, 2)) * extent
+    gpd.GeoDataFrame({'sp': rng.integers(1, 4, points)},
+                     geometry=gpd.points_from_xy(x0 + xy[:, 0], y0 + xy[:, 1]),
+                     crs=crs).to_file(root + "/layers/observations.gpkg", driver="GPKG")
+
+
+# stand-ins for the command line tools GEOGEAR calls
+
+def _options(argv):
+    args = [a for a in argv if not a.startswith('-f=')]
+    options = {}
+    key = None
+    for a in args[2:]:
+        if re.match(r'^-[A-Z_0-9]+$', a):
+            key = a[1:]
+            options[key] = True
+        elif key:
+            options[key] = a if options[key] is True else options[key] + ' ' + a
+    return args[0], args[1], options
+
+
+def _nodata(src):
+    # like SAGA, rasters without nodata get one outside the range of their values
+    if src.nodata is not None:
+        return src.nodata
+    if np.issubdtype(np.dtype(src.dtypes[0]), np.integer):
+        info = np.iinfo(src.dtypes[0])
+        return info.min if info.min < 0 else info.max
+    return -99999
+
+
+def _write(path, values, profile, nodata):
+    import rasterio
+    with rasterio.open(path, 'w', **dict(profile, driver='GTiff', count=1, dtype=values.dtype.name, nodata=nodata)) as dst:
+        dst.write(values, 1)
+
+
+def saga_standin(argv):
+    """Run the SAGA tools GEOGEAR uses, approximated with rasterio and geopandas."""
+
+    import rasterio
+    import geopandas as gpd
+    from rasterio import features
+    from rasterio.warp import reproject, Resampling, calculate_default_transform
+    from rasterio.transform import from_origin
+
+    if argv[:1] == ['--version']:
+        print('SAGA Version: 7.7.0 (GEOGEAR benchmark stand-in)')
+        return 0
+    library, tool, o = _options(argv)
+
+    if (library, tool) == ('pj_proj4', '2'):
+        gpd.read_file(o['SOURCE']).to_crs(o['CRS_PROJ4']).to_file(o['TARGET'], driver='GPKG')
+
+    elif (library, tool) == ('pj_proj4', '4'):
+        with rasterio.open(o['SOURCE']) as src:
+            transform, width, height = calculate_default_transform(src.crs, o['CRS_PROJ4'], src.width, src.height, *src.bounds)
+            nodata = _nodata(src)
+            out = np.full((height, width), nodata, dtype=src.dtypes[0])
+            reproject(rasterio.band(src, 1), out, dst_transform=transform, dst_crs=o['CRS_PROJ4'],
+                      dst_nodata=nodata, resampling=Resampling.nearest)
+        _write(o['GRID'], out, dict(crs=o['CRS_PROJ4'], transform=transform, width=width, height=height), nodata)
+
+    elif (library, tool) == ('grid_gridding', '0'):
+        lyr = gpd.read_file(o['INPUT'])
+        if o.get('TARGET_DEFINITION') == '1':
+            with rasterio.open(o['TARGET_TEMPLATE']) as t:
+                profile, transform, shape = t.profile, t.transform, t.shape
+        else:
+            size = float(o['TARGET_USER_SIZE'])
+            if 'TARGET_USER_XMIN' in o:
+                xmin, ymin, xmax, ymax = [float(o['TARGET_USER_' + k]) for k in ('XMIN', 'YMIN', 'XMAX', 'YMAX')]
+            else:
+                b = lyr.total_bounds
+                xmin, ymin = b[0] + size / 2, b[1] + size / 2
+                xmax = xmin + max(1, np.ceil((b[2] - b[0]) / size) - 1) * size
+                ymax = ymin + max(1, np.ceil((b[3] - b[1]) / size) - 1) * size
+            shape = (int(round((ymax - ymin) / size)) + 1, int(round((xmax - xmin) / size)) + 1)
+            transform = from_origin(xmin - size / 2, ymax + size / 2, size, size)
+            profile = dict(width=shape[1], height=shape[0], crs=lyr.crs, transform=transform)
+        if o.get('OUTPUT', '2') == '0':
+            grid = features.rasterize(((g, 1) for g in lyr.geometry), out_shape=shape, transform=transform, fill=0, dtype='uint8')
+            _write(o['GRID'], grid, profile, 0)
+        else:
+            columns = [c for c in lyr.columns if c != lyr.geometry.name]
+            values = lyr[columns[0]] if columns else range(1, len(lyr) + 1)
+            grid = features.rasterize(zip(lyr.geometry, values), out_shape=shape, transform=transform, fill=-99999, dtype='float32')
+            _write(o['GRID'], grid, profile, -99999)
+        if 'COUNT' in o:
+            row, col = rasterio.transform.rowcol(transform, lyr.geometry.x.values, lyr.geometry.y.values)
+            row, col = np.asarray(row), np.asarray(col)
+            inside = (row >= 0) & (row < shape[0]) & (col >= 0) & (col < shape[1])
+            count = np.bincount(row[inside] * shape[1] + col[inside], minlength=shape[0] * shape[1])
+            _write(o['COUNT'], count.reshape(shape).astype('float32'), profile, -99999)
+
+    elif (library, tool) == ('grid_analysis', '26'):
+        with rasterio.open(o['TARGET_TEMPLATE']) as t:
+            profile, transform, shape, crs = t.profile, t.transform, t.shape, t.crs
+        with rasterio.open(o['CLASSES']) as src:
+            f = max(1, int(round(transform.a / abs(src.transform.a))))
+            fine = np.full((shape[0] * f, shape[1] * f), -99999, dtype='float64')
+            reproject(rasterio.band(src, 1), fine, dst_transform=transform * transform.scale(1 / f), dst_crs=crs,
+                      dst_nodata=-99999, resampling=Resampling.nearest)
+            nodata = src.nodata if src.nodata is not None else -99999
+        for n, v in enumerate([v for v in np.unique(fine) if v != -99999 and v != nodata], 1):
+            share = (fine == v).reshape(shape[0], f, shape[1], f).mean(axis=(1, 3)).astype('float32')
+            _write(o['COVERAGES'][:-4] + '%04d.tif' % n, share, profile, -99999)
+
+    elif (library, tool) == ('grid_tools', '0'):
+        with rasterio.open(o['TARGET_TEMPLATE']) as t:
+            profile, transform, shape, crs = t.profile, t.transform, t.shape, t.crs
+        with rasterio.open(o['INPUT']) as src:
+            nodata = _nodata(src)
+            out = np.full(shape, nodata, dtype=src.dtypes[0])
+            reproject(rasterio.band(src, 1), out, dst_transform=transform, dst_crs=crs, src_nodata=nodata,
+                      dst_nodata=nodata, resampling=Resampling.mode)
+        _write(o['OUTPUT'], out, profile, nodata)
+
+    else:
+        print('GEOGEAR benchmark stand-in does not implement ' + library + ' ' + tool, file=sys.stderr)
+        return 1
+    return 0
+
+
+def gdal_translate_standin(argv):
+    """Write a raster as GDAL XYZ text."""
+
+    import rasterio
+    with rasterio.open(argv[0]) as src, open(argv[1], 'w') as f:
+        t = src.transform
+        for row in range(src.height):
+            values = src.read(1, window=((row, row + 1), (0, src.width)))[0]
+            x = t.c + (np.arange(src.width) + 0.5) * t.a
+            y = t.f + (row + 0.5) * t.e
+            f.writelines('%.18g %.18g %s\n' % (x[c], y, repr(values[c].item())) for c in range(src.width))
+    return 0
+
+
+def install_standins(bin_dir):
+    """Put saga_cmd, gdal_translate and ogrinfo stand-ins in bin_dir and in front of the PATH."""
+
+    import rasterio
+    os.makedirs(bin_dir, exist_ok=True)
+    scripts = {'saga_cmd': 'exec "%s" -W ignore "%s" saga "$@"' % (sys.executable, os.path.abspath(__file__)),
+               'gdal_translate': 'exec "%s" -W ignore "%s" gdal_translate "$@"' % (sys.executable, os.path.abspath(__file__)),
+               'ogrinfo': 'echo "GDAL %s (GEOGEAR benchmark stand-in)"' % rasterio.__gdal_version__}
+    for name, line in scripts.items():
+        with open(os.path.join(bin_dir, name), 'w') as f:
+            f.write("#!/bin/sh\n" + line + "\n")
+        os.chmod(os.path.join(bin_dir, name), os.stat(os.path.join(bin_dir, name)).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+
+# timing
+
+def _timed(call):
+    start = time()
+    result = call()
+    return time() - start, result
+
+
+def run(data, work, projection="EPSG:3035", cellsize=100, engine="saga", max_workers=None, table_format="csv"):
+    """Run grid, the three analysis functions and backend.analysis on data; returns their timings."""
+
+    import geopandas as gpd
+    from geogear import cache, functions, backend, provenance, metrics
+
+    layers = {'coverages': ['landcover.tif', 'landuse.gpkg'], 'resample': ['elevation.tif'],
+              'presence_absence': ['observations.gpkg']}
+    urls = {i: 'file://' + os.path.abspath(data + "/layers/" + i) for j in layers.values() for i in j}
+    mask = gpd.read_file(data + "/mask.gpkg").to_crs(projection)
+    results = {}
+
+    def product(name):
+        path = os.path.join(work, name)
+        if os.path.exists(path): shutil.rmtree(path)
+        os.makedirs(path + "/input")
+        os.makedirs(path + "/analysis")
+        return path
+
+    # every run starts cold: no cache and a fresh product directory
+    enabled = cache.enabled
+    cache.enabled = False
+    try:
+        path = product("functions")
+        seconds, doc = _timed(lambda: functions.grid(mask, cellsize, path, engine))
+        results['grid'] = {'seconds': seconds, 'steps': provenance.timings(doc)}
+        grd_json = doc.serialize()
+
+        # the layers are fetched before each function starts, so its seconds
+        # are spent on the function alone
+        for name in ['coverages', 'resample', 'presence_absence']:
+            pairs = [(i, urls[i]) for i in layers[name]]
+            download, _ = _timed(lambda: functions.download_layers(layers[name], [urls[i] for i in layers[name]],
+                                                                   path, max_workers))
+            functions._share_run(path, downloaded=pairs)
+            try:
+                seconds, doc = _timed(lambda: getattr(functions, name)(
+                    pairs, projection, path, max_workers, engine, table_format))
+            finally:
+                functions._share_run(path)
+            results[name] = {'seconds': seconds, 'download_seconds': download, 'steps': provenance.timings(doc)}
+
+        path = product("analysis")
+        shutil.copytree(os.path.join(work, "functions", "output", "grid"), path + "/output/grid")
+        layers_dict = {name: [{i: urls[i]} for i in layers[name]] for name in layers}
+        seconds, doc = _timed(lambda: backend.analysis(projection, layers_dict, grd_json, path, ["JSON"],
+                                                       max_workers, engine, table_format))
+        # analysis() downloads every layer up front, in its own metrics step
+        download = sum(i['wall'] for i in metrics.records(path) if i['step'] == 'download')
+        results['analysis'] = {'seconds': seconds - download, 'download_seconds': download,
+                               'steps': provenance.timings(doc)}
+    finally:
+        cache.enabled = enabled
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m geogear.benchmark", description=__doc__.splitlines()[0])
+    parser.add_argument("--out", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--workdir", help="directory for data and products, a temporary one by default")
+    parser.add_argument("--extent", type=float, default=20000, help="side of the layer extent in meters")
+    parser.add_argument("--raster-res", type=float, default=10, help="resolution of the synthetic rasters in meters")
+    parser.add_argument("--cellsize", type=float, default=100, help="grid cell size in meters")
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--points", type=int, default=100000)
+    parser.add_argument("--polygons", type=int, default=500)
+    parser.add_argument("--engine", default="saga", choices=["saga", "native"])
+    parser.add_argument("--table-format", default="csv", choices=["csv", "parquet", "both"])
+    parser.add_argument("--max-workers", type=int)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--standin", action="store_true", help="use stand-ins for saga_cmd, gdal_translate and ogrinfo")
+    args = parser.parse_args(argv)
+
+    work = args.workdir or tempfile.mkdtemp(prefix="geogear-benchmark-")
+    if args.standin:
+        install_standins(os.path.join(work, "bin"))
+
+    start = time()
+    make_data(work + "/data", args.extent, args.raster_res, args.classes, args.points, args.polygons)
+    generated = time() - start
+
+    runs = [run(work + "/data", work + "/products", cellsize=args.cellsize, engine=args.engine,
+                max_workers=args.max_workers, table_format=args.table_format) for i in range(args.repeat)]
+
+    report = {'commit': _commit(), 'date': datetime.now().isoformat(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'standin': args.standin,
+              'parameters': {k: v for k, v in vars(args).items() if k not in ('out', 'workdir')},
+              'data_seconds': generated, 'runs': runs}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    for name in runs[0]:
+        print("%-18s %8.2f s" % (name, min(r[name]['seconds'] for r in runs)))
+    if not args.workdir:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['saga']:
+        sys.exit(saga_standin(sys.argv[2:]))
+    elif sys.argv[1:2] == ['gdal_translate']:
+        sys.exit(gdal_translate_standin(sys.argv[2:]))
+    main()
@@ -0,0 +1,191 @@
+"""GEOGEAR content-addressed cache for downloaded layers and intermediate rasters."""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import pandas as pd
+from time import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, the first byte of the lock file is locked instead
+    fcntl = None
+    import msvcrt
+
+cache_dir = os.environ.get("GEOGEAR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "geogear"))
+cache_limit = int(os.environ.get("GEOGEAR_CACHE_LIMIT", 20 * 2**30))
+enabled = os.environ.get("GEOGEAR_CACHE_DISABLE") is None
+
+_lock = threading.Lock()
+_hashes = {}
+_key_locks = {}
+
+
+def file_hash(path):
+    """Return the sha256 of a file, memoized on its size and modification time."""
+
+    stat = os.stat(path)
+    memo = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo not in _hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                sha.update(block)
+        _hashes[memo] = sha.hexdigest()
+    return _hashes[memo]
+
+
+def key(*parts):
+    """Return the cache key of a step from its input hashes and parameters."""
+
+    return hashlib.sha256(json.dumps([str(i) for i in parts]).encode()).hexdigest()
+
+
+def lock(k):
+    """Return the lock of key k; steps holding it are computed once and restored by the others."""
+
+    with _lock:
+        return _key_locks.setdefault(k, threading.Lock())
+
+
+@contextmanager
+def _locked():
+
+    # the thread lock orders the threads of this process, the lock file the
+    # processes sharing cache_dir (batch workers, service jobs)
+    with _lock:
+        if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, ".lock"), 'a+') as f:
+            _lock_file(f)
+            try:
+                yield
+            finally:
+                _unlock_file(f)
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        # msvcrt gives up after ten tries of a second each
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _entry(k):
+    return os.path.join(cache_dir, k[:2], k)
+
+
+def _read_meta(entry):
+    with open(os.path.join(entry, "meta.json")) as f:
+        return json.load(f)
+
+
+def _write_meta(entry, meta):
+    with open(os.path.join(entry, "meta.json.tmp"), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(entry, "meta.json.tmp"), os.path.join(entry, "meta.json"))
+
+
+def restore(k, stem):
+    """Copy the artifacts cached under k back to stem + member name; False on a miss."""
+
+    entry = _entry(k)
+    with _locked():
+        if not os.path.exists(os.path.join(entry, "meta.json")):
+            return False
+        meta = _read_meta(entry)
+        for blob, member in enumerate(meta['members']):
+            target = stem + member
+            if os.path.dirname(target) and not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(os.path.join(entry, str(blob)), target)
+        meta['last_used'] = time()
+        _write_meta(entry, meta)
+    return True
+
+
+def save(k, stem, files):
+    """Cache files, which all start with stem, under k and evict entries over the size limit."""
+
+    entry = _entry(k)
+    members = []
+    size = 0
+    tmp = entry + ".tmp%d-%d" % (os.getpid(), threading.get_ident())
+    if os.path.exists(tmp): shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for blob, f in enumerate(sorted(files)):
+        if not f.startswith(stem):
+            raise ValueError(f + " does not start with " + stem)
+        shutil.copyfile(f, os.path.join(tmp, str(blob)))
+        members.append(f[len(stem):])
+        size += os.path.getsize(f)
+    _write_meta(tmp, {'members': members, 'size': size, 'created': time(), 'last_used': time()})
+
+    # the finished entry is renamed into place; an older one is moved aside
+    # first, since a directory can only replace an empty one
+    with _locked():
+        if os.path.exists(entry):
+            os.replace(entry, tmp + ".old")
+        os.replace(tmp, entry)
+        shutil.rmtree(tmp + ".old", ignore_errors=True)
+        _evict()
+
+
+def _evict():
+
+    entries = info()
+    total = entries['size'].sum()
+    for i in entries.sort_values('last_used').itertuples():
+        if total <= cache_limit:
+            break
+        shutil.rmtree(_entry(i.key), ignore_errors=True)
+        total -= i.size
+
+
+def info():
+    """Return a table of the cached entries with their size, member files and last use."""
+
+    rows = []
+    if os.path.exists(cache_dir):
+        for prefix in os.listdir(cache_dir):
+            if not os.path.isdir(os.path.join(cache_dir, prefix)):
+                continue
+            for k in os.listdir(os.path.join(cache_dir, prefix)):
+                # entries still being written carry a .tmp suffix
+                if "." not in k and os.path.exists(os.path.join(cache_dir, prefix, k, "meta.json")):
+                    meta = _read_meta(os.path.join(cache_dir, prefix, k))
+                    rows.append({'key': k, 'size': meta['size'], 'members': meta['members'],
+                                 'created': meta['created'], 'last_used': meta['last_used']})
+    return pd.DataFrame(rows, columns=['key', 'size', 'members', 'created', 'last_used'])
+
+
+def purge(keys=None):
+    """Remove the given cache entries, or the whole cache when no keys are given."""
+
+    with _locked():
+        if keys is None:
+            # the lock file stays, other processes may be waiting on it
+            for prefix in os.listdir(cache_dir):
+                if os.path.isdir(os.path.join(cache_dir, prefix)):
+                    shutil.rmtree(os.path.join(cache_dir, prefix))
+        else:
+            for k in keys:
+                shutil.rmtree(_entry(k), ignore_errors=True)
@@ -0,0 +1,279 @@
+"""GEOGEAR layer fetcher: concurrent, resumable downloads from pluggable sources."""
+
+import os
+import re
+import shutil
+import hashlib
+import zipfile
+import threading
+import requests
+from time import sleep
+from concurrent import futures
+from urllib.parse import urlsplit, unquote
+from tqdm.notebook import tqdm
+from geogear import cache
+
+chunk_size = 2**20
+retries = 3
+timeout = 60
+
+
+class Source:
+    """A place layers are fetched from; subclasses decide which URLs they handle."""
+
+    def matches(self, url):
+        raise NotImplementedError
+
+    def key(self, url):
+        """Return what identifies the remote file, used as its cache key."""
+        return url
+
+    def version(self, url):
+        """Return what changes with the contents of the remote file, or '' when the source can't tell."""
+        return ''
+
+    def open(self, url, offset):
+        """Return (chunks, total size or None, whether the stream starts at offset)."""
+        raise NotImplementedError
+
+
+class HTTPSource(Source):
+
+    _local = threading.local()
+
+    def matches(self, url):
+        return urlsplit(url).scheme in ("http", "https")
+
+    def session(self):
+        # one keep-alive session per worker thread; the pool size bounds the connections
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request_url(self, url):
+        return url
+
+    def version(self, url):
+        # revalidated on every fetch with a HEAD request; a server that can't
+        # be asked keeps serving what was cached without a version
+        try:
+            response = self.session().head(self.request_url(url), allow_redirects=True, timeout=timeout)
+            response.raise_for_status()
+        except requests.RequestException:
+            return ''
+        for i in ('ETag', 'Last-Modified', 'Content-Length'):
+            if i in response.headers:
+                return i + ": " + response.headers[i]
+        return ''
+
+    def open(self, url, offset):
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        response = self.session().get(self.request_url(url), headers=headers, stream=True, timeout=timeout)
+        response.raise_for_status()
+        resumed = response.status_code == 206
+        if resumed and 'Content-Range' in response.headers:
+            total = int(response.headers['Content-Range'].split("/")[-1])
+        elif 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+            total = int(response.headers['Content-Length'])
+        else:
+            total = None
+        return response.iter_content(chunk_size), total, resumed
+
+
+class GoogleDriveSource(HTTPSource):
+
+    def matches(self, url):
+        return urlsplit(url).netloc in ("drive.google.com", "docs.google.com", "drive.usercontent.google.com")
+
+    def key(self, url):
+        return drive_id(url)
+
+    def request_url(self, url):
+        # confirm=t skips the virus-scan interstitial Drive shows for large files
+        return "https://drive.usercontent.google.com/download?id=" + drive_id(url) + "&export=download&confirm=t"
+
+    def open(self, url, offset):
+        chunks, total, resumed = HTTPSource.open(self, url, offset)
+        first = next(chunks, b'')
+        if first.lstrip()[:15].lower().startswith((b'<!doctype html', b'<html')):
+            raise IOError("Google Drive returned a web page instead of the file, check sharing settings")
+        return _prepend(first, chunks), total, resumed
+
+
+class FileSource(Source):
+
+    def matches(self, url):
+        return urlsplit(url).scheme == "file"
+
+    def version(self, url):
+        try:
+            stat = os.stat(unquote(urlsplit(url).path))
+        except OSError:
+            return ''
+        return "%d %d" % (stat.st_size, stat.st_mtime_ns)
+
+    def open(self, url, offset):
+        local = unquote(urlsplit(url).path)
+        total = os.path.getsize(local)
+
+        def chunks():
+            with open(local, 'rb') as f:
+                f.seek(offset)
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    yield block
+
+        return chunks(), total, True
+
+
+sources = [GoogleDriveSource(), HTTPSource(), FileSource()]
+
+_dest_locks = {}
+_dest_locks_lock = threading.Lock()
+
+
+def _prepend(first, chunks):
+    if first:
+        yield first
+    for i in chunks:
+        yield i
+
+
+def drive_id(url):
+    """Return the file id of a Google Drive sharing link."""
+
+    match = re.search(r"/d/([0-9A-Za-z_-]+)", url) or re.search(r"[?&]id=([0-9A-Za-z_-]+)", url)
+    if match is None:
+        raise ValueError(url + " is not a Google Drive file link")
+    return match.group(1)
+
+
+def source_for(url):
+
+    for i in sources:
+        if i.matches(url):
+            return i
+    raise ValueError("No source can fetch " + url)
+
+
+def _checksum(url):
+
+    # an expected digest can be attached to any URL as #sha256=... or #md5=...
+    fragment = urlsplit(url).fragment
+    match = re.match(r"(sha256|sha1|md5)=([0-9a-fA-F]+)$", fragment)
+    return (match.group(1), match.group(2).lower()) if match else (None, None)
+
+
+def _download(url, dest, name):
+
+    source = source_for(url.split("#")[0])
+    algorithm, digest = _checksum(url)
+    part = dest + ".part"
+
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            chunks, total, resumed = source.open(url.split("#")[0], offset)
+            if not resumed:
+                offset = 0
+            t = tqdm(total=total, initial=offset, unit='B', unit_scale=True, desc=name)
+            with open(part, 'ab' if offset else 'wb') as f:
+                for block in chunks:
+                    f.write(block)
+                    t.update(len(block))
+            t.close()
+            if total is not None and os.path.getsize(part) != total:
+                raise IOError("%s: expected %d bytes, got %d" % (name, total, os.path.getsize(part)))
+            break
+        except IOError as e:
+            status = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None else None
+            if status == 416:
+                # the partial file does not fit the remote one anymore, start over
+                os.remove(part)
+            elif status is not None and status < 500:
+                raise
+            if attempt == retries:
+                raise
+            sleep(2 ** attempt)
+
+    if algorithm is not None:
+        h = hashlib.new(algorithm)
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                h.update(block)
+        if h.hexdigest() != digest:
+            os.remove(part)
+            raise IOError(name + ": " + algorithm + " checksum mismatch")
+
+    os.replace(part, dest)
+
+
+def version(url):
+    """Return the version of the file at url: its checksum fragment, else what its source reports."""
+
+    algorithm, digest = _checksum(url)
+    if algorithm is not None:
+        return algorithm + "=" + digest
+    return source_for(url.split("#")[0]).version(url.split("#")[0])
+
+
+def _unzip(archive, dest_dir):
+
+    # members are copied out one buffer at a time instead of read whole
+    extracted = []
+    with zipfile.ZipFile(archive) as z:
+        for member in z.infolist():
+            target = os.path.realpath(os.path.join(dest_dir, member.filename))
+            if not target.startswith(os.path.realpath(dest_dir) + os.sep):
+                raise IOError(member.filename + " would be extracted outside " + dest_dir)
+            if member.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with z.open(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+            extracted.append(target)
+    return extracted
+
+
+def fetch_layer(name, url, dest_dir):
+    """Fetch one layer into dest_dir, unzipping .zip/.shp archives, and return the files written."""
+
+    dest = os.path.join(dest_dir, name)
+    source = source_for(url.split("#")[0])
+    # a new version of the remote file is a new key, so it is downloaded again
+    k = cache.key('download', source.key(url.split("#")[0]), version(url), name)
+
+    with _dest_locks_lock:
+        lock = _dest_locks.setdefault(os.path.abspath(dest), threading.Lock())
+
+    # the key lock makes products of a batch fetching the same layer wait
+    # for one download and restore it from the cache
+    with lock, cache.lock(k):
+        if cache.enabled and cache.restore(k, dest_dir + "/"):
+            return []
+        _download(url, dest, name)
+        if name.endswith((".zip", ".shp")):
+            files = _unzip(dest, dest_dir)
+            os.remove(dest)
+        else:
+            files = [dest]
+        if cache.enabled:
+            cache.save(k, os.path.realpath(dest_dir) + "/", [os.path.realpath(i) for i in files])
+    return files
+
+
+def fetch_layers(layer_lst, layer_urls, dest_dir, max_workers=4):
+    """Fetch layers concurrently; returns a dict of the layers that failed and why."""
+
+    if not os.path.exists(dest_dir): os.makedirs(dest_dir)
+
+    failed = {}
+    with futures.ThreadPoolExecutor(max_workers) as pool:
+        jobs = {pool.submit(fetch_layer, layer_lst[i], layer_urls[i], dest_dir): layer_lst[i]
+                for i in range(len(layer_lst))}
+        for job in futures.as_completed(jobs):
+            try:
+                job.result()
+            except (ValueError, IOError, requests.RequestException, zipfile.BadZipFile) as e:
+                failed[jobs[job]] = e
+    return failed
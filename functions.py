@@ -1,4 +1,8 @@
 import os
+import json
+import threading
+from concurrent import futures
+from functools import partial
 import pandas as pd
 import fnmatch
 from prov.model import ProvDocument
@@ -8,38 +12,389 @@ from tqdm.notebook import tqdm
 from time import time
 from datetime import datetime
 import geopandas as gpd
+import pyogrio
+import pyproj
+import shapely
+import numpy as np
 import rasterio
-from google_drive_downloader import GoogleDriveDownloader as gdd
+import rasterio.features
+import rasterio.shutil
+import rasterio.warp
+import rasterio.windows
+from rasterio.windows import Window
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from affine import Affine
+from geogear import cache, fetch, metrics
 
 saga_cmd = "saga_cmd"
+tile_rows = None
+tile_workers = 1
+sparse_tables = True
+clip_inputs = True
+clip_buffer = 2
+cell_statistics = ['data_cells', 'nodata_cells', 'mean', 'min', 'max', 'range', 'sum', 'var', 'stddev']
+
+_runs = {}
+_runs_lock = threading.Lock()
 
 def url_to_id(url):
-    x = url.split("/")
-    return x[5]
+    return fetch.drive_id(url)
 
-def download_layers(layer_lst, layer_urls, path):
 
-    for i in range(len(layer_lst)):
-        if layer_lst[i].endswith((".zip",".shp")):
-            try:
-                gdd.download_file_from_google_drive(file_id=url_to_id(layer_urls[i]),
-                                                dest_path=path + "/input/" + layer_lst[i], 
-                                                overwrite=True, showsize=True, unzip=True)
-                os.remove(path+"/input/" + layer_lst[i])
-            except IndexError:
-                print(layer_lst[i] + " can't be downloaded, check URL...")
+def download_layers(layer_lst, layer_urls, path, max_workers=None):
+
+    # layers the current analysis already fetched for all its functions are skipped
+    with _runs_lock:
+        downloaded = _runs.get(os.path.abspath(path), {}).get('downloaded', set())
+    todo = [i for i in range(len(layer_lst)) if (layer_lst[i], layer_urls[i]) not in downloaded]
+    failed = fetch.fetch_layers([layer_lst[i] for i in todo], [layer_urls[i] for i in todo], path + "/input", max_workers)
+    for i in layer_lst:
+        if i in failed:
+            print(i + " can't be downloaded (" + str(failed[i]) + "), check URL...")
+    return failed
+
+                
+_versions = {}
+
+def _tool_version(cmd):
+    
+    # tools are probed once per process, not once per function run
+    if cmd not in _versions:
+        _versions[cmd] = (os.popen(cmd + ' --version').read().splitlines() or [cmd + ' (version unknown)'])[0]
+    return _versions[cmd]
+
+
+def _cached(key, stem, run, members=None):
+    
+    # run writes files starting with stem (or exactly stem + members) and
+    # returns its exit status; when the key is cached those files are
+    # restored instead of running the step, and a step already running
+    # under the same key (another product of a batch) is waited for
+    def written():
+        if members is None:
+            found = glob.glob(glob.escape(stem) + '**', recursive=True)
+        else:
+            found = [stem + i for i in members]
+        return {f: os.path.getmtime(f) for f in found if os.path.isfile(f)}
+    
+    with cache.lock(key):
+        if cache.enabled and cache.restore(key, stem):
+            return 0
+        before = written()
+        status = run()
+        if cache.enabled and status == 0:
+            files = [f for f, mtime in written().items() if before.get(f) != mtime]
+            if files:
+                cache.save(key, stem, files)
+    return status
+
+
+def _cell_ids(grid_band, offset=0):
+    
+    # cell_IDs are numbered row by row over the non-zero grid cells, offset
+    # by the cells of the tiles above
+    valid = grid_band != 0
+    ids = np.zeros(grid_band.shape, dtype=np.uint32)
+    ids[valid] = np.arange(offset + 1, offset + np.count_nonzero(valid) + 1, dtype=np.uint32)
+    return ids
+
+
+def _tile_windows(height, width, rows):
+    
+    # tiles are strips of whole grid rows, so each one holds a contiguous range
+    # of cell_IDs and tiles stitch back together in cell_ID order
+    return [Window(0, row, width, min(rows, height - row)) for row in range(0, height, rows)]
+
+
+def _map_tiles(compute, windows, write, workers=1):
+    
+    # compute runs on the pool, write gets the results back in tile order;
+    # only a few tiles are in flight at a time to keep memory bounded
+    with futures.ThreadPoolExecutor(workers) as pool:
+        for i in range(0, len(windows), 2 * workers):
+            batch = windows[i:i + 2 * workers]
+            for window, result in zip(batch, pool.map(compute, batch)):
+                write(window, result)
+
+
+def _grid_index(path):
+    
+    # grids made before grid_ID.tif existed get their index written on first use
+    if not os.path.exists(path + "/output/grid/grid_ID.tif"):
+        with rasterio.open(path + "/output/grid/grid.tif") as src:
+            profile = src.profile
+            profile.update(dtype='uint32', nodata=0, count=1, compress='deflate')
+            with rasterio.open(path + "/output/grid/grid_ID.tif", 'w', **profile) as dst:
+                offset = 0
+                for window in _tile_windows(src.height, src.width, tile_rows or 1024):
+                    grid_ids = _cell_ids(src.read(1, window=window), offset)
+                    offset = max(offset, int(grid_ids.max()))
+                    dst.write(grid_ids, 1, window=window)
+    return path + "/output/grid/grid_ID.tif"
+
+
+def _value_dtype(src, band=1, chunk_rows=1024):
+    
+    # the tables used to be typed by parsing each raster back from XYZ text,
+    # so integer rasters and float rasters holding only whole numbers are
+    # written as integers and all other values as float64
+    if np.issubdtype(np.dtype(src.dtypes[band - 1]), np.integer):
+        return np.dtype(np.int64)
+    for row in range(0, src.height, chunk_rows):
+        values = src.read(band, window=Window(0, row, src.width, min(chunk_rows, src.height - row)))
+        if not np.all(np.mod(values, 1) == 0):
+            return np.dtype(np.float64)
+    return np.dtype(np.int64)
+
+
+def _raster_features(raster):
+    
+    # single band outputs are named after their file, multi-band outputs of
+    # the native engines carry a feature tag per band
+    stem = os.path.splitext(os.path.basename(os.path.normpath(raster)))[0]
+    with rasterio.open(raster) as src:
+        return [(b, src.tags(b).get('feature', stem)) for b in range(1, src.count + 1)]
+
+
+def _write_table(sources, path, table, value='value', chunk_rows=None, workers=None, patch=None):
+    
+    # sources are (raster, band, feature, skip) tuples; rows are built per tile
+    # of grid rows and appended to the csv in tile order, which keeps them
+    # ordered by cell_ID and then source. With patch, the rows of the existing
+    # table are kept, except those of the features in patch, and the rows of
+    # sources are merged in
+    chunk_rows = chunk_rows or tile_rows or 1024
+    grid_ID = _grid_index(path)
+    with rasterio.open(grid_ID) as grd:
+        height, width = grd.shape
+    
+    dtypes = []
+    for raster, band, feature, skip in sources:
+        with rasterio.open(raster) as src:
+            if src.shape != (height, width):
+                raise ValueError(src.name + " is not aligned with grid.tif")
+            dtypes.append(_value_dtype(src, band))
+    
+    # values keep the type of their own raster, also where integer and
+    # float features share a chunk
+    mixed = len(set(dtypes)) > 1 or patch is not None
+    pd.DataFrame(columns=['cell_ID', value, 'feature']).to_csv(table + ".part", index=False)
+    
+    def rows(window):
+        with rasterio.open(grid_ID) as grd:
+            grid_ids = grd.read(1, window=window)
+        valid = grid_ids != 0
+        chunk = []
+        for dtype, (raster, band, feature, skip) in zip(dtypes, sources):
+            with rasterio.open(raster) as src:
+                values = src.read(band, window=window)
+            keep = valid if skip is None else valid & (values != skip)
+            values = values[keep].astype(dtype)
+            chunk.append(pd.DataFrame({'cell_ID': grid_ids[keep],
+                                       value: values.astype(object) if mixed else values,
+                                       'feature': feature}))
+        return int(grid_ids.max()), chunk
+    
+    # the existing rows are read back as text, so they are written out unchanged
+    old = pd.read_csv(table, dtype={value: str}, chunksize=2**16) if patch is not None else iter([])
+    pending = []
+    
+    def old_rows(last_id):
+        kept = []
+        while True:
+            if not pending:
+                part = next(old, None)
+                if part is None:
+                    break
+                pending.append(part[~part['feature'].isin(patch)])
+            part = pending.pop()
+            kept.append(part[part['cell_ID'] <= last_id])
+            if (part['cell_ID'] > last_id).any():
+                pending.append(part[part['cell_ID'] > last_id])
                 break
+        return kept
+    
+    windows = _tile_windows(height, width, chunk_rows)
+    t = tqdm(total=len(windows))
+    t.set_description("Building table " + os.path.basename(table), refresh=True)
+    
+    def append(window, result):
+        last_id, chunk = result
+        chunk = old_rows(last_id) + chunk
+        if chunk:
+            chunk_df = pd.concat(chunk).sort_values('cell_ID', kind='stable')
+            chunk_df.to_csv(table + ".part", mode='a', header=False, index=False)
+        t.update()
+    
+    _map_tiles(rows, windows, append, workers or tile_workers)
+    t.close()
+    os.replace(table + ".part", table)
+
+    
+def _column_dtype(src, band=1, chunk_rows=1024):
+    
+    # integer rasters keep their type, float rasters holding only whole
+    # numbers get the smallest integer type that fits, other floats stay as they are
+    dtype = np.dtype(src.dtypes[band - 1])
+    if np.issubdtype(dtype, np.integer) or _value_dtype(src, band, chunk_rows) != np.int64:
+        return dtype
+    low, high = 0, 0
+    for row in range(0, src.height, chunk_rows):
+        values = src.read(band, window=Window(0, row, src.width, min(chunk_rows, src.height - row)))
+        values = values[_valid(values, src.nodata)]
+        if values.size:
+            low, high = min(low, values.min()), max(high, values.max())
+    return np.promote_types(np.min_scalar_type(int(low)), np.min_scalar_type(int(high)))
+
+
+def _write_wide(sources, path, table, sparse=True, chunk_rows=None, workers=None):
+    
+    # one row per grid cell in cell_ID order and one typed column per feature;
+    # cells holding a skip value are null, which parquet stores almost for free,
+    # unless sparse is off and the skip value is a plain zero
+    import pyarrow
+    import pyarrow.parquet
+    
+    chunk_rows = chunk_rows or tile_rows or 1024
+    grid_ID = _grid_index(path)
+    with rasterio.open(grid_ID) as grd:
+        height, width = grd.shape
+    
+    dtypes = []
+    for raster, band, feature, skip in sources:
+        with rasterio.open(raster) as src:
+            if src.shape != (height, width):
+                raise ValueError(src.name + " is not aligned with grid.tif")
+            dtypes.append(_column_dtype(src, band))
+    schema = pyarrow.schema([('cell_ID', pyarrow.uint32())] +
+                            [(feature, pyarrow.from_numpy_dtype(dtype))
+                             for dtype, (raster, band, feature, skip) in zip(dtypes, sources)])
+    
+    def columns(window):
+        with rasterio.open(grid_ID) as grd:
+            grid_ids = grd.read(1, window=window)
+        valid = grid_ids != 0
+        arrays = [pyarrow.array(grid_ids[valid], pyarrow.uint32())]
+        for dtype, (raster, band, feature, skip) in zip(dtypes, sources):
+            with rasterio.open(raster) as src:
+                values = src.read(band, window=window)[valid]
+                nodata = src.nodata
+            null = ~_valid(values, nodata)
+            if skip is not None and (sparse or skip != 0):
+                null |= values == skip
+            arrays.append(pyarrow.array(np.where(null, 0, values).astype(dtype), mask=null))
+        return pyarrow.Table.from_arrays(arrays, schema=schema)
+    
+    windows = _tile_windows(height, width, chunk_rows)
+    t = tqdm(total=len(windows))
+    t.set_description("Building table " + os.path.basename(table), refresh=True)
+    
+    with pyarrow.parquet.ParquetWriter(table + ".part", schema, compression='zstd') as writer:
+        
+        def append(window, part):
+            if part.num_rows:
+                writer.write_table(part)
+            t.update()
+        
+        _map_tiles(columns, windows, append, workers or tile_workers)
+    t.close()
+    os.replace(table + ".part", table)
+
+
+def _layer_sources(out_dir, files, nodata=False):
+    
+    # cells are skipped where the raster has its nodata value, or zero
+    sources = []
+    for i in files:
+        with rasterio.open(out_dir + "/" + i) as src:
+            skip = src.nodata if nodata else 0
+        for band, feature in _raster_features(out_dir + "/" + i):
+            sources.append((out_dir + "/" + i, band, feature, skip))
+    return sources
+
+
+def _rasterize_grid(mask, cellsize, path, table_format="csv", rows=None, workers=1, block_pixels=2**22):
+    
+    # the grid is aligned to whole multiples of the cell size and covers the mask bounds
+    size = float(cellsize)
+    left, bottom, right, top = mask.total_bounds
+    left, top = np.floor(left / size) * size, np.ceil(top / size) * size
+    width = max(1, int(np.ceil((right - left) / size)))
+    height = max(1, int(np.ceil((top - bottom) / size)))
+    transform = Affine(size, 0, left, 0, -size, top)
+    shapes = [g for g in mask.geometry if g is not None and not g.is_empty]
+    
+    def cells(window):
+        return rasterio.features.rasterize(((g, 1) for g in shapes), out_shape=(int(window.height), width),
+                                           transform=rasterio.windows.transform(window, transform),
+                                           fill=0, dtype='uint8')
+    
+    profile = dict(driver='GTiff', width=width, height=height, count=1, crs=mask.crs,
+                   transform=transform, compress='deflate')
+    tables = [path + "/output/grid/" + i for i in _grid_tables("native", table_format)]
+    writer = None
+    for table in tables:
+        if table.endswith(".csv"):
+            pd.DataFrame(columns=['x', 'y', 'cell_ID']).to_csv(table, index=False)
         else:
-            try:
-                gdd.download_file_from_google_drive(file_id=url_to_id(layer_urls[i]),
-                                                    dest_path=path+"/input/" + layer_lst[i], 
-                                                    overwrite=True, showsize=True)
-            except IndexError:
-                print(layer_lst[i] + " can't be downloaded, check URL...")
+            import pyarrow
+            import pyarrow.parquet
+            writer = pyarrow.parquet.ParquetWriter(table, pyarrow.schema(
+                [('x', pyarrow.float64()), ('y', pyarrow.float64()), ('cell_ID', pyarrow.uint32())]))
+    
+    offset = [0]
+    with rasterio.open(path + "/output/grid/grid.tif", 'w', **dict(profile, dtype='uint8', nodata=0)) as grd, \
+         rasterio.open(path + "/output/grid/grid_ID.tif", 'w', **dict(profile, dtype='uint32', nodata=0)) as ids:
+        
+        def write(window, block):
+            
+            # cell_IDs follow from a running count of the valid cells, row by row
+            grid_ids = _cell_ids(block, offset[0])
+            offset[0] += int(np.count_nonzero(block))
+            grd.write(block, 1, window=window)
+            ids.write(grid_ids, 1, window=window)
+            row, col = np.nonzero(block)
+            cell_df = pd.DataFrame({'x': left + (col + 0.5) * size,
+                                    'y': top - (row + window.row_off + 0.5) * size,
+                                    'cell_ID': grid_ids[row, col]})
+            if table_format != "parquet":
+                cell_df.to_csv(tables[0], mode='a', header=False, index=False)
+            if writer is not None:
+                writer.write_table(pyarrow.Table.from_pandas(cell_df, preserve_index=False))
+        
+        try:
+            _map_tiles(cells, _tile_windows(height, width, rows or max(1, block_pixels // width)), write, workers)
+        finally:
+            if writer is not None:
+                writer.close()
+    return tables
 
-                
+
+def _table_formats(table_format):
+    
+    # the table files written for table_format, the CSV one first
+    if table_format not in ("csv", "parquet", "both"):
+        raise ValueError("Unknown table format " + table_format)
+    return ["csv", "parquet"] if table_format == "both" else [table_format]
+
+
+def _grid_tables(engine, table_format):
+    """Return the cell tables grid() writes to output/grid for engine and table_format."""
+    
+    # SAGA grids always come with grid.csv, the native grid with the tables asked for
+    formats = _table_formats(table_format)
+    return ["grid.csv"] if engine == "saga" else ["grid." + i for i in formats]
+
+
+def grid(mask, cellsize, path, engine="saga", table_format="csv"):
+    
+    if engine not in ("saga", "native"):
+        raise ValueError("Unknown grid engine " + engine)
+    _grid_tables(engine, table_format)
     
-def grid(mask, cellsize, path):
+    # a new grid starts a new product, and with it a new metrics journal
+    metrics.start(path)
     
     doc = ProvDocument()
     
@@ -49,12 +404,47 @@ def grid(mask, cellsize, path):
     doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
     doc.set_default_namespace("")
     
+    if engine == "native":
+        
+        if not os.path.exists(path + '/output/grid'): os.makedirs(path + '/output/grid')
+        rio = doc.agent("rasterio", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', 'rasterio ' + rasterio.__version__ + ', GDAL ' + rasterio.__gdal_version__)))
+        
+        mask.to_file(path + "/input/mask.gpkg", driver="GPKG")
+        
+        grid_start = datetime.now()
+        with metrics.step(path, 'rasterize_grid', None):
+            tables = _rasterize_grid(mask, cellsize, path, table_format, tile_rows, tile_workers)
+        grid_end = datetime.now()
+        
+        mask_ent = doc.entity('mask.gpkg', (
+            (prov.model.PROV_TYPE, mask.type[0]), 
+            ('cat:CT_CRS', str(mask.crs)), 
+            ('gex:EX_GeographicBoundingBox', str(mask.total_bounds))))
+        cz_ent = doc.entity('msr:resolution', (
+            (prov.model.PROV_TYPE, mask.crs.axis_info[0].unit_name),
+            (prov.model.PROV_VALUE, cellsize)))
+        grid_act = doc.activity('rasterize_' + str(time()), grid_start, grid_end)
+        doc.used(grid_act, cz_ent)
+        doc.used(grid_act, mask_ent)
+        doc.wasGeneratedBy(doc.entity('grid.tif'), grid_act)
+        doc.wasGeneratedBy(doc.entity('grid_ID.tif'), grid_act)
+        doc.wasAssociatedWith(grid_act, rio)
+        doc.wasDerivedFrom(doc.entity('grid_ID.tif'), doc.entity('grid.tif'))
+        for table in tables:
+            doc.wasGeneratedBy(doc.entity(os.path.basename(table)), grid_act)
+            doc.wasDerivedFrom(doc.entity(os.path.basename(table)), doc.entity('grid_ID.tif'))
+        
+        metrics.save_grid(path)
+        return doc
+    
     saga = doc.agent("saga_cmd", (
     (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('saga_cmd --version').read().splitlines()[0])))
+    ('cit:edition', _tool_version(saga_cmd))))
     gdal = doc.agent("gdal", (
     (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('ogrinfo --version').read().splitlines()[0])))
+    ('cit:edition', _tool_version('ogrinfo'))))
     
     if not os.path.exists(path + '/output/grid'): os.makedirs(path + '/output/grid')
     
@@ -64,7 +454,7 @@ def grid(mask, cellsize, path):
     gg_act = doc.activity('grid_gridding_0_' + str(time())) 
 
     gg_act.set_time(startTime=datetime.now())
-    os.system(saga_cmd 
+    metrics.run(path, 'grid_gridding_0', None, saga_cmd
               + ' grid_gridding 0 -INPUT ' + path + '/input/mask.gpkg -GRID ' + path + '/output/grid/grid.tif -OUTPUT 0 -GRID_TYPE 1 -TARGET_DEFINITION 0 -TARGET_USER_SIZE ' + str(cellsize)
               + " -TARGET_USER_XMIN " + str(mask_bbox[0] - 0.5*int(cellsize))
               + " -TARGET_USER_YMIN " + str(mask_bbox[1] - 0.5*int(cellsize))
@@ -87,24 +477,739 @@ def grid(mask, cellsize, path):
     
     trans_act = doc.activity('gdal_translate_' + str(time()))
     trans_act.set_time(startTime=datetime.now())    
-    os.system("gdal_translate " + path + "/output/grid/grid.tif " + path + "/analysis/grid.xyz")
+    metrics.run(path, 'gdal_translate', None, "gdal_translate " + path + "/output/grid/grid.tif " + path + "/analysis/grid.xyz")
     doc.wasGeneratedBy(doc.entity('grid.xyz'), trans_act)
     doc.used(trans_act, doc.entity("grid.tif"))
     doc.wasAssociatedWith(trans_act, gdal)
     trans_act.set_time(endTime=datetime.now())
     
-    grid_xyz = pd.read_csv(path + "/analysis/grid.xyz", header=None, delimiter=" ")
-    grid_sub = grid_xyz[(grid_xyz[2] != 0)]
-    grid_sub['cell_ID'] = range(1,len(grid_sub)+1)
-    grid_rm = grid_sub.drop(2, axis='columns').rename(columns={0:"x",1:"y"})
-    grid_rm.to_csv(path + "/output/grid/grid.csv", index=False)
+    with metrics.step(path, 'grid.csv', None):
+        grid_xyz = pd.read_csv(path + "/analysis/grid.xyz", header=None, delimiter=" ")
+        grid_sub = grid_xyz[(grid_xyz[2] != 0)]
+        grid_sub['cell_ID'] = range(1,len(grid_sub)+1)
+        grid_rm = grid_sub.drop(2, axis='columns').rename(columns={0:"x",1:"y"})
+        grid_rm.to_csv(path + "/output/grid/grid.csv", index=False)
     doc.wasDerivedFrom(doc.entity('grid.csv'), doc.entity('grid.xyz'))
     
+    if os.path.exists(path + "/output/grid/grid_ID.tif"): os.remove(path + "/output/grid/grid_ID.tif")
+    _grid_index(path)
+    doc.wasDerivedFrom(doc.entity('grid_ID.tif'), doc.entity('grid.tif'))
+    
+    metrics.save_grid(path)
     return doc
 
 
             
-def coverages(layers, projection, path):
+def _map_layers(step, jobs, description, max_workers=None, path=None):
+    
+    # jobs are (name, args) pairs; the steps of different layers are
+    # independent, so they run on a pool and progress advances as they finish.
+    # In a planned run every job takes one of the run's worker slots, which
+    # the functions running side by side (and batch products) share
+    slots = _run_slots(path)
+    if slots is not None:
+        step = partial(_in_slot, slots, step)
+    t = tqdm(total=len(jobs))
+    with futures.ThreadPoolExecutor(max_workers) as pool:
+        running = {pool.submit(step, *args): name for name, args in jobs}
+        for job in futures.as_completed(running):
+            job.result()
+            t.set_description(description + running[job], refresh=True)
+            t.update()
+    t.close()
+
+
+def _clip_bounds(template, crs, buffer=2):
+    
+    # the grid extent plus a margin of buffer grid cells, in the crs of a layer
+    with rasterio.open(template) as grd:
+        left, bottom, right, top = grd.bounds
+        margin = buffer * abs(grd.transform.a)
+        grid_crs = grd.crs
+    return rasterio.warp.transform_bounds(grid_crs, crs, left - margin, bottom - margin,
+                                          right + margin, top + margin, densify_pts=21)
+
+
+def _clip_raster(source, bounds, out, block_pixels=2**22):
+    
+    with rasterio.open(source) as src:
+        window = rasterio.windows.from_bounds(*bounds, transform=src.transform)
+        col0, row0 = max(0, int(np.floor(window.col_off))), max(0, int(np.floor(window.row_off)))
+        col1 = min(src.width, int(np.ceil(window.col_off + window.width)))
+        row1 = min(src.height, int(np.ceil(window.row_off + window.height)))
+        window = Window(col0, row0, col1 - col0, row1 - row0)
+        profile = src.profile
+        profile.update(width=int(window.width), height=int(window.height),
+                       transform=src.window_transform(window), BIGTIFF='IF_SAFER')
+        with rasterio.open(out, 'w', **profile) as dst:
+            for strip in _tile_windows(dst.height, dst.width, max(1, block_pixels // dst.width)):
+                dst.write(src.read(window=Window(window.col_off, window.row_off + strip.row_off,
+                                                 strip.width, strip.height)), window=strip)
+    return 0
+
+
+def _clip_vector(source, bounds, out):
+    
+    gpd.read_file(source, bbox=bounds).to_file(out, driver="GPKG")
+    return 0
+
+
+def _clip_input(layer, path, stem):
+    
+    # layers reaching past the grid are cut to its extent before SAGA
+    # reprojects them; returns the file to use and whether it was clipped
+    source = path + "/input/" + layer
+    if not clip_inputs:
+        return source, False
+    if layer.endswith(".tif"):
+        with rasterio.open(source) as src:
+            crs = src.crs
+            extent = tuple(src.bounds)
+        clipped = path + "/analysis/" + stem + "_clip.tif"
+        clip = _clip_raster
+    else:
+        info = pyogrio.read_info(source, force_total_bounds=True)
+        crs = info['crs']
+        extent = tuple(info['total_bounds'])
+        clipped = path + "/analysis/" + stem + "_clip.gpkg"
+        clip = _clip_vector
+    if crs is None:
+        return source, False
+    
+    bounds = _clip_bounds(path + "/output/grid/grid.tif", crs, clip_buffer)
+    inside = (extent[0] >= bounds[0] and extent[1] >= bounds[1] and extent[2] <= bounds[2] and extent[3] <= bounds[3])
+    apart = (extent[0] > bounds[2] or extent[2] < bounds[0] or extent[1] > bounds[3] or extent[3] < bounds[1])
+    if inside or apart:
+        return source, False
+    
+    with metrics.step(path, 'clip', os.path.splitext(layer)[0]):
+        _cached(cache.key('clip', cache.file_hash(source), cache.file_hash(path + "/output/grid/grid.tif"), clip_buffer),
+                clipped, lambda: clip(source, bounds, clipped), [''])
+    return clipped, True
+
+
+def _layer_entity(doc, path, layer, url, projection):
+    
+    # the entities of an input layer, described from its file in input/, and
+    # of the projection it is taken to; called with the lock of doc held
+    source = path + "/input/" + layer
+    if layer.endswith(".tif"):
+        with rasterio.open(source) as lyr:
+            lyr_ent = doc.entity(layer, (
+                (prov.model.PROV_TYPE, lyr.meta['driver']),
+                ('cat:CT_CRS', str(lyr.crs.to_proj4())),
+                ('gex:EX_GeographicBoundingBox', str(list(lyr.bounds[0:4]))),
+                ('msr:resolution', lyr.meta['transform'][0]),
+                ('cit:CI_OnlineResource', url)))
+    else:
+        info = pyogrio.read_info(source, force_total_bounds=True)
+        lyr_ent = doc.entity(layer, (
+            (prov.model.PROV_TYPE, info['geometry_type']),
+            ('cat:CT_CRS', str(pyproj.CRS(info['crs']).to_proj4())),
+            ('gex:EX_GeographicBoundingBox', str(np.array(info['total_bounds']))),
+            ('cit:CI_OnlineResource', url)))
+    proj_ent = doc.entity('projection', (
+        (prov.model.PROV_TYPE, 'proj4string'),
+        (prov.model.PROV_VALUE, str(projection))))
+    return lyr_ent, proj_ent
+
+
+def _clip_doc(doc, lyr_ent, source, start, end):
+    
+    clip_act = doc.activity('clip_' + str(time()), start, end)
+    clip_ent = doc.entity(os.path.basename(source))
+    doc.wasGeneratedBy(clip_ent, clip_act)
+    doc.used(clip_act, lyr_ent)
+    doc.used(clip_act, doc.entity('grid.tif'))
+    return clip_ent
+
+
+def _share_run(path, layers=(), downloaded=(), slots=None):
+    
+    # backend plans an analysis up front: layers listed under several functions
+    # are harmonized once for all of them, into files without a function suffix,
+    # downloaded layers are not fetched again and the per-layer steps take
+    # turns on the semaphore slots; without arguments the run ends
+    with _runs_lock:
+        if layers or downloaded or slots is not None:
+            _runs[os.path.abspath(path)] = {'layers': {i: {'lock': threading.Lock(), 'done': {}} for i in layers},
+                                            'downloaded': set(downloaded), 'slots': slots}
+        else:
+            _runs.pop(os.path.abspath(path), None)
+
+
+def _run_slots(path):
+    
+    if path is None:
+        return None
+    with _runs_lock:
+        return _runs.get(os.path.abspath(path), {}).get('slots')
+
+
+def _in_slot(slots, step, *args):
+    
+    # a step waiting in _once for another function holds its slot, but the
+    # step it waits for already holds one of its own
+    with slots:
+        return step(*args)
+
+
+def _shared(path, layer):
+    
+    with _runs_lock:
+        return _runs.get(os.path.abspath(path), {}).get('layers', {}).get(layer)
+
+
+def _stem(path, layer, suffix):
+    
+    name = os.path.splitext(layer)[0]
+    return name if _shared(path, layer) else name + "_" + suffix
+
+
+def _once(path, layer, step, run):
+    
+    # runs a preprocessing step of layer and returns its result and True; when
+    # the layer is shared and another function ran the step in this run, its
+    # result is returned with False and the step's files and provenance are
+    # that function's
+    state = _shared(path, layer)
+    if state is None:
+        return run(), True
+    with state['lock']:
+        if step in state['done']:
+            return state['done'][step], False
+        state['done'][step] = run()
+        return state['done'][step], True
+
+
+def _reproject_vector(doc, lock, saga, layer, url, projection, path, stem):
+    
+    name = os.path.splitext(layer)[0]
+    clip_start = datetime.now()
+    source, clipped = _clip_input(layer, path, stem)
+    clip_end = datetime.now()
+    
+    proj_key = cache.key('pj_proj4_2', cache.file_hash(source), projection, _tool_version(saga_cmd))
+    proj_start = datetime.now()
+    _cached(proj_key, path + "/analysis/" + stem + "_reproj.gpkg", lambda: metrics.run(path, 'pj_proj4_2', name, saga_cmd
+    + " -f=p pj_proj4 2 -CRS_PROJ4 "+ projection
+    + " -SOURCE " + source
+    + " -TARGET " + path + "/analysis/" + stem + "_reproj.gpkg -PARALLEL 1"))
+    proj_end = datetime.now()
+    
+    with lock:
+        lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
+        if clipped:
+            lyr_ent = _clip_doc(doc, lyr_ent, source, clip_start, clip_end)
+
+        proj_shp_act = doc.activity('pj_proj4_2_' + str(time()), proj_start, proj_end)
+        doc.wasGeneratedBy(doc.entity(stem + '_reproj.gpkg'), proj_shp_act)
+        doc.used(proj_shp_act, lyr_ent)
+        doc.used(proj_shp_act, proj_ent)
+        doc.wasAssociatedWith(proj_shp_act, saga)
+    
+    return proj_key
+
+
+def _harmonize_layer(doc, lock, saga, layer, url, projection, path, suffix):
+    
+    name = os.path.splitext(layer)[0]
+    stem = _stem(path, layer, suffix)
+    
+    if layer.endswith(".tif") == False:
+        
+        proj_key, _ = _once(path, layer, 'pj_proj4_2', lambda: _reproject_vector(
+            doc, lock, saga, layer, url, projection, path, stem))
+        
+        def rasterize():
+            rstr_start = datetime.now()
+            _cached(cache.key('grid_gridding_0', proj_key, 100), path + "/analysis/" + stem + "_raster.tif", lambda: metrics.run(path, 'grid_gridding_0', name, saga_cmd
+            + " grid_gridding 0 -INPUT " + path + "/analysis/" + stem + "_reproj.gpkg"
+            + " -GRID " + path + "/analysis/" + stem + "_raster.tif -TARGET_USER_SIZE 100"))
+            rstr_end = datetime.now()
+            
+            with lock:
+                rstr_act = doc.activity('grid_gridding_0_' + str(time()), rstr_start, rstr_end)
+                doc.wasGeneratedBy(doc.entity(stem + '_raster.tif'), rstr_act)
+                doc.used(rstr_act, doc.entity(stem + '_reproj.gpkg'))
+                doc.wasAssociatedWith(rstr_act, saga)
+        
+        _once(path, layer, 'grid_gridding_0', rasterize)
+
+    else:
+        
+        def reproject():
+            clip_start = datetime.now()
+            source, clipped = _clip_input(layer, path, stem)
+            clip_end = datetime.now()
+            
+            proj_start = datetime.now()
+            _cached(cache.key('pj_proj4_4', cache.file_hash(source), projection, _tool_version(saga_cmd)),
+                    path + "/analysis/" + stem + "_raster.tif", lambda: metrics.run(path, 'pj_proj4_4', name, saga_cmd
+            + " pj_proj4 4 -CRS_PROJ4 "+ projection
+            + " -SOURCE " + source
+            + " -GRID " + path + "/analysis/" + stem + "_raster.tif -RESAMPLING 0"))
+            proj_end = datetime.now()
+            
+            with lock:
+                lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
+                if clipped:
+                    lyr_ent = _clip_doc(doc, lyr_ent, source, clip_start, clip_end)
+
+                proj_rstr_act = doc.activity('pj_proj4_4_' + str(time()), proj_start, proj_end)
+                doc.wasGeneratedBy(stem + '_raster.tif', proj_rstr_act)
+                doc.used(proj_rstr_act, lyr_ent)
+                doc.used(proj_rstr_act, proj_ent)
+                doc.wasAssociatedWith(proj_rstr_act, saga)
+        
+        _once(path, layer, 'pj_proj4_4', reproject)
+
+
+def _outside(src):
+    
+    # the value of cells outside the footprint of src: its nodata, or for
+    # rasters without one the far end of an integer type and -99999 for floats
+    if src.nodata is not None:
+        return src.nodata
+    if np.issubdtype(np.dtype(src.dtypes[0]), np.integer):
+        info = np.iinfo(src.dtypes[0])
+        return info.min if info.min < 0 else info.max
+    return -99999
+
+
+def _warp_raster(source, template, out, buffer=2):
+    
+    # a warped VRT of the layer in the grid CRS at about its own resolution,
+    # over the grid extent only; it is a few lines of XML, the pixels are
+    # reprojected whenever the VRT is read
+    with rasterio.open(template) as grd:
+        left, bottom, right, top = grd.bounds
+        margin = buffer * abs(grd.transform.a)
+        crs = grd.crs
+    with rasterio.open(os.path.abspath(source)) as src:
+        default = rasterio.warp.calculate_default_transform(src.crs, crs, src.width, src.height, *src.bounds)[0]
+        xres, yres = abs(default.a), abs(default.e)
+        width = int(np.ceil((right - left + 2 * margin) / xres))
+        height = int(np.ceil((top - bottom + 2 * margin) / yres))
+        with WarpedVRT(src, crs=crs, transform=Affine(xres, 0, left - margin, 0, -yres, top + margin),
+                       width=width, height=height, nodata=_outside(src), resampling=Resampling.nearest) as vrt:
+            rasterio.shutil.copy(vrt, out, driver='VRT')
+    return 0
+
+
+def _raster_hash(raster):
+    
+    # a VRT is hashed together with the files it reads
+    if raster.endswith(".vrt"):
+        with rasterio.open(raster) as src:
+            return cache.key(*[cache.file_hash(f) for f in src.files])
+    return cache.file_hash(raster)
+
+
+def _virtual_layer(doc, lock, rio, layer, url, projection, path, suffix):
+    
+    name = os.path.splitext(layer)[0]
+    stem = _stem(path, layer, suffix)
+    
+    def warp():
+        warp_start = datetime.now()
+        with metrics.step(path, 'warp', name):
+            _warp_raster(path + "/input/" + layer, path + "/output/grid/grid.tif",
+                         path + "/analysis/" + stem + "_raster.vrt", clip_buffer)
+        warp_end = datetime.now()
+        
+        with lock:
+            lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
+            
+            warp_act = doc.activity('warp_' + str(time()), warp_start, warp_end)
+            doc.wasGeneratedBy(doc.entity(stem + '_raster.vrt', (
+                (prov.model.PROV_TYPE, 'VRTWarpedDataset'),)), warp_act)
+            doc.used(warp_act, lyr_ent)
+            doc.used(warp_act, proj_ent)
+            doc.used(warp_act, doc.entity('grid.tif'))
+            doc.wasAssociatedWith(warp_act, rio)
+    
+    _once(path, layer, 'warp', warp)
+
+
+def _coverage_raster(doc, lock, saga, raster, name, path):
+    
+    cov_key = cache.key('grid_analysis_26', cache.file_hash(path + "/analysis/" + raster),
+                        cache.file_hash(path + "/output/grid/grid.tif"), _tool_version(saga_cmd))
+    cov_start = datetime.now()
+    _cached(cov_key, path + "/output/coverages/" + name + "_cov_", lambda: metrics.run(path, 'grid_analysis_26', name, saga_cmd
+    + " grid_analysis 26 -CLASSES " + path + "/analysis/" + raster
+    + " -COVERAGES " + path + "/output/coverages/" + name + "_cov_.tif"
+    + " -TARGET_DEFINITION 1 -TARGET_TEMPLATE " + path + "/output/grid/grid.tif -DATADEPTH 3"))
+    cov_end = datetime.now()
+    
+    with lock:
+        calc_cov_act = doc.activity('grid_analysis_26_' + str(time()), cov_start, cov_end)
+        doc.wasGeneratedBy(doc.entity(name + '_cov_.tif'), calc_cov_act)
+        doc.used(calc_cov_act, doc.entity(raster))
+        doc.used(calc_cov_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(calc_cov_act, saga)
+
+
+def _valid(values, nodata):
+    
+    valid = np.ones(values.shape, dtype=bool) if nodata is None else values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    return valid
+
+
+def _class_label(value):
+    
+    if isinstance(value, str):
+        return value
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _class_fractions(classes, template, out, prefix, rows=None, workers=1, block_pixels=2**22):
+    
+    with rasterio.open(template) as grd:
+        profile = grd.profile
+        height, width = grd.shape
+        transform = grd.transform
+        crs = grd.crs
+    
+    with rasterio.open(classes) as src:
+        
+        # the class values are collected from the source itself, block by block
+        values = set()
+        scan = max(1, block_pixels // src.width)
+        for row in range(0, src.height, scan):
+            block = src.read(1, window=Window(0, row, src.width, min(scan, src.height - row)))
+            values.update(np.unique(block[_valid(block, src.nodata)]).tolist())
+        f = max(1, int(round(abs(transform.a) / abs(src.transform.a))))
+    class_values = np.array(sorted(values))
+    if len(class_values) == 0:
+        return 0
+    
+    # every grid cell is sampled by f x f class cells at about the class
+    # resolution, and the share of each class is counted per cell
+    sub = transform * Affine.scale(1 / f)
+    
+    def fractions(window):
+        h = int(window.height)
+        # cells outside the footprint of the classes are nodata, not class 0
+        with rasterio.open(classes) as src, WarpedVRT(src, crs=crs, transform=sub, width=width * f, height=height * f,
+                                                      nodata=_outside(src), resampling=Resampling.nearest) as vrt:
+            block = vrt.read(1, window=Window(0, window.row_off * f, width * f, h * f))
+            nodata = vrt.nodata
+        idx = np.clip(np.searchsorted(class_values, block), 0, len(class_values) - 1)
+        valid = _valid(block, nodata) & (class_values[idx] == block)
+        cell = (np.arange(h * f)[:, None] // f) * width + np.arange(width * f)[None, :] // f
+        counts = np.bincount(cell[valid] * len(class_values) + idx[valid],
+                             minlength=h * width * len(class_values))
+        return (counts.reshape(h, width, len(class_values)).transpose(2, 0, 1) / float(f * f)).astype('float32')
+    
+    profile.update(dtype='float32', count=len(class_values), nodata=None, compress='deflate')
+    with rasterio.open(out, 'w', **profile) as dst:
+        for b in range(len(class_values)):
+            dst.set_band_description(b + 1, _class_label(class_values[b]))
+            dst.update_tags(b + 1, feature=prefix + _class_label(class_values[b]))
+        windows = _tile_windows(height, width, rows or max(1, block_pixels // (width * f * f)))
+        _map_tiles(fractions, windows, lambda window, block: dst.write(block, window=window), workers)
+    return 0
+
+
+def _native_coverage(doc, lock, rio, raster, name, path):
+    
+    # integer rasters without nodata counted cells outside their footprint as class 0 before version 2
+    cov_key = cache.key('class_fractions', 2, _raster_hash(path + "/analysis/" + raster),
+                        cache.file_hash(path + "/output/grid/grid.tif"))
+    cov_start = datetime.now()
+    with metrics.step(path, 'class_fractions', name):
+        _cached(cov_key, path + "/output/coverages/" + name + "_cov.tif", lambda: _class_fractions(
+            path + "/analysis/" + raster, path + "/output/grid/grid.tif",
+            path + "/output/coverages/" + name + "_cov.tif", name + "_cov_", tile_rows, tile_workers))
+    cov_end = datetime.now()
+    
+    with lock:
+        calc_cov_act = doc.activity('class_fractions_' + str(time()), cov_start, cov_end)
+        doc.wasGeneratedBy(doc.entity(name + '_cov.tif'), calc_cov_act)
+        doc.used(calc_cov_act, doc.entity(raster))
+        doc.used(calc_cov_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(calc_cov_act, rio)
+
+
+def _polygon_fractions(layer, template, out, prefix, rows=None, workers=1, block_pixels=2**22):
+    
+    with rasterio.open(template) as grd:
+        profile = grd.profile
+        height, width = grd.shape
+        transform = grd.transform
+        crs = grd.crs
+    
+    # polygons are classed by their first attribute, like the SAGA gridding
+    # of the layer, or numbered when the layer has none
+    layer_crs = pyogrio.read_info(layer)['crs']
+    bbox = _clip_bounds(template, layer_crs, clip_buffer) if clip_inputs and layer_crs else None
+    lyr = gpd.read_file(layer, bbox=bbox).to_crs(crs)
+    columns = [c for c in lyr.columns if c != lyr.geometry.name]
+    classes = lyr[columns[0]] if columns else pd.Series(range(1, len(lyr) + 1), index=lyr.index)
+    keep = (lyr.geom_type.isin(['Polygon', 'MultiPolygon']) & ~lyr.geometry.is_empty & classes.notna()).values
+    geoms = lyr.geometry.values[keep]
+    if len(geoms) == 0:
+        return 0
+    class_values, class_idx = np.unique(classes.values[keep], return_inverse=True)
+    
+    # where polygons overlap, the one drawn last covers the others, as in the
+    # rasterized layer SAGA computes its coverages from
+    tree = shapely.STRtree(geoms)
+    first, later = tree.query(geoms, predicate='intersects')
+    overlaps = (later > first) & (shapely.area(shapely.intersection(geoms[first], geoms[later])) > 0)
+    first, later = first[overlaps], later[overlaps]
+    if len(first):
+        geoms = geoms.copy()
+        for i in np.unique(first):
+            geoms[i] = shapely.difference(geoms[i], shapely.union_all(geoms[later[first == i]]))
+        tree = shapely.STRtree(geoms)
+    cell_area = abs(transform.a * transform.e)
+    
+    def fractions(window):
+        
+        # only polygons near the tile are clipped to it, and only the cells
+        # their bounding boxes touch are intersected
+        h = int(window.height)
+        with rasterio.open(template) as grd:
+            row, col = np.nonzero(grd.read(1, window=window))
+        left, bottom, right, top = rasterio.windows.bounds(window, transform)
+        near = tree.query(shapely.box(left, bottom, right, top))
+        clipped = shapely.clip_by_rect(geoms[near], left, bottom, right, top)
+        x = transform.c + col * transform.a
+        y = transform.f + (row + window.row_off) * transform.e
+        cells = shapely.box(x, y + transform.e, x + transform.a, y)
+        cell_idx, poly_idx = shapely.STRtree(clipped).query(cells, predicate='intersects')
+        areas = shapely.area(shapely.intersection(cells[cell_idx], clipped[poly_idx]))
+        flat = class_idx[near[poly_idx]] * (h * width) + row[cell_idx] * width + col[cell_idx]
+        shares = np.bincount(flat, weights=areas, minlength=len(class_values) * h * width) / cell_area
+        return shares.reshape(len(class_values), h, width).astype('float32')
+    
+    profile.update(dtype='float32', count=len(class_values), nodata=None, compress='deflate')
+    with rasterio.open(out, 'w', **profile) as dst:
+        for b in range(len(class_values)):
+            dst.set_band_description(b + 1, _class_label(class_values[b]))
+            dst.update_tags(b + 1, feature=prefix + _class_label(class_values[b]))
+        windows = _tile_windows(height, width, rows or max(1, block_pixels // width))
+        _map_tiles(fractions, windows, lambda window, block: dst.write(block, window=window), workers)
+    return 0
+
+
+def _vector_coverage(doc, lock, gpd_agent, layer, url, projection, path):
+    
+    name = os.path.splitext(layer)[0]
+    cov_start = datetime.now()
+    with metrics.step(path, 'polygon_fractions', name):
+        # overlapping polygons were counted twice before version 2
+        _cached(cache.key('polygon_fractions', 2, cache.file_hash(path + "/input/" + layer),
+                          cache.file_hash(path + "/output/grid/grid.tif")),
+                path + "/output/coverages/" + name + "_cov.tif", lambda: _polygon_fractions(
+                    path + "/input/" + layer, path + "/output/grid/grid.tif",
+                    path + "/output/coverages/" + name + "_cov.tif", name + "_cov_", tile_rows, tile_workers))
+    cov_end = datetime.now()
+    
+    with lock:
+        lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
+        
+        cov_act = doc.activity('polygon_fractions_' + str(time()), cov_start, cov_end)
+        doc.wasGeneratedBy(doc.entity(name + '_cov.tif'), cov_act)
+        doc.used(cov_act, lyr_ent)
+        doc.used(cov_act, proj_ent)
+        doc.used(cov_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(cov_act, gpd_agent)
+
+
+def _resample_raster(doc, lock, saga, raster, name, path):
+    
+    rsmpl_key = cache.key('grid_tools_0', cache.file_hash(path + '/analysis/' + raster),
+                          cache.file_hash(path + '/output/grid/grid.tif'), _tool_version(saga_cmd))
+    rsmpl_start = datetime.now()
+    _cached(rsmpl_key, path + '/output/resample/' + name + '_rsmpl.tif', lambda: metrics.run(path, 'grid_tools_0', name, saga_cmd
+              + ' grid_tools 0 -INPUT ' + path + '/analysis/' + raster +
+              ' -TARGET_TEMPLATE ' + path + '/output/grid/grid.tif' +
+              ' -OUTPUT ' + path + '/output/resample/' + name + '_rsmpl.tif' +
+              ' -TARGET_DEFINITION 1 -SCALE_UP 8 -SCALE_DOWN 0'))
+    rsmpl_end = datetime.now()
+    
+    with lock:
+        rsmpl_act = doc.activity('grid_tools_0_' + str(time()), rsmpl_start, rsmpl_end)
+        doc.wasGeneratedBy(doc.entity(name + '_rsmpl.tif'), rsmpl_act)
+        doc.used(rsmpl_act, doc.entity(raster))
+        doc.used(rsmpl_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(rsmpl_act, saga)
+
+
+def _aggregate_raster(source, template, out, rows=None, workers=1, block_pixels=2**22):
+    
+    with rasterio.open(template) as grd:
+        profile = grd.profile
+        height, width = grd.shape
+        transform = grd.transform
+        crs = grd.crs
+    
+    with rasterio.open(source) as src:
+        dtype = src.dtypes[0]
+        categorical = np.issubdtype(np.dtype(dtype), np.integer)
+        nodata = _outside(src)
+        f = max(1, int(round(abs(transform.a) / abs(src.transform.a))))
+    
+    # categorical rasters take the majority class of each cell, continuous ones
+    # the mean; by default a tile covers at most block_pixels source cells
+    resampling = Resampling.mode if categorical else Resampling.average
+    
+    def aggregate(window):
+        with rasterio.open(source) as src, WarpedVRT(src, crs=crs, transform=transform, width=width, height=height,
+                                                     nodata=nodata, resampling=resampling) as vrt:
+            return vrt.read(1, window=window)
+    
+    profile.update(dtype=dtype, count=1, nodata=nodata, compress='deflate')
+    with rasterio.open(out, 'w', **profile) as dst:
+        windows = _tile_windows(height, width, rows or max(1, block_pixels // (width * f * f)))
+        _map_tiles(aggregate, windows, lambda window, block: dst.write(block, 1, window=window), workers)
+    return 0
+
+
+def _native_resample(doc, lock, rio, raster, name, path):
+    
+    # integer rasters without nodata were 0 outside their footprint before version 2
+    rsmpl_key = cache.key('aggregate', 2, _raster_hash(path + '/analysis/' + raster),
+                          cache.file_hash(path + '/output/grid/grid.tif'))
+    rsmpl_start = datetime.now()
+    with metrics.step(path, 'aggregate', name):
+        _cached(rsmpl_key, path + '/output/resample/' + name + '_rsmpl.tif', lambda: _aggregate_raster(
+            path + '/analysis/' + raster, path + '/output/grid/grid.tif',
+            path + '/output/resample/' + name + '_rsmpl.tif', tile_rows, tile_workers))
+    rsmpl_end = datetime.now()
+    
+    with lock:
+        rsmpl_act = doc.activity('aggregate_' + str(time()), rsmpl_start, rsmpl_end)
+        doc.wasGeneratedBy(doc.entity(name + '_rsmpl.tif'), rsmpl_act)
+        doc.used(rsmpl_act, doc.entity(raster))
+        doc.used(rsmpl_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(rsmpl_act, rio)
+
+
+def _rasterize_vector(layer, template, out, cellsize=100, rows=None, workers=1, times=None):
+    
+    # the layer is reprojected in memory and burned at cellsize into a
+    # /vsimem/ raster over the grid extent, which is then aggregated to the
+    # grid; neither intermediate is written to disk
+    times = {} if times is None else times
+    with rasterio.open(template) as grd:
+        left, bottom, right, top = grd.bounds
+        margin = clip_buffer * abs(grd.transform.a)
+        crs = grd.crs
+    
+    start = datetime.now()
+    layer_crs = pyogrio.read_info(layer)['crs']
+    bbox = _clip_bounds(template, layer_crs, clip_buffer) if clip_inputs and layer_crs else None
+    lyr = gpd.read_file(layer, bbox=bbox).to_crs(crs)
+    lyr = lyr[~lyr.geometry.is_empty & lyr.geometry.notna()]
+    times['reproj'] = (start, datetime.now())
+    
+    # burned with their first attribute, like the SAGA gridding of the layer,
+    # or numbered when the layer has none or it is not numeric
+    start = datetime.now()
+    columns = [c for c in lyr.columns if c != lyr.geometry.name]
+    values = lyr[columns[0]] if columns else pd.Series(range(1, len(lyr) + 1), index=lyr.index)
+    if not pd.api.types.is_numeric_dtype(values):
+        values = pd.Series(pd.factorize(values)[0] + 1, index=lyr.index)
+    dtype = 'int32' if pd.api.types.is_integer_dtype(values) else 'float32'
+    keep = values.notna().values
+    width = int(np.ceil((right - left + 2 * margin) / cellsize))
+    height = int(np.ceil((top - bottom + 2 * margin) / cellsize))
+    transform = Affine(cellsize, 0, left - margin, 0, -cellsize, top + margin)
+    shapes = list(zip(lyr.geometry.values[keep], values.values[keep]))
+    burned = rasterio.features.rasterize(shapes, out_shape=(height, width), transform=transform,
+                                         fill=-99999, dtype=dtype) if shapes else np.full((height, width), -99999, dtype)
+    times['raster'] = (start, datetime.now())
+    
+    start = datetime.now()
+    with rasterio.MemoryFile() as mem:
+        with mem.open(driver='GTiff', width=width, height=height, count=1, dtype=dtype, crs=crs,
+                      transform=transform, nodata=-99999) as tmp:
+            tmp.write(burned, 1)
+        del burned
+        status = _aggregate_raster(mem.name, template, out, rows, workers)
+    times['aggregate'] = (start, datetime.now())
+    return status
+
+
+def _native_vector_resample(doc, lock, rio, layer, url, projection, path):
+    
+    name = os.path.splitext(layer)[0]
+    times = {}
+    rsmpl_start = datetime.now()
+    with metrics.step(path, 'rasterize_aggregate', name):
+        _cached(cache.key('rasterize_aggregate', cache.file_hash(path + "/input/" + layer), projection,
+                          cache.file_hash(path + '/output/grid/grid.tif'), clip_buffer),
+                path + '/output/resample/' + name + '_rsmpl.tif', lambda: _rasterize_vector(
+                    path + "/input/" + layer, path + '/output/grid/grid.tif',
+                    path + '/output/resample/' + name + '_rsmpl.tif', 100, tile_rows, tile_workers, times))
+    rsmpl_end = datetime.now()
+    
+    # the intermediates only ever lived in memory, provenance still names them;
+    # restored from the cache every step spans the whole restore
+    with lock:
+        lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
+        
+        reproj_ent = doc.entity(name + '_rsmpl_reproj.gpkg', ((prov.model.PROV_TYPE, 'in-memory'),))
+        raster_ent = doc.entity(name + '_rsmpl_raster.tif', ((prov.model.PROV_TYPE, 'in-memory'),))
+        
+        start, end = times.get('reproj', (rsmpl_start, rsmpl_end))
+        reproj_act = doc.activity('to_crs_' + str(time()), start, end)
+        doc.wasGeneratedBy(reproj_ent, reproj_act)
+        doc.used(reproj_act, lyr_ent)
+        doc.used(reproj_act, proj_ent)
+        doc.wasAssociatedWith(reproj_act, rio)
+        
+        start, end = times.get('raster', (rsmpl_start, rsmpl_end))
+        rstr_act = doc.activity('rasterize_' + str(time()), start, end)
+        doc.wasGeneratedBy(raster_ent, rstr_act)
+        doc.used(rstr_act, reproj_ent)
+        doc.wasAssociatedWith(rstr_act, rio)
+        
+        start, end = times.get('aggregate', (rsmpl_start, rsmpl_end))
+        rsmpl_act = doc.activity('aggregate_' + str(time()), start, end)
+        doc.wasGeneratedBy(doc.entity(name + '_rsmpl.tif'), rsmpl_act)
+        doc.used(rsmpl_act, raster_ent)
+        doc.used(rsmpl_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(rsmpl_act, rio)
+
+
+def _pa_layer(doc, lock, saga, layer, url, projection, path):
+    
+    name = os.path.splitext(layer)[0]
+    stem = _stem(path, layer, 'pa')
+    
+    proj_key, _ = _once(path, layer, 'pj_proj4_2', lambda: _reproject_vector(
+        doc, lock, saga, layer, url, projection, path, stem))
+    
+    pa_start = datetime.now()
+    _cached(cache.key('grid_gridding_0', proj_key, cache.file_hash(path + '/output/grid/grid.tif')),
+            path + '/output/presence_absence/' + name + '_', lambda: metrics.run(path, 'grid_gridding_0', name, saga_cmd
+             + ' grid_gridding 0 -INPUT ' + path + '/analysis/' + stem + '_reproj.gpkg'
+             + ' -TARGET_TEMPLATE ' + path + '/output/grid/grid.tif'
+             + ' -GRID ' + path + '/output/presence_absence/' + name + '_pa.tif '
+             + ' -COUNT ' + path + '/output/presence_absence/' + name + '_count.tif '
+             + ' -OUTPUT 0' 
+             + ' -TARGET_DEFINITION 1'), ['pa.tif', 'count.tif'])
+    pa_end = datetime.now()
+    
+    with lock:
+        pa_act = doc.activity('grid_gridding_0_' + str(time()), pa_start, pa_end)
+        doc.wasGeneratedBy(doc.entity(name + '_pa.tif'), pa_act)
+        doc.wasGeneratedBy(doc.entity(name + '_count.tif'), pa_act)
+        doc.used(pa_act, doc.entity(stem + '_reproj.gpkg'))
+        doc.used(pa_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(pa_act, saga)
+
+
+            
+def _layer_doc():
     
     doc = ProvDocument()
     
@@ -114,12 +1219,111 @@ def coverages(layers, projection, path):
     doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
     doc.set_default_namespace("")
     
-    saga = doc.agent("saga_cmd", (
-        (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-        ('cit:edition', os.popen('saga_cmd --version').read().splitlines()[0])))
-    gdal = doc.agent("gdal", (
+    return doc
+
+
+def _input_hash(path, layer, url):
+    
+    # zipped layers are unpacked and removed after download, their URL and
+    # the version of the remote file stand in
+    if os.path.exists(path + "/input/" + layer):
+        return cache.file_hash(path + "/input/" + layer)
+    return cache.key(url, fetch.version(url))
+
+
+def _plan_run(out_dir, tables, settings, inputs):
+    
+    # the manifest in out_dir records the settings and grid of the last run,
+    # the tables it left up to date and the input, outputs, table features and
+    # provenance of each of its layers; layers with a new input are redone,
+    # outputs of layers that are gone are removed, and a run with other
+    # settings starts over. A table that is up to date is patched, any other
+    # one is rebuilt from all layers (patch None), and tables that are not
+    # asked for are removed, since they would fall behind the outputs
+    try:
+        with open(out_dir + "/manifest.json") as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    same = manifest.get('settings') == settings
+    
+    kept = {}
+    dropped = []
+    for name, entry in manifest.get('layers', {}).items():
+        if same and inputs.get(name) == entry['input']:
+            kept[name] = entry
+        else:
+            dropped.extend(entry['features'])
+            for i in entry['artifacts']:
+                if os.path.exists(out_dir + "/" + i): os.remove(out_dir + "/" + i)
+    
+    current = manifest.get('tables', []) if same else []
+    patches = {}
+    for i in tables:
+        patches[i] = set(dropped) if os.path.basename(i) in current and os.path.exists(i) else None
+    for i in current:
+        if out_dir + "/" + i not in tables and os.path.exists(out_dir + "/" + i):
+            os.remove(out_dir + "/" + i)
+    
+    changed = [i for i in inputs if i not in kept]
+    return {'settings': settings, 'tables': [os.path.basename(i) for i in tables], 'layers': kept}, changed, patches
+
+
+def _save_manifest(out_dir, manifest):
+    
+    with open(out_dir + "/manifest.json.tmp", 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(out_dir + "/manifest.json.tmp", out_dir + "/manifest.json")
+
+
+def _layer_entry(out_dir, input_hash, url, artifacts, doc):
+    
+    features = []
+    for i in artifacts:
+        features.extend(feature for band, feature in _raster_features(out_dir + "/" + i))
+    return {'input': input_hash, 'url': url, 'artifacts': artifacts, 'features': features,
+            'prov': doc.serialize()}
+
+
+def _coverage_artifacts(out_dir, name, engine, names):
+    
+    # the native engine writes one multi-band raster per layer, SAGA one
+    # raster per class; files of other layers whose names start the same
+    # way (soil and soil_cover) are not this layer's
+    if engine == "native":
+        return [name + "_cov.tif"] if os.path.exists(out_dir + "/" + name + "_cov.tif") else []
+    others = tuple(i + "_cov_" for i in names if i != name and i.startswith(name))
+    return sorted(os.path.basename(i) for i in glob.glob(glob.escape(out_dir + "/" + name + "_cov_") + "*.tif")
+                  if not os.path.basename(i).startswith(others))
+
+
+def coverages(layers, projection, path, max_workers=None, engine="saga", table_format="csv"):
+    
+    if engine not in ("saga", "native"):
+        raise ValueError("Unknown coverage engine " + engine)
+    _table_formats(table_format)
+    
+    doc = ProvDocument()
+    
+    doc.add_namespace('cat', 'https://schemas.isotc211.org/19139/-/cat/1.2')
+    doc.add_namespace('gex', 'https://schemas.isotc211.org/19115/-1/gex/1.3')
+    doc.add_namespace('msr', 'https://schemas.isotc211.org/19115/-1/msr/1.3/')
+    doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
+    doc.set_default_namespace("")
+    
+    # SAGA is only asked for its version when it does the work
+    if engine == "saga":
+        saga = doc.agent("saga_cmd", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', _tool_version(saga_cmd))))
+    rio = doc.agent("rasterio", (
         (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-        ('cit:edition', os.popen('ogrinfo --version').read().splitlines()[0])))
+        ('cit:edition', 'rasterio ' + rasterio.__version__ + ', GDAL ' + rasterio.__gdal_version__)))
+    
+    if engine == "native":
+        gpd_agent = doc.agent("geopandas", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', 'geopandas ' + gpd.__version__ + ', shapely ' + shapely.__version__)))
     
     if not os.path.exists(os.path.join(path,'output/coverages')): os.makedirs(os.path.join(path,'output/coverages'))
     
@@ -132,147 +1336,102 @@ def coverages(layers, projection, path):
         layer_lst.append(i[0])
         layer_urls.append(i[1])
     
-    download_layers(layer_lst, layer_urls, path)
+    download_layers(layer_lst, layer_urls, path, max_workers)
     
-    t = tqdm(range(len(layer_lst)))
+    out_dir = path + "/output/coverages"
+    tables = [out_dir + "/cov_table." + i for i in _table_formats(table_format)]
+    inputs = {layer_names[i]: _input_hash(path, layer_lst[i], layer_urls[i]) for i in range(len(layer_lst))}
+    manifest, changed, patches = _plan_run(out_dir, tables, {'projection': projection, 'engine': engine,
+        'grid': cache.file_hash(path + "/output/grid/grid.tif")}, inputs)
+    layer_docs = {i: _layer_doc() for i in changed}
     
-    for i in t:
-        if layer_lst[i].endswith(".tif") == False:
-            
-            lyr = gpd.read_file(path + "/input/" + layer_lst[i])
-            lyr_ent = doc.entity(layer_lst[i], (
-                (prov.model.PROV_TYPE, lyr.type[0]),
-                ('cat:CT_CRS', str(lyr.crs.to_proj4())),
-                ('gex:EX_GeographicBoundingBox', str(lyr.total_bounds)),
-                ('cit:CI_OnlineResource', layer_urls[i])))
-            proj_ent = doc.entity('projection', (
-                (prov.model.PROV_TYPE, 'proj4string'),
-                (prov.model.PROV_VALUE, str(projection))))
-
-            proj_shp_act = doc.activity('pj_proj4_2_' + str(time()))
-            proj_shp_act.set_time(startTime=datetime.now())
-            t.set_description("Reprojecting "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " -f=p pj_proj4 2 -CRS_PROJ4 "+ projection
-            + " -SOURCE " + path + "/input/" + layer_lst[i]
-            + " -TARGET " + path + "/analysis/" + layer_names[i] + "_cov_reproj.gpkg -PARALLEL 1")
-
-            doc.wasGeneratedBy(doc.entity(layer_names[i]+'_cov_reproj.gpkg'), proj_shp_act)
-            doc.used(proj_shp_act, lyr_ent)
-            doc.used(proj_shp_act, proj_ent)
-            doc.wasAssociatedWith(proj_shp_act, saga)
-            proj_shp_act.set_time(endTime=datetime.now())
-
-            rstr_act = doc.activity('grid_gridding_0_' + str(time()))
-            rstr_act.set_time(startTime=datetime.now())
-            t.set_description("Rasterizing "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " grid_gridding 0 -INPUT " + path + "/analysis/" + layer_names[i] + "_cov_reproj.gpkg"
-            + " -GRID " + path + "/analysis/" + layer_names[i] + "_cov_raster.tif -TARGET_USER_SIZE 100")
-
-            doc.wasGeneratedBy(doc.entity(layer_names[i]+'_cov_raster.tif'), rstr_act)
-            doc.used(rstr_act, doc.entity(layer_names[i]+'_cov_reproj.gpkg'))
-            doc.wasAssociatedWith(rstr_act, saga)
-            rstr_act.set_time(endTime=datetime.now())
-
+    lock = threading.Lock()
+    
+    # the native engine intersects vector layers with the grid cells directly
+    # instead of burning them to a 100 m raster first
+    jobs = []
+    vector_jobs = []
+    for i in range(len(layer_lst)):
+        if layer_names[i] not in changed:
+            continue
+        if engine == "native" and not layer_lst[i].endswith(".tif"):
+            vector_jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, gpd_agent, layer_lst[i], layer_urls[i], projection, path)))
+        elif engine == "native":
+            jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, rio, layer_lst[i], layer_urls[i], projection, path, 'cov')))
         else:
-            
-            lyr = rasterio.open(path + "/input/" + layer_lst[i])
-            lyr_ent = doc.entity(layer_lst[i], (
-                (prov.model.PROV_TYPE, lyr.meta['driver']),
-                ('cat:CT_CRS', str(lyr.crs.to_proj4())),
-                ('gex:EX_GeographicBoundingBox', str(list(lyr.bounds[0:4]))),
-                ('msr:resolution', lyr.meta['transform'][0]),
-                ('cit:CI_OnlineResource', layer_urls[i])))
-            proj_ent = doc.entity('projection', (
-                (prov.model.PROV_TYPE, 'proj4string'),
-                (prov.model.PROV_VALUE, str(projection))))
-
-            proj_rstr_act = doc.activity('pj_proj4_4_' + str(time()))
-            proj_rstr_act.set_time(startTime=datetime.now())
-            t.set_description("Reprojecting "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " pj_proj4 4 -CRS_PROJ4 "+ projection
-            + " -SOURCE " + path + "/input/" + layer_lst[i]
-            + " -GRID " + path + "/analysis/" + layer_names[i] + "_cov_raster.tif -RESAMPLING 0")
-
-            doc.wasGeneratedBy(layer_names[i]+'_cov_raster.tif', proj_rstr_act)
-            doc.used(proj_rstr_act, lyr_ent)
-            doc.used(proj_rstr_act, proj_ent)
-            doc.wasAssociatedWith(proj_rstr_act, saga)
-            proj_rstr_act.set_time(endTime=datetime.now())
-            
+            jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, saga, layer_lst[i], layer_urls[i], projection, path, 'cov')))
+    _map_layers(_virtual_layer if engine == "native" else _harmonize_layer, jobs, "Harmonized ", max_workers, path)
+    if vector_jobs:
+        _map_layers(_vector_coverage, vector_jobs, "Calculated coverages of ", max_workers, path)
+    
+    # the native engine reads rasters through warped VRTs instead of
+    # reprojected copies; layers shared with other functions have no suffix
+    raster_ext = "_raster.vrt" if engine == "native" else "_raster.tif"
     raster_lst = []
     raster_names = []
-    for i in os.listdir(path + "/analysis"):
-        if fnmatch.fnmatch(i, "*_cov_raster.tif"):
-            raster_lst.append(i)
-            raster_names.append(i.replace("_cov_raster.tif",""))
+    for i in range(len(layer_lst)):
+        raster = _stem(path, layer_lst[i], 'cov') + raster_ext
+        if layer_names[i] in changed and os.path.exists(path + "/analysis/" + raster):
+            raster_lst.append(raster)
+            raster_names.append(layer_names[i])
     
-    raster_lst.sort()
-    raster_names.sort()
+    jobs = []
+    for i in range(len(raster_lst)):
+        jobs.append((raster_names[i], (layer_docs[raster_names[i]], lock, rio if engine == "native" else saga, raster_lst[i], raster_names[i], path)))
+    _map_layers(_native_coverage if engine == "native" else _coverage_raster, jobs, "Calculated coverages of ", max_workers, path)
     
-    t = tqdm(range(len(raster_lst)))
-
-    for i in t:
-        
-        calc_cov_act = doc.activity('grid_analysis_26_' + str(time()))
-        calc_cov_act.set_time(startTime=datetime.now())
-        t.set_description("Calculating coverages of "+ raster_names[i], refresh=True)
-        os.system(saga_cmd
-        + " grid_analysis 26 -CLASSES " + path + "/analysis/" + raster_lst[i]
-        + " -COVERAGES " + path + "/output/coverages/" + raster_names[i] + "_cov_.tif"
-        + " -TARGET_DEFINITION 1 -TARGET_TEMPLATE " + path + "/output/grid/grid.tif -DATADEPTH 3")
-
-        doc.wasGeneratedBy(doc.entity(layer_names[i]+'_cov_.tif'), calc_cov_act)
-        doc.used(calc_cov_act, doc.entity(raster_lst[i]))
-        doc.used(calc_cov_act, doc.entity('grid.tif'))
-        doc.wasAssociatedWith(calc_cov_act, saga)
-        calc_cov_act.set_time(endTime=datetime.now())
-
-    class_lst = glob.glob(path + "/output/coverages/*cov*tif")
-
-    class_names = []
-    for i in class_lst:
-        name = os.path.basename(os.path.normpath(i))
-        class_names.append(os.path.splitext(name)[0])
-
-    df_total = pd.DataFrame(columns=[0,1,2])
-
-    t = tqdm(range(len(class_lst)))
+    cov_out = "_cov" if engine == "native" else "_cov_"
     
-    for i in t:
-        t.set_description("Building table for "+ class_names[i], refresh=True)
-        os.system("gdal_translate "+class_lst[i]+" " + path + "/analysis/"+class_names[i]+".xyz")
-        class_df = pd.read_csv(path + "/analysis/"+class_names[i]+".xyz", header=None, delimiter=" ")
-        class_sub = class_df[(class_df[2] != 0)]
-        class_sub['feature'] = class_names[i]
-        df_total = pd.concat([df_total, class_sub])
+    artifacts = {}
+    sources = []
+    for i in changed:
+        artifacts[i] = _coverage_artifacts(out_dir, i, engine, set(layer_names) | set(manifest['layers']))
+        sources.extend(_layer_sources(out_dir, artifacts[i]))
 
-    df_rename = df_total.rename(columns={0:'x',1:'y',2:'proportion'})
+    table_start = datetime.now()
+    files = []
+    for i in sorted(set(manifest['layers']) | set(changed)):
+        files.extend(artifacts[i] if i in artifacts else manifest['layers'][i]['artifacts'])
+    csv = out_dir + "/cov_table.csv"
+    if csv in patches and patches[csv] is None:
+        with metrics.step(path, 'cov_table.csv', None):
+            _write_table(_layer_sources(out_dir, files), path, csv, 'proportion')
+    elif csv in patches and (sources or patches[csv]):
+        with metrics.step(path, 'cov_table.csv', None):
+            _write_table(sources, path, csv, 'proportion', patch=patches[csv])
+    if out_dir + "/cov_table.parquet" in patches:
+        with metrics.step(path, 'cov_table.parquet', None):
+            _write_wide(_layer_sources(out_dir, files), path, out_dir + "/cov_table.parquet", sparse_tables)
+    table_end = datetime.now()
 
     
-    for i in layer_names:
-        trans_act = doc.activity('gdal_translate_' + str(time()))
-        trans_act.set_time(startTime=datetime.now())
-        doc.wasGeneratedBy(doc.entity(i+'_cov_.xyz'), trans_act)
-        doc.used(trans_act, doc.entity(i+"_cov_.tif"))
-        doc.wasAssociatedWith(trans_act, gdal)
-        trans_act.set_time(endTime=datetime.now())
+    for i in changed:
+        read_act = layer_docs[i].activity('rasterio_read_' + str(time()), table_start, table_end)
+        layer_docs[i].wasGeneratedBy(layer_docs[i].entity(i+cov_out+'.xyz'), read_act)
+        layer_docs[i].used(read_act, layer_docs[i].entity(i+cov_out+".tif"))
+        layer_docs[i].used(read_act, layer_docs[i].entity('grid_ID.tif'))
+        layer_docs[i].wasAssociatedWith(read_act, rio)
         
-    grid_df = pd.read_csv(path + "/output/grid/grid.csv")
-
-    merge_df = grid_df.merge(df_rename, on=['x','y']).drop(['x','y'], axis='columns')
-    merge_df.to_csv(path + "/output/coverages/cov_table.csv", index=False)
-
-    for i in layer_names:
-        doc.wasDerivedFrom(doc.entity('cov_table.csv'), doc.entity(i+'_cov_.xyz'))
+    for i in changed:
+        if table_format != "parquet":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('cov_table.csv'), layer_docs[i].entity(i+cov_out+'.xyz'))
+        if table_format != "csv":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('cov_table.parquet'), layer_docs[i].entity(i+cov_out+'.tif'))
+        manifest['layers'][i] = _layer_entry(out_dir, inputs[i], layer_urls[layer_names.index(i)], artifacts[i], layer_docs[i])
+    _save_manifest(out_dir, manifest)
+    
+    for i in sorted(manifest['layers']):
+        doc.update(ProvDocument.deserialize(content=manifest['layers'][i]['prov']))
      
     return doc
 
 
     
-def resample(layers, projection, path):
+def resample(layers, projection, path, max_workers=None, engine="saga", table_format="csv"):
+    
+    if engine not in ("saga", "native"):
+        raise ValueError("Unknown resample engine " + engine)
+    _table_formats(table_format)
     
     doc = ProvDocument()
     
@@ -282,12 +1441,13 @@ def resample(layers, projection, path):
     doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
     doc.set_default_namespace("")
     
-    saga = doc.agent("saga_cmd", (
+    if engine == "saga":
+        saga = doc.agent("saga_cmd", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', _tool_version(saga_cmd))))
+    rio = doc.agent("rasterio", (
     (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('saga_cmd --version').read().splitlines()[0])))
-    gdal = doc.agent("gdal", (
-    (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('ogrinfo --version').read().splitlines()[0])))
+    ('cit:edition', 'rasterio ' + rasterio.__version__ + ', GDAL ' + rasterio.__gdal_version__)))
     
     if not os.path.exists(os.path.join(path,'output/resample')): os.makedirs(os.path.join(path,'output/resample'))
     
@@ -300,147 +1460,167 @@ def resample(layers, projection, path):
         layer_lst.append(i[0])
         layer_urls.append(i[1])
     
-    download_layers(layer_lst, layer_urls, path)
+    download_layers(layer_lst, layer_urls, path, max_workers)
     
-    t = tqdm(range(len(layer_lst)))
+    out_dir = path + "/output/resample"
+    tables = [out_dir + "/rsmpl_table." + i for i in _table_formats(table_format)]
+    inputs = {layer_names[i]: _input_hash(path, layer_lst[i], layer_urls[i]) for i in range(len(layer_lst))}
+    manifest, changed, patches = _plan_run(out_dir, tables, {'projection': projection, 'engine': engine,
+        'grid': cache.file_hash(path + "/output/grid/grid.tif")}, inputs)
+    layer_docs = {i: _layer_doc() for i in changed}
     
-    for i in t:
-        if layer_lst[i].endswith(".tif") == False:
-            
-            lyr = gpd.read_file(path + "/input/" + layer_lst[i])
-            lyr_ent = doc.entity(layer_lst[i], (
-                (prov.model.PROV_TYPE, lyr.type[0]),
-                ('cat:CT_CRS', str(lyr.crs.to_proj4())),
-                ('gex:EX_GeographicBoundingBox', str(lyr.total_bounds)),
-                ('cit:CI_OnlineResource', layer_urls[i])))
-            proj_ent = doc.entity('projection', (
-                (prov.model.PROV_TYPE, 'proj4string'),
-                (prov.model.PROV_VALUE, str(projection))))
-
-            proj_shp_act = doc.activity('pj_proj4_2_' + str(time()))
-            proj_shp_act.set_time(startTime=datetime.now())
-            t.set_description("Reprojecting "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " -f=p pj_proj4 2 -CRS_PROJ4 "+ projection
-            + " -SOURCE " + path + "/input/" + layer_lst[i]
-            + " -TARGET " + path + "/analysis/" + layer_names[i] + "_rsmpl_reproj.gpkg -PARALLEL 1")
-
-            doc.wasGeneratedBy(doc.entity(layer_names[i]+'_rsmpl_reproj.gpkg'), proj_shp_act)
-            doc.used(proj_shp_act, lyr_ent)
-            doc.used(proj_shp_act, proj_ent)
-            doc.wasAssociatedWith(proj_shp_act, saga)
-            proj_shp_act.set_time(endTime=datetime.now())
-
-            rstr_act = doc.activity('grid_gridding_0_' + str(time()))
-            rstr_act.set_time(startTime=datetime.now())
-            t.set_description("Rasterizing "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " grid_gridding 0 -INPUT " + path + "/analysis/" + layer_names[i] + "_rsmpl_reproj.gpkg"
-            + " -GRID " + path + "/analysis/" + layer_names[i] + "_rsmpl_raster.tif -TARGET_USER_SIZE 100")
-
-            doc.wasGeneratedBy(doc.entity(layer_names[i]+'_rsmpl_raster.tif'), rstr_act)
-            doc.used(rstr_act, doc.entity(layer_names[i]+'_rsmpl_reproj.gpkg'))
-            doc.wasAssociatedWith(rstr_act, saga)
-            rstr_act.set_time(endTime=datetime.now())
-
+    lock = threading.Lock()
+    
+    # the native engine warps rasters through VRTs and resamples vector
+    # layers in memory, so neither leaves files in analysis
+    jobs = []
+    vector_jobs = []
+    for i in range(len(layer_lst)):
+        if layer_names[i] not in changed:
+            continue
+        if engine == "native" and not layer_lst[i].endswith(".tif"):
+            vector_jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, rio, layer_lst[i], layer_urls[i], projection, path)))
+        elif engine == "native":
+            jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, rio, layer_lst[i], layer_urls[i], projection, path, 'rsmpl')))
         else:
-            
-            lyr = rasterio.open(path + "/input/" + layer_lst[i])
-            lyr_ent = doc.entity(layer_lst[i], (
-                (prov.model.PROV_TYPE, lyr.meta['driver']),
-                ('cat:CT_CRS', str(lyr.crs.to_proj4())),
-                ('gex:EX_GeographicBoundingBox', str(list(lyr.bounds[0:4]))),
-                ('msr:resolution', lyr.meta['transform'][0]),
-                ('cit:CI_OnlineResource', layer_urls[i])))
-            proj_ent = doc.entity('projection', (
-                (prov.model.PROV_TYPE, 'proj4string'),
-                (prov.model.PROV_VALUE, str(projection))))
-
-            proj_rstr_act = doc.activity('pj_proj4_4_' + str(time()))
-            proj_rstr_act.set_time(startTime=datetime.now())
-            t.set_description("Reprojecting "+ layer_names[i], refresh=True)
-            os.system(saga_cmd
-            + " pj_proj4 4 -CRS_PROJ4 "+ projection
-            + " -SOURCE " + path + "/input/" + layer_lst[i]
-            + " -GRID " + path + "/analysis/" + layer_names[i] + "_rsmpl_raster.tif -RESAMPLING 0")
-
-            doc.wasGeneratedBy(layer_names[i]+'_rsmpl_raster.tif', proj_rstr_act)
-            doc.used(proj_rstr_act, lyr_ent)
-            doc.used(proj_rstr_act, proj_ent)
-            doc.wasAssociatedWith(proj_rstr_act, saga)
-            proj_rstr_act.set_time(endTime=datetime.now())
+            jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, saga, layer_lst[i], layer_urls[i], projection, path, 'rsmpl')))
+    _map_layers(_virtual_layer if engine == "native" else _harmonize_layer, jobs, "Harmonized ", max_workers, path)
+    if vector_jobs:
+        _map_layers(_native_vector_resample, vector_jobs, "Resampled to grid resolution: ", max_workers, path)
     
+    raster_ext = "_raster.vrt" if engine == "native" else "_raster.tif"
     raster_lst = []
     raster_names = []
-    for i in os.listdir(path + "/analysis"):
-        if fnmatch.fnmatch(i, "*_rsmpl_raster.tif"):
-            raster_lst.append(i)
-            raster_names.append(i.replace("_rsmpl_raster.tif",""))
-    
-    raster_lst.sort()
-    raster_names.sort()
-    
-    t = tqdm(range(len(raster_lst)))
-    
-    for i in t:
-        
-        rsmpl_act = doc.activity('grid_tools_0_' + str(time()))
-        rsmpl_act.set_time(startTime=datetime.now())
-        t.set_description("Resampling " + raster_names[i] + " to grid resolution")
-        os.system(saga_cmd + ' grid_tools 0 -INPUT ' + path + '/analysis/' + raster_lst[i] +
-                  ' -TARGET_TEMPLATE ' + path + '/output/grid/grid.tif' +
-                  ' -OUTPUT ' + path + '/output/resample/' + raster_names[i] + '_rsmpl.tif' +
-                  ' -TARGET_DEFINITION 1 -SCALE_UP 8 -SCALE_DOWN 0')
-        doc.wasGeneratedBy(doc.entity(layer_names[i]+'_rsmpl.tif'), rsmpl_act)
-        doc.used(rsmpl_act, doc.entity(raster_lst[i]))
-        doc.used(rsmpl_act, doc.entity('grid.tif'))
-        doc.wasAssociatedWith(rsmpl_act, saga)
-        rsmpl_act.set_time(endTime=datetime.now())
-        
-    class_lst = glob.glob(path + "/output/resample/*rsmpl*tif")
-
-    class_names = []
-    for i in class_lst:
-        name = os.path.basename(os.path.normpath(i))
-        class_names.append(os.path.splitext(name)[0])
-
-    df_total = pd.DataFrame(columns=[0,1,2])
+    for i in range(len(layer_lst)):
+        raster = _stem(path, layer_lst[i], 'rsmpl') + raster_ext
+        if layer_names[i] in changed and os.path.exists(path + "/analysis/" + raster):
+            raster_lst.append(raster)
+            raster_names.append(layer_names[i])
+    
+    jobs = []
+    for i in range(len(raster_lst)):
+        jobs.append((raster_names[i], (layer_docs[raster_names[i]], lock, rio if engine == "native" else saga, raster_lst[i], raster_names[i], path)))
+    _map_layers(_native_resample if engine == "native" else _resample_raster, jobs, "Resampled to grid resolution: ", max_workers, path)
+    
+    artifacts = {}
+    sources = []
+    for i in changed:
+        artifacts[i] = [i + "_rsmpl.tif"] if os.path.exists(out_dir + "/" + i + "_rsmpl.tif") else []
+        sources.extend(_layer_sources(out_dir, artifacts[i], True))
 
-    t = tqdm(range(len(class_lst)))
+    table_start = datetime.now()
+    files = []
+    for i in sorted(set(manifest['layers']) | set(changed)):
+        files.extend(artifacts[i] if i in artifacts else manifest['layers'][i]['artifacts'])
+    csv = out_dir + "/rsmpl_table.csv"
+    if csv in patches and patches[csv] is None:
+        with metrics.step(path, 'rsmpl_table.csv', None):
+            _write_table(_layer_sources(out_dir, files, True), path, csv)
+    elif csv in patches and (sources or patches[csv]):
+        with metrics.step(path, 'rsmpl_table.csv', None):
+            _write_table(sources, path, csv, patch=patches[csv])
+    if out_dir + "/rsmpl_table.parquet" in patches:
+        with metrics.step(path, 'rsmpl_table.parquet', None):
+            _write_wide(_layer_sources(out_dir, files, True), path, out_dir + "/rsmpl_table.parquet", sparse_tables)
+    table_end = datetime.now()
 
-    for i in t:
-        t.set_description("Building table for "+ class_names[i], refresh=True)
-        nodata = rasterio.open(class_lst[i]).nodata
-        os.system("gdal_translate "+class_lst[i]+ " " + path + "/analysis/"+class_names[i]+".xyz")
-        class_df = pd.read_csv(path + "/analysis/"+class_names[i]+".xyz", header=None, delimiter=" ")
-        class_sub = class_df[(class_df[2] != nodata)]
-        class_sub['feature'] = class_names[i]
-        df_total = pd.concat([df_total, class_sub])
 
-    df_rename = df_total.rename(columns={0:'x',1:'y',2:'value'})
+    for i in changed:
+        read_act = layer_docs[i].activity('rasterio_read_' + str(time()), table_start, table_end)
+        layer_docs[i].wasGeneratedBy(layer_docs[i].entity(i+'_rsmpl.xyz'), read_act)
+        layer_docs[i].used(read_act, layer_docs[i].entity(i+"_rsmpl.tif"))
+        layer_docs[i].used(read_act, layer_docs[i].entity('grid_ID.tif'))
+        layer_docs[i].wasAssociatedWith(read_act, rio)
 
+    for i in changed:
+        if table_format != "parquet":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('rsmpl_table.csv'), layer_docs[i].entity(i+'_rsmpl.xyz'))
+        if table_format != "csv":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('rsmpl_table.parquet'), layer_docs[i].entity(i+'_rsmpl.tif'))
+        manifest['layers'][i] = _layer_entry(out_dir, inputs[i], layer_urls[layer_names.index(i)], artifacts[i], layer_docs[i])
+    _save_manifest(out_dir, manifest)
+    
+    for i in sorted(manifest['layers']):
+        doc.update(ProvDocument.deserialize(content=manifest['layers'][i]['prov']))
+        
+    return doc
 
-    for i in layer_names:
-        trans_act = doc.activity('gdal_translate_' + str(time()))
-        trans_act.set_time(startTime=datetime.now())
-        doc.wasGeneratedBy(doc.entity(i+'_rsmpl.xyz'), trans_act)
-        doc.used(trans_act, doc.entity(i+"_rsmpl.tif"))
-        doc.wasAssociatedWith(trans_act, gdal)
-        trans_act.set_time(endTime=datetime.now())
 
-    grid_df = pd.read_csv(path + "/output/grid/grid.csv")
+        
+def _bin_points(points, projection, template, pa_out, count_out, rows=None, workers=1,
+                block_pixels=2**22, chunk_size=10**6):
+    
+    with rasterio.open(template) as grd:
+        profile = grd.profile
+        height, width = grd.shape
+        transform = grd.transform
+    layer_crs = pyogrio.read_info(points)['crs']
+    
+    def count(window):
+        
+        # each tile reads only the points around it, one chunk at a time, and
+        # counts them per cell straight from their reprojected coordinates
+        h = int(window.height)
+        left, bottom, right, top = rasterio.windows.bounds(Window(-1, window.row_off - 1, width + 2, h + 2), transform)
+        bbox = rasterio.warp.transform_bounds(projection, layer_crs, left, bottom, right, top)
+        counts = np.zeros(h * width, dtype=np.int64)
+        start = 0
+        while True:
+            lyr = gpd.read_file(points, bbox=bbox, rows=slice(start, start + chunk_size))
+            if len(lyr) == 0:
+                break
+            start += len(lyr)
+            xy = shapely.get_coordinates(lyr.geometry.values)
+            x, y = pyproj.Transformer.from_crs(lyr.crs, projection, always_xy=True).transform(xy[:, 0], xy[:, 1])
+            col, row = ~transform * (np.asarray(x), np.asarray(y))
+            col, row = np.floor(col), np.floor(row) - window.row_off
+            inside = (row >= 0) & (row < h) & (col >= 0) & (col < width)
+            counts += np.bincount(row[inside].astype(np.int64) * width + col[inside].astype(np.int64),
+                                  minlength=h * width)
+        return counts.reshape(h, width)
+    
+    profile.update(count=1, compress='deflate')
+    with rasterio.open(pa_out, 'w', **dict(profile, dtype='uint8', nodata=0)) as pa, \
+         rasterio.open(count_out, 'w', **dict(profile, dtype='uint32', nodata=None)) as cnt:
+        
+        def write(window, counts):
+            pa.write((counts > 0).astype('uint8'), 1, window=window)
+            cnt.write(counts.astype('uint32'), 1, window=window)
+        
+        _map_tiles(count, _tile_windows(height, width, rows or max(1, block_pixels // width)), write, workers)
+    return 0
 
-    merge_df = grid_df.merge(df_rename, on=['x','y']).drop(['x','y'], axis='columns')
-    merge_df.to_csv(path + "/output/resample/rsmpl_table.csv", index=False)
 
-    for i in layer_names:
-        doc.wasDerivedFrom(doc.entity('rsmpl_table.csv'), doc.entity(i+'_rsmpl.xyz'))
+def _native_pa_layer(doc, lock, rio, layer, url, projection, path):
+    
+    name = os.path.splitext(layer)[0]
+    pa_start = datetime.now()
+    with metrics.step(path, 'bin_points', name):
+        _cached(cache.key('bin_points', cache.file_hash(path + "/input/" + layer), projection,
+                          cache.file_hash(path + '/output/grid/grid.tif')),
+                path + '/output/presence_absence/' + name + '_', lambda: _bin_points(
+                    path + "/input/" + layer, projection, path + '/output/grid/grid.tif',
+                    path + '/output/presence_absence/' + name + '_pa.tif',
+                    path + '/output/presence_absence/' + name + '_count.tif', tile_rows, tile_workers), ['pa.tif', 'count.tif'])
+    pa_end = datetime.now()
+    
+    with lock:
+        lyr_ent, proj_ent = _layer_entity(doc, path, layer, url, projection)
         
-    return doc
+        pa_act = doc.activity('bin_points_' + str(time()), pa_start, pa_end)
+        doc.wasGeneratedBy(doc.entity(name + '_pa.tif'), pa_act)
+        doc.wasGeneratedBy(doc.entity(name + '_count.tif'), pa_act)
+        doc.used(pa_act, lyr_ent)
+        doc.used(pa_act, proj_ent)
+        doc.used(pa_act, doc.entity('grid.tif'))
+        doc.wasAssociatedWith(pa_act, rio)
 
 
-        
-def presence_absence(layers, projection, path):
+def presence_absence(layers, projection, path, max_workers=None, engine="saga", table_format="csv"):
+    
+    if engine not in ("saga", "native"):
+        raise ValueError("Unknown presence-absence engine " + engine)
+    _table_formats(table_format)
     
     doc = ProvDocument()
     
@@ -450,12 +1630,13 @@ def presence_absence(layers, projection, path):
     doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
     doc.set_default_namespace("")
     
-    saga = doc.agent("saga_cmd", (
+    if engine == "saga":
+        saga = doc.agent("saga_cmd", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', _tool_version(saga_cmd))))
+    rio = doc.agent("rasterio", (
     (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('saga_cmd --version').read().splitlines()[0])))
-    gdal = doc.agent("gdal", (
-    (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
-    ('cit:edition', os.popen('ogrinfo --version').read().splitlines()[0])))
+    ('cit:edition', 'rasterio ' + rasterio.__version__ + ', GDAL ' + rasterio.__gdal_version__)))
     
     if not os.path.exists(os.path.join(path,'output/presence_absence')): os.makedirs(os.path.join(path,'output/presence_absence'))
     
@@ -468,126 +1649,227 @@ def presence_absence(layers, projection, path):
         layer_lst.append(i[0])
         layer_urls.append(i[1])
     
-    download_layers(layer_lst, layer_urls, path)
+    download_layers(layer_lst, layer_urls, path, max_workers)
     
-    t = tqdm(range(len(layer_lst)))
+    out_dir = path + "/output/presence_absence"
+    tables = [out_dir + "/pa_table." + i for i in _table_formats(table_format)]
+    inputs = {layer_names[i]: _input_hash(path, layer_lst[i], layer_urls[i]) for i in range(len(layer_lst))}
+    manifest, changed, patches = _plan_run(out_dir, tables, {'projection': projection, 'engine': engine,
+        'grid': cache.file_hash(path + "/output/grid/grid.tif")}, inputs)
+    layer_docs = {i: _layer_doc() for i in changed}
     
-    for i in t:
-        
-        lyr = gpd.read_file(path + "/input/" + layer_lst[i])
-        lyr_ent = doc.entity(layer_lst[i], (
-            (prov.model.PROV_TYPE, lyr.type[0]),
-            ('cat:CT_CRS', str(lyr.crs.to_proj4())),
-            ('gex:EX_GeographicBoundingBox', str(lyr.total_bounds)),
-            ('cit:CI_OnlineResource', layer_urls[i])))
-        proj_ent = doc.entity('projection', (
-            (prov.model.PROV_TYPE, 'proj4string'),
-            (prov.model.PROV_VALUE, str(projection))))
+    lock = threading.Lock()
+    
+    jobs = []
+    for i in range(len(layer_lst)):
+        if layer_names[i] in changed:
+            jobs.append((layer_names[i], (layer_docs[layer_names[i]], lock, rio if engine == "native" else saga, layer_lst[i], layer_urls[i], projection, path)))
+    _map_layers(_native_pa_layer if engine == "native" else _pa_layer, jobs, "Calculated point presence-absence of ", max_workers, path)
 
-        proj_shp_act = doc.activity('pj_proj4_2_' + str(time()))
-        proj_shp_act.set_time(startTime=datetime.now())
-        t.set_description("Reprojecting "+ layer_names[i], refresh=True)
-        os.system(saga_cmd
-        + " -f=p pj_proj4 2 -CRS_PROJ4 "+ projection
-        + " -SOURCE " + path + "/input/" + layer_lst[i]
-        + " -TARGET " + path + "/analysis/" + layer_names[i] + "_pa_reproj.gpkg -PARALLEL 1")
+    artifacts = {}
+    sources = []
+    for i in changed:
+        artifacts[i] = [j for j in (i + "_count.tif", i + "_pa.tif") if os.path.exists(out_dir + "/" + j)]
+        sources.extend(_layer_sources(out_dir, artifacts[i]))
 
-        doc.wasGeneratedBy(doc.entity(layer_names[i]+'_pa_reproj.gpkg'), proj_shp_act)
-        doc.used(proj_shp_act, lyr_ent)
-        doc.used(proj_shp_act, proj_ent)
-        doc.wasAssociatedWith(proj_shp_act, saga)
-        proj_shp_act.set_time(endTime=datetime.now())
-        
-        pa_act = doc.activity('grid_gridding_0_' + str(time()))
-        pa_act.set_time(startTime=datetime.now())
-        t.set_description("Calculating "+ layer_names[i] + " point presence-absence", refresh=True)
-        os.system(saga_cmd
-                 + ' grid_gridding 0 -INPUT ' + path + '/analysis/' + layer_names[i] + '_pa_reproj.gpkg'
-                 + ' -TARGET_TEMPLATE ' + path + '/output/grid/grid.tif'
-                 + ' -GRID ' + path + '/output/presence_absence/' + layer_names[i] + '_pa.tif '
-                 + ' -COUNT ' + path + '/output/presence_absence/' + layer_names[i] + '_count.tif '
-                 + ' -OUTPUT 0' 
-                 + ' -TARGET_DEFINITION 1')
-        doc.wasGeneratedBy(doc.entity(layer_names[i]+'_pa.tif'), pa_act)
-        doc.wasGeneratedBy(doc.entity(layer_names[i]+'_count.tif'), pa_act)
-        doc.used(pa_act, doc.entity(layer_names[i]+'_pa_reproj.gpkg'))
-        doc.used(pa_act, doc.entity('grid.tif'))
-        doc.wasAssociatedWith(pa_act, saga)
-        pa_act.set_time(endTime=datetime.now())
+    table_start = datetime.now()
+    files = []
+    for i in sorted(set(manifest['layers']) | set(changed)):
+        files.extend(artifacts[i] if i in artifacts else manifest['layers'][i]['artifacts'])
+    csv = out_dir + "/pa_table.csv"
+    if csv in patches and patches[csv] is None:
+        with metrics.step(path, 'pa_table.csv', None):
+            _write_table(_layer_sources(out_dir, files), path, csv)
+    elif csv in patches and (sources or patches[csv]):
+        with metrics.step(path, 'pa_table.csv', None):
+            _write_table(sources, path, csv, patch=patches[csv])
+    if out_dir + "/pa_table.parquet" in patches:
+        with metrics.step(path, 'pa_table.parquet', None):
+            _write_wide(_layer_sources(out_dir, files), path, out_dir + "/pa_table.parquet", sparse_tables)
+    table_end = datetime.now()
 
-    class_lst = glob.glob(path + "/output/presence_absence/*tif")
 
-    class_names = []
-    for i in class_lst:
-        name = os.path.basename(os.path.normpath(i))
-        class_names.append(os.path.splitext(name)[0])
+    for i in changed:
+        read_act = layer_docs[i].activity('rasterio_read_' + str(time()), table_start, table_end)
+        layer_docs[i].wasGeneratedBy(layer_docs[i].entity(i+'_pa.xyz'), read_act)
+        layer_docs[i].used(read_act, layer_docs[i].entity(i+"_pa.tif"))
+        layer_docs[i].used(read_act, layer_docs[i].entity('grid_ID.tif'))
+        layer_docs[i].wasAssociatedWith(read_act, rio)
+        
+        read_act = layer_docs[i].activity('rasterio_read_' + str(time()), table_start, table_end)
+        layer_docs[i].wasGeneratedBy(layer_docs[i].entity(i+'_count.xyz'), read_act)
+        layer_docs[i].used(read_act, layer_docs[i].entity(i+"_count.tif"))
+        layer_docs[i].used(read_act, layer_docs[i].entity('grid_ID.tif'))
+        layer_docs[i].wasAssociatedWith(read_act, rio)
+        
+    for i in changed:
+        if table_format != "parquet":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('pa_table.csv'), layer_docs[i].entity(i+'_pa.xyz'))
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('pa_table.csv'), layer_docs[i].entity(i+'_count.xyz'))
+        if table_format != "csv":
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('pa_table.parquet'), layer_docs[i].entity(i+'_pa.tif'))
+            layer_docs[i].wasDerivedFrom(layer_docs[i].entity('pa_table.parquet'), layer_docs[i].entity(i+'_count.tif'))
+        manifest['layers'][i] = _layer_entry(out_dir, inputs[i], layer_urls[layer_names.index(i)], artifacts[i], layer_docs[i])
+    _save_manifest(out_dir, manifest)
+    
+    for i in sorted(manifest['layers']):
+        doc.update(ProvDocument.deserialize(content=manifest['layers'][i]['prov']))
+    
+    return doc
 
-    df_total = pd.DataFrame(columns=[0,1,2])
 
-    t = tqdm(range(len(class_lst)))
 
-    for i in t:
-        t.set_description("Building table for "+ class_names[i], refresh=True)
-        os.system("gdal_translate "+class_lst[i]+" " + path + "/analysis/"+class_names[i]+".xyz")
-        class_df = pd.read_csv(path + "/analysis/"+class_names[i]+".xyz", header=None, delimiter=" ")
-        class_sub = class_df[(class_df[2] != 0)]
-        class_sub['feature'] = class_names[i]
-        df_total = pd.concat([df_total, class_sub])
+def _stat_sources(path, selection):
+    
+    # every band of the outputs recorded in the manifests of the other
+    # functions; a selection keeps the ones whose function, layer, file or
+    # feature matches one of its names or patterns
+    sources = []
+    for func in ("coverages", "presence_absence", "resample"):
+        out_dir = path + "/output/" + func
+        try:
+            with open(out_dir + "/manifest.json") as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for name in sorted(manifest['layers']):
+            for i in manifest['layers'][name]['artifacts']:
+                for band, feature in _raster_features(out_dir + "/" + i):
+                    if not selection or any(j in (func, name, os.path.splitext(i)[0]) or os.path.splitext(j)[0] == name
+                                            or fnmatch.fnmatch(feature, j) for j in selection):
+                        sources.append((out_dir + "/" + i, band, feature))
+    return sources
 
-    df_rename = df_total.rename(columns={0:'x',1:'y',2:'value'})
+
+def _cell_statistics(sources, template, out, stats, rows=None, workers=1, block_pixels=2**22):
+    
+    with rasterio.open(template) as grd:
+        profile = grd.profile
+        height, width = grd.shape
+    for raster, band, feature in sources:
+        with rasterio.open(raster) as src:
+            if src.shape != (height, width):
+                raise ValueError(src.name + " is not aligned with grid.tif")
+    
+    # the bands are summed into running totals one at a time, so a tile holds
+    # a few arrays of its size however many bands there are
+    def compute(window):
+        h = int(window.height)
+        n = np.zeros((h, width))
+        total = np.zeros((h, width))
+        total2 = np.zeros((h, width))
+        low = np.full((h, width), np.inf)
+        high = np.full((h, width), -np.inf)
+        for raster, band, feature in sources:
+            with rasterio.open(raster) as src:
+                values = src.read(band, window=window)
+                valid = _valid(values, src.nodata)
+            values = np.where(valid, values, 0).astype('float64')
+            n += valid
+            total += values
+            total2 += values * values
+            low = np.minimum(low, np.where(valid, values, np.inf))
+            high = np.maximum(high, np.where(valid, values, -np.inf))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / n
+            var = np.maximum(total2 / n - mean * mean, 0)
+        values = {'data_cells': n, 'nodata_cells': len(sources) - n, 'mean': mean, 'min': low, 'max': high,
+                  'range': high - low, 'sum': total, 'sum2': total2, 'var': var, 'stddev': np.sqrt(var)}
+        empty = n == 0
+        return np.stack([values[i] if i.endswith('_cells') else np.where(empty, -99999, values[i])
+                         for i in stats]).astype('float32')
+    
+    profile.update(dtype='float32', count=len(stats), nodata=-99999, compress='deflate')
+    with rasterio.open(out, 'w', **profile) as dst:
+        for b in range(len(stats)):
+            dst.set_band_description(b + 1, stats[b])
+            dst.update_tags(b + 1, feature='stats_' + stats[b])
+        windows = _tile_windows(height, width, rows or max(1, block_pixels // width))
+        _map_tiles(compute, windows, lambda window, block: dst.write(block, window=window), workers)
+    return 0
 
 
-    for i in layer_names:
-        trans_act = doc.activity('gdal_translate_' + str(time()))
-        trans_act.set_time(startTime=datetime.now())
-        doc.wasGeneratedBy(doc.entity(i+'_pa.xyz'), trans_act)
-        doc.used(trans_act, doc.entity(i+"_pa.tif"))
-        doc.wasAssociatedWith(trans_act, gdal)
-        trans_act.set_time(endTime=datetime.now())
+def grid_statistics(layers, projection, path, max_workers=None, table_format="csv"):
+    
+    _table_formats(table_format)
+    unknown = set(cell_statistics) - {'data_cells', 'nodata_cells', 'mean', 'min', 'max', 'range', 'sum', 'sum2', 'var', 'stddev'}
+    if unknown:
+        raise ValueError("Unknown cell statistics " + ", ".join(sorted(unknown)))
+    
+    doc = ProvDocument()
+    
+    doc.add_namespace('cat', 'https://schemas.isotc211.org/19139/-/cat/1.2')
+    doc.add_namespace('gex', 'https://schemas.isotc211.org/19115/-1/gex/1.3')
+    doc.add_namespace('msr', 'https://schemas.isotc211.org/19115/-1/msr/1.3/')
+    doc.add_namespace('cit', 'https://schemas.isotc211.org/19115/-1/cit/1.3')
+    doc.set_default_namespace("")
+    
+    if not os.path.exists(os.path.join(path,'output/grid_statistics')): os.makedirs(os.path.join(path,'output/grid_statistics'))
+    
+    # the layers name the outputs to summarize (a function, a layer or a
+    # feature pattern), all outputs of the run when there are none
+    selection = sorted(i[0] for i in layers if i[0])
+    sources = _stat_sources(path, selection)
+    
+    out_dir = path + "/output/grid_statistics"
+    tables = [out_dir + "/stats_table." + i for i in _table_formats(table_format)]
+    inputs = {'stats': cache.key(*[(raster, band, cache.file_hash(raster)) for raster, band, feature in sources])} if sources else {}
+    manifest, changed, patches = _plan_run(out_dir, tables, {'grid': cache.file_hash(path + "/output/grid/grid.tif"),
+        'selection': selection, 'statistics': cell_statistics}, inputs)
+    # the statistics are a single output, so a table that is not up to date
+    # is written along with it again
+    if None in patches.values():
+        changed = list(inputs)
+    
+    if not sources:
+        print("No outputs to calculate grid statistics of")
+        for i in ("/stats_table.csv", "/stats_table.parquet"):
+            if os.path.exists(out_dir + i): os.remove(out_dir + i)
+    
+    for i in changed:
+        layer_doc = _layer_doc()
+        rio = layer_doc.agent("rasterio", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', 'rasterio ' + rasterio.__version__ + ', GDAL ' + rasterio.__gdal_version__)))
+        np_agent = layer_doc.agent("numpy", (
+            (prov.model.PROV_TYPE, 'prov:SoftwareAgent'),
+            ('cit:edition', 'numpy ' + np.__version__)))
         
-        trans_act = doc.activity('gdal_translate_' + str(time()))
-        trans_act.set_time(startTime=datetime.now())
-        doc.wasGeneratedBy(doc.entity(i+'_count.xyz'), trans_act)
-        doc.used(trans_act, doc.entity(i+"_count.tif"))
-        doc.wasAssociatedWith(trans_act, gdal)
-        trans_act.set_time(endTime=datetime.now())       
+        stats_start = datetime.now()
+        with metrics.step(path, 'cell_statistics', None):
+            _cell_statistics(sources, path + "/output/grid/grid.tif", out_dir + "/stats.tif", cell_statistics,
+                             tile_rows, max_workers or os.cpu_count())
+        stats_end = datetime.now()
         
-    grid_df = pd.read_csv(path + "/output/grid/grid.csv")
-
-    merge_df = grid_df.merge(df_rename, on=['x','y']).drop(['x','y'], axis='columns')
-    merge_df.to_csv(path + "/output/presence_absence/pa_table.csv", index=False)
-
-    for i in layer_names:
-        doc.wasDerivedFrom(doc.entity('pa_table.csv'), doc.entity(i+'_pa.xyz'))
-        doc.wasDerivedFrom(doc.entity('pa_table.csv'), doc.entity(i+'_count.xyz'))
+        stats_act = layer_doc.activity('cell_statistics_' + str(time()), stats_start, stats_end)
+        layer_doc.wasGeneratedBy(layer_doc.entity('stats.tif'), stats_act)
+        for j in sorted(set(os.path.basename(raster) for raster, band, feature in sources)):
+            layer_doc.used(stats_act, layer_doc.entity(j))
+        layer_doc.used(stats_act, layer_doc.entity('grid.tif'))
+        layer_doc.wasAssociatedWith(stats_act, np_agent)
+        
+        table_start = datetime.now()
+        if out_dir + "/stats_table.csv" in patches:
+            with metrics.step(path, 'stats_table.csv', None):
+                _write_table(_layer_sources(out_dir, ["stats.tif"], True), path, out_dir + "/stats_table.csv")
+        if out_dir + "/stats_table.parquet" in patches:
+            with metrics.step(path, 'stats_table.parquet', None):
+                _write_wide(_layer_sources(out_dir, ["stats.tif"], True), path, out_dir + "/stats_table.parquet", sparse_tables)
+        table_end = datetime.now()
+        
+        read_act = layer_doc.activity('rasterio_read_' + str(time()), table_start, table_end)
+        layer_doc.wasGeneratedBy(layer_doc.entity('stats.xyz'), read_act)
+        layer_doc.used(read_act, layer_doc.entity("stats.tif"))
+        layer_doc.used(read_act, layer_doc.entity('grid_ID.tif'))
+        layer_doc.wasAssociatedWith(read_act, rio)
+        if table_format != "parquet":
+            layer_doc.wasDerivedFrom(layer_doc.entity('stats_table.csv'), layer_doc.entity('stats.xyz'))
+        if table_format != "csv":
+            layer_doc.wasDerivedFrom(layer_doc.entity('stats_table.parquet'), layer_doc.entity('stats.tif'))
+        manifest['layers'][i] = _layer_entry(out_dir, inputs[i], None, ["stats.tif"], layer_doc)
+    _save_manifest(out_dir, manifest)
+    
+    for i in sorted(manifest['layers']):
+        doc.update(ProvDocument.deserialize(content=manifest['layers'][i]['prov']))
     
     return doc
-
-
-        
-def grid_statistics(params):
-    grid_lst = []
-    for i in os.listdir("output"):
-        if fnmatch.fnmatch(i, "*.tif"):
-            j = 'output/' + i
-            grid_lst.append(j)
-
-    grid_str = ";".join(grid_lst)
-    
-    os.system(saga_cmd 
-        + ' statistics_grid 13 -GRIDS output/' + grid_str
-        + ' -STATS table.csv' 
-        + ' -DATA_CELLS ' + params[0]
-        + ' -NODATA_CELLS ' + params[1]
-        + ' -CELLSIZE ' + params[2]
-        + ' -MEAN ' + params[3]
-        + ' -MIN ' + params[4]
-        + ' -MAX ' + params[5]
-        + ' -RANGE ' + params[6]
-        + ' -SUM ' + params[7]
-        + ' -SUM2 ' + params[8]
-        + ' -VAR ' + params[9]
-        + ' -STDDEV ' + params[10]
-        + ' -STDDEVLO ' + params[11]
-        + ' -STDDEVHI ' + params[12]
-        )
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""GEOGEAR run metrics: wall time, CPU, memory, I/O and exit status per step and layer.
+
+Every external tool call and every in-process stage of a product appends a
+record to ``output/metrics/steps.jsonl``. :func:`summarize` aggregates them per
+step and per layer into ``summary.json`` and a Prometheus textfile
+(``geogear.prom``), which the node exporter's textfile collector can pick up.
+
+External tools are measured exactly, from the resource usage of their own
+process. In-process stages report the whole process over their wall time, so
+stages that run side by side count each other's CPU and I/O. Peak RSS is the
+high-water mark of the process, and bytes are what reached the storage layer
+(the page cache absorbs the rest). Where the platform has no resource usage
+(Windows), only wall time, the CPU time of in-process stages and exit status
+are recorded, and the other values are null.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+from time import time, process_time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_lock = threading.Lock()
+
+
+class ToolError(RuntimeError):
+    """An external tool exited with a non-zero status."""
+
+
+def journal(path):
+    return path + '/output/metrics/steps.jsonl'
+
+
+def grid_journal(path):
+    return path + '/output/metrics/grid.jsonl'
+
+
+def start(path, grid=False):
+    """Start a new metrics journal in path: empty, or with grid, holding the records of making its grid."""
+
+    if not os.path.exists(path + '/output/metrics'): os.makedirs(path + '/output/metrics')
+    with _lock:
+        if grid and os.path.exists(grid_journal(path)):
+            shutil.copyfile(grid_journal(path), journal(path))
+        else:
+            open(journal(path), 'w').close()
+
+
+def save_grid(path):
+    """Keep the records of the grid just made in path for every analysis run on it."""
+
+    with _lock:
+        shutil.copyfile(journal(path), grid_journal(path))
+
+
+def record(path, step, layer, **values):
+    """Append one measurement to the journal of path."""
+
+    line = json.dumps(dict({'step': step, 'layer': layer}, **values))
+    with _lock:
+        if not os.path.exists(path + '/output/metrics'): os.makedirs(path + '/output/metrics')
+        with open(journal(path), 'a') as f:
+            f.write(line + "\n")
+
+
+def _storage_io():
+    # bytes this process had read from and written to storage so far
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        if resource is None:
+            return None, None
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def _peak_rss(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if usage is None:
+        return None
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _change(before, after):
+    return None if before is None else after - before
+
+
+@contextmanager
+def step(path, name, layer=None):
+    """Measure the block as step name of layer in the product at path."""
+
+    started, cpu = time(), process_time()
+    read, written = _storage_io()
+    status = 0
+    try:
+        yield
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        now_read, now_written = _storage_io()
+        record(path, name, layer, start=started, wall=time() - started, cpu=process_time() - cpu,
+               peak_rss=_peak_rss(resource and resource.getrusage(resource.RUSAGE_SELF)),
+               read_bytes=_change(read, now_read), write_bytes=_change(written, now_written), status=status, tool=False)
+
+
+def run(path, name, layer, cmd, check=True):
+    """Run a shell command like os.system, measure it as step name of layer and return its exit status.
+
+    With check, a non-zero status raises ToolError with the end of the command's stderr.
+    """
+
+    started = time()
+    with tempfile.TemporaryFile() as err:
+        process = subprocess.Popen(cmd, shell=True, stderr=err)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = status = os.waitstatus_to_exitcode(status)
+        else:
+            # no resource usage of a single child on this platform
+            status, usage = process.wait(), None
+        err.seek(max(0, err.seek(0, os.SEEK_END) - 2000))
+        tail = err.read().decode(errors='replace')
+
+    record(path, name, layer, start=started, wall=time() - started,
+           cpu=usage and usage.ru_utime + usage.ru_stime, peak_rss=_peak_rss(usage),
+           read_bytes=usage and usage.ru_inblock * 512, write_bytes=usage and usage.ru_oublock * 512,
+           status=status, tool=cmd.split()[0])
+    if check and status != 0:
+        raise ToolError("%s (%s) exited with status %d: %s" % (name, layer or path, status, tail.strip()[-500:]))
+    return status
+
+
+def records(path):
+    """Return the measurements in the journal of path."""
+
+    if not os.path.exists(journal(path)):
+        return []
+    with open(journal(path)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _total(group, key, how=sum):
+    # values the platform could not measure are null and left out
+    values = [i[key] for i in group if i.get(key) is not None]
+    return how(values) if values else None
+
+
+def _totals(group):
+    return {'count': len(group), 'wall': sum(i['wall'] for i in group), 'cpu': _total(group, 'cpu'),
+            'peak_rss': _total(group, 'peak_rss', max), 'read_bytes': _total(group, 'read_bytes'),
+            'write_bytes': _total(group, 'write_bytes'),
+            'failed': sum(1 for i in group if i['status'] != 0)}
+
+
+def summarize(path, top=10):
+    """Write summary.json and geogear.prom for the journal of path and return the summary."""
+
+    steps = records(path)
+    by = {'step': {}, 'layer': {}, 'step_layer': {}}
+    for i in steps:
+        by['step'].setdefault(i['step'], []).append(i)
+        by['layer'].setdefault(i['layer'] or '', []).append(i)
+        by['step_layer'].setdefault((i['step'], i['layer'] or ''), []).append(i)
+
+    summary = {'path': path, 'created': time(), 'records': len(steps),
+               'wall': (max(i['start'] + i['wall'] for i in steps) - min(i['start'] for i in steps)) if steps else 0,
+               'by_step': {k: _totals(v) for k, v in sorted(by['step'].items())},
+               'by_layer': {k: _totals(v) for k, v in sorted(by['layer'].items())},
+               'slowest': sorted(steps, key=lambda i: -i['wall'])[:top]}
+
+    with open(path + '/output/metrics/summary.json.tmp', 'w') as f:
+        json.dump(summary, f, indent=1)
+    os.replace(path + '/output/metrics/summary.json.tmp', path + '/output/metrics/summary.json')
+
+    product = os.path.basename(os.path.abspath(path)).replace('\\', '\\\\').replace('"', '\\"')
+    lines = []
+    for metric, key, text in [('seconds', 'wall', 'Wall time'), ('cpu_seconds', 'cpu', 'CPU time'),
+                              ('peak_rss_bytes', 'peak_rss', 'Peak resident memory'),
+                              ('read_bytes', 'read_bytes', 'Bytes read from storage'),
+                              ('write_bytes', 'write_bytes', 'Bytes written to storage'),
+                              ('failures', 'failed', 'Calls that exited with an error'),
+                              ('calls', 'count', 'Number of calls')]:
+        lines.append('# HELP geogear_step_%s %s per step and layer' % (metric, text))
+        lines.append('# TYPE geogear_step_%s gauge' % metric)
+        for (name, layer), group in sorted(by['step_layer'].items()):
+            labels = 'product="%s",step="%s",layer="%s"' % (product, name, layer.replace('"', '\\"'))
+            value = _totals(group)[key]
+            if value is not None:
+                lines.append('geogear_step_%s{%s} %s' % (metric, labels, repr(float(value))))
+    lines.append('# HELP geogear_run_seconds Wall time from the first to the last step')
+    lines.append('# TYPE geogear_run_seconds gauge')
+    lines.append('geogear_run_seconds{product="%s"} %s' % (product, repr(float(summary['wall']))))
+
+    with open(path + '/output/metrics/geogear.prom.tmp', 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + '/output/metrics/geogear.prom.tmp', path + '/output/metrics/geogear.prom')
+    return summary
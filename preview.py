@@ -0,0 +1,222 @@
+"""GEOGEAR grid preview: memoized grids drawn as an image, with cell lines once zoomed in.
+
+:func:`grid` builds a grid like ``functions.grid`` but remembers it per mask,
+projection, cell size and engine: an unchanged grid in the same path is
+reused as is, and a grid made before is restored from the cache. A grid is
+only made when one of these settings changes.
+
+:class:`GridPreview` draws ``grid.tif`` on a matplotlib axis without turning
+it into polygons. The data cells are shown as an image from a pyramid of
+halved resolutions. On every zoom or pan it picks the level that matches the
+pixels on screen. Cell outlines are drawn once at most ``line_cells`` cells
+fit across the view. Both the number of pixels and the number of lines stay
+bounded, so grids with millions of cells stay interactive.
+"""
+
+import os
+import hashlib
+import threading
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from prov.model import ProvDocument
+from geogear import cache, functions, metrics
+
+line_cells = 150
+min_level_size = 256
+
+_lock = threading.Lock()
+_grids = {}
+_pyramids = {}
+
+
+def _mask_hash(mask):
+    sha = hashlib.sha256(mask.crs.to_wkt().encode())
+    for geometry in mask.geometry:
+        if geometry is not None:
+            sha.update(geometry.wkb)
+    return sha.hexdigest()
+
+
+def grid(mask, cellsize, path, engine="saga", table_format="csv"):
+    """Make the grid of mask at cellsize in path, or reuse it; returns its provenance document."""
+
+    settings = [_mask_hash(mask), float(cellsize), engine, table_format]
+    if engine == "saga":
+        settings.append(functions._tool_version(functions.saga_cmd))
+    k = cache.key('grid', *settings)
+    members = ['analysis/grid_prov.json', 'input/mask.gpkg'] + [
+        'output/grid/' + i for i in ['grid.tif', 'grid_ID.tif'] + functions._grid_tables(engine, table_format)]
+
+    with cache.lock(k):
+        # the grid in path is still the one made for these settings
+        with _lock:
+            made = _grids.get(os.path.abspath(path))
+        if made and made[0] == k and os.path.exists(path + '/output/grid/grid.tif') and \
+                made[1] == _stamp(path + '/output/grid/grid.tif'):
+            metrics.start(path)
+            return ProvDocument.deserialize(content=made[2])
+
+        if cache.enabled and cache.restore(k, path + '/'):
+            metrics.start(path)
+            metrics.save_grid(path)
+            with open(path + '/analysis/grid_prov.json') as f:
+                grd_json = f.read()
+        else:
+            grd_json = functions.grid(mask, cellsize, path, engine, table_format).serialize()
+            with open(path + '/analysis/grid_prov.json', 'w') as f:
+                f.write(grd_json)
+            if cache.enabled:
+                cache.save(k, path + '/', [path + '/' + i for i in members])
+
+        with _lock:
+            _grids[os.path.abspath(path)] = (k, _stamp(path + '/output/grid/grid.tif'), grd_json)
+    return ProvDocument.deserialize(content=grd_json)
+
+
+def _stamp(raster):
+    stat = os.stat(raster)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def pyramid(raster, rows=4096):
+    """Return the data cells of raster as boolean arrays, halved in resolution from level to level."""
+
+    k = (os.path.abspath(raster),) + _stamp(raster)
+    with _lock:
+        if k in _pyramids:
+            return _pyramids[k]
+
+    with rasterio.open(raster) as src:
+        cells = np.zeros((src.height, src.width), dtype=bool)
+        for row in range(0, src.height, rows):
+            window = Window(0, row, src.width, min(rows, src.height - row))
+            cells[row:row + rows] = (src.read_masks(1, window=window) > 0) & (src.read(1, window=window) != 0)
+        transform = src.transform
+
+    # a cell of the next level holds data when any of its four cells does
+    levels = [cells]
+    while max(levels[-1].shape) > min_level_size:
+        last = levels[-1]
+        last = np.pad(last, ((0, last.shape[0] % 2), (0, last.shape[1] % 2)))
+        levels.append(last.reshape(last.shape[0] // 2, 2, last.shape[1] // 2, 2).any(axis=(1, 3)))
+
+    with _lock:
+        _pyramids.clear()
+        _pyramids[k] = (levels, transform)
+    return _pyramids[k]
+
+
+def _outlines(cells, row, col, transform):
+    # segments along the cell edges that border at least one data cell;
+    # cells holds the view plus one cell of margin on every side
+    x = transform.c + (col + np.arange(cells.shape[1])) * transform.a
+    y = transform.f + (row + np.arange(cells.shape[0])) * transform.e
+    segments = []
+    # vertical edges between column j - 1 and j
+    i, j = np.nonzero(cells[1:-1, :-1] | cells[1:-1, 1:])
+    segments.append(np.stack([np.stack([x[j + 1], y[i + 1]], -1), np.stack([x[j + 1], y[i + 2]], -1)], 1))
+    # horizontal edges between row i - 1 and i
+    i, j = np.nonzero(cells[:-1, 1:-1] | cells[1:, 1:-1])
+    segments.append(np.stack([np.stack([x[j + 1], y[i + 1]], -1), np.stack([x[j + 2], y[i + 1]], -1)], 1))
+    return np.concatenate(segments)
+
+
+def _margin(cells, row0, row1, col0, col1):
+    # the window with one more cell on every side, empty outside the grid
+    height, width = cells.shape
+    window = np.zeros((row1 - row0 + 2, col1 - col0 + 2), dtype=bool)
+    top, left = max(row0 - 1, 0), max(col0 - 1, 0)
+    block = cells[top:min(row1 + 1, height), left:min(col1 + 1, width)]
+    window[top - row0 + 1:top - row0 + 1 + block.shape[0], left - col0 + 1:left - col0 + 1 + block.shape[1]] = block
+    return window
+
+
+class GridPreview:
+    """Draw the grid of path on ax and keep redrawing it as the view changes."""
+
+    def __init__(self, ax, path, color="black", alpha=0.3, linewidth=0.5):
+
+        from matplotlib.collections import LineCollection
+        from matplotlib.colors import ListedColormap
+
+        self.ax = ax
+        # the view spans the grid and whatever was drawn on ax before, the mask
+        had_data, xlim, ylim = ax.has_data(), ax.get_xlim(), ax.get_ylim()
+        self.levels, self.transform = pyramid(path + '/output/grid/grid.tif')
+        height, width = self.levels[0].shape
+        self.bounds = (self.transform.c, self.transform.f + height * self.transform.e,
+                       self.transform.c + width * self.transform.a, self.transform.f)
+
+        self.image = ax.imshow(np.ma.masked_all((1, 1)), cmap=ListedColormap([color]), vmin=0, vmax=1,
+                               alpha=alpha, interpolation='nearest', extent=(0, 1, 0, 1), zorder=2)
+        self.lines = LineCollection([], colors=color, linewidths=linewidth, zorder=3)
+        ax.add_collection(self.lines, autolim=False)
+        if had_data:
+            ax.set_xlim(min(xlim[0], self.bounds[0]), max(xlim[1], self.bounds[2]))
+            ax.set_ylim(min(ylim[0], self.bounds[1]), max(ylim[1], self.bounds[3]))
+        else:
+            ax.set_xlim(self.bounds[0], self.bounds[2])
+            ax.set_ylim(self.bounds[1], self.bounds[3])
+        ax.set_autoscale_on(False)
+
+        self._view = None
+        self._callbacks = [ax.callbacks.connect('xlim_changed', self.update),
+                           ax.callbacks.connect('ylim_changed', self.update)]
+        self.update()
+
+    def _window(self):
+        # the cells in view, as [row0, row1) and [col0, col1) of level 0
+        (xmin, xmax), (ymin, ymax) = sorted(self.ax.get_xlim()), sorted(self.ax.get_ylim())
+        height, width = self.levels[0].shape
+        col0 = int(np.clip(np.floor((xmin - self.transform.c) / self.transform.a), 0, width))
+        col1 = int(np.clip(np.ceil((xmax - self.transform.c) / self.transform.a), 0, width))
+        row0 = int(np.clip(np.floor((ymax - self.transform.f) / self.transform.e), 0, height))
+        row1 = int(np.clip(np.ceil((ymin - self.transform.f) / self.transform.e), 0, height))
+        return row0, row1, col0, col1
+
+    def update(self, ax=None):
+        """Redraw the image and cell lines for the current view."""
+
+        row0, row1, col0, col1 = self._window()
+        # the box of an equal-aspect axis shrinks and grows with the view,
+        # the space it was given on the figure does not
+        box = self.ax.get_position(original=True).transformed(self.ax.figure.transFigure)
+        pixels = max(box.width, box.height, 1)
+        level = 0
+        while level + 1 < len(self.levels) and max(col1 - col0, row1 - row0) >> level > pixels:
+            level += 1
+        view = (row0, row1, col0, col1, level)
+        if view == self._view:
+            return
+        self._view = view
+
+        # the image covers the view in whole cells of its level
+        r0, c0 = row0 >> level, col0 >> level
+        r1, c1 = -(-row1 // 2**level), -(-col1 // 2**level)
+        cells = self.levels[level][r0:r1, c0:c1]
+        if cells.size == 0:
+            self.image.set_visible(False)
+        else:
+            self.image.set_visible(True)
+            self.image.set_data(np.ma.masked_equal(cells.astype('uint8'), 0))
+            size = 2**level
+            self.image.set_extent((self.transform.c + c0 * size * self.transform.a,
+                                   self.transform.c + c1 * size * self.transform.a,
+                                   self.transform.f + r1 * size * self.transform.e,
+                                   self.transform.f + r0 * size * self.transform.e))
+
+        if 0 < col1 - col0 <= line_cells and 0 < row1 - row0 <= line_cells:
+            cells = _margin(self.levels[0], row0, row1, col0, col1)
+            self.lines.set_segments(_outlines(cells, row0 - 1, col0 - 1, self.transform))
+        else:
+            self.lines.set_segments([])
+        self.ax.figure.canvas.draw_idle()
+
+    def remove(self):
+        """Stop following the view and take the grid off the axis."""
+
+        for i in self._callbacks:
+            self.ax.callbacks.disconnect(i)
+        self.image.remove()
+        self.lines.remove()
@@ -0,0 +1,86 @@
+"""GEOGEAR provenance journal: records are appended as steps finish and rendered on demand."""
+
+import os
+import re
+import json
+import threading
+from time import time
+from concurrent import futures
+from prov.dot import prov_to_dot
+from prov.model import ProvDocument
+
+_lock = threading.Lock()
+_renderer = futures.ThreadPoolExecutor(1)
+
+
+def journal(path):
+    return path + '/output/provenance/journal.jsonl'
+
+
+def start(path):
+    """Start an empty journal for a new run in path."""
+
+    if not os.path.exists(path + '/output/provenance'): os.makedirs(path + '/output/provenance')
+    with _lock:
+        open(journal(path), 'w').close()
+
+
+def append(path, step, doc):
+    """Append the provenance document (or its PROV-JSON) of a finished step to the journal."""
+
+    line = json.dumps({'step': step, 'time': time(), 'prov': doc if isinstance(doc, str) else doc.serialize()})
+    with _lock:
+        with open(journal(path), 'a') as f:
+            f.write(line + "\n")
+
+
+def document(path):
+    """Build one provenance document from every step in the journal."""
+
+    doc = ProvDocument()
+    with open(journal(path)) as f:
+        for line in f:
+            if line.strip():
+                doc.update(ProvDocument.deserialize(content=json.loads(line)['prov']))
+    return doc
+
+
+def timings(doc):
+    """Return the seconds spent per step, summed over the activities of doc."""
+
+    # steps are the activity names without their timestamp suffix
+    steps = {}
+    for record in doc.get_records():
+        if record.get_type().localpart == 'Activity' and record.get_startTime() and record.get_endTime():
+            name = re.sub(r'_[0-9.]+$', '', record.identifier.localpart)
+            seconds = (record.get_endTime() - record.get_startTime()).total_seconds()
+            steps[name] = steps.get(name, 0) + seconds
+    return steps
+
+
+def render(path, formats):
+    """Write the journal of path in the given formats (PNG, PDF, JSON, XML, RDF) and return the document."""
+
+    doc = document(path)
+
+    for i in list(formats):
+        if i in ["PNG","PDF"]:
+            dot = prov_to_dot(doc, direction="BT")
+            if i == "PNG":
+                dot.write(path + '/output/provenance/GEOGEAR-prov.png', format='png')
+            else:
+                dot.write_pdf(path + '/output/provenance/GEOGEAR-prov.pdf', )
+        elif i == "JSON":
+             doc.serialize(path + '/output/provenance/GEOGEAR-prov.json')
+        elif i == "XML":
+            doc.serialize(path + '/output/provenance/GEOGEAR-prov.xml', format='xml')
+        elif i == "RDF":
+            doc.serialize(path + '/output/provenance/GEOGEAR-prov.ttl', format='rdf', rdf_format='ttl')
+
+    return doc
+
+
+def render_later(path, formats):
+    """Render on a background worker; returns a future of the document."""
+
+    return _renderer.submit(render, path, list(formats))
@@ -0,0 +1,390 @@
+"""GEOGEAR job service: analyses queued on localhost and run in worker processes.
+
+Start it with ``python -m geogear.service`` (127.0.0.1:8765 by default). It
+takes analysis specs over HTTP, queues them, and runs at most ``--max-jobs`` at
+a time in worker processes. When a slot frees up, the user with the fewest
+running jobs goes next and users take turns, so one user's backlog cannot
+starve the others.
+Progress events come from the provenance journal of each finished step. A
+notebook follows them with :class:`Client`; results and provenance can be
+fetched when the job is done.
+
+A spec holds ``projection``, ``layers_dict`` and either ``mask`` (a vector
+file) with ``cellsize``, or ``grd_json`` and ``path`` of a grid that was
+already made. Optional keys are ``engine``, ``table_format``, ``max_workers``,
+``provenance`` (export formats) and ``path``.
+
+    POST   /jobs                      {"user": ..., "spec": {...}} -> {"id": ...}
+    GET    /jobs[?user=...]           all jobs
+    GET    /jobs/<id>                 state, times and step timings
+    GET    /jobs/<id>/events?after=n  events after the first n, waits up to ?wait= seconds
+    GET    /jobs/<id>/provenance      PROV-JSON of a finished job
+    GET    /jobs/<id>/files[/<file>]  the output files, or one of them
+    DELETE /jobs/<id>                 cancel a queued job
+"""
+
+import os
+import re
+import sys
+import json
+import getpass
+import asyncio
+import argparse
+import threading
+import subprocess
+import collections
+import multiprocessing
+from time import time, sleep
+from functools import partial
+from concurrent import futures
+from urllib.parse import urlsplit, parse_qs, quote
+import requests
+
+host = "127.0.0.1"
+port = 8765
+max_jobs = 2
+max_queued = 20
+
+
+def run_job(job_id, spec, path, events):
+    """Run one analysis spec in path and put its progress on events; runs in a worker process."""
+
+    start = time()
+
+    def emit(kind, **data):
+        events.put(dict(data, job=job_id, event=kind, time=time(), elapsed=time() - start))
+
+    try:
+        import geopandas as gpd
+        from prov.model import ProvDocument
+        from geogear import functions, backend, provenance
+
+        emit("started", pid=os.getpid())
+        for i in ("input", "analysis"):
+            if not os.path.exists(path + "/" + i): os.makedirs(path + "/" + i)
+        engine = spec.get("engine", "saga")
+        table_format = spec.get("table_format", "csv")
+
+        if "grd_json" in spec:
+            grd_json = spec["grd_json"]
+        else:
+            mask = gpd.read_file(spec["mask"]).to_crs(spec["projection"])
+            grd_json = functions.grid(mask, spec["cellsize"], path, engine, table_format).serialize()
+
+        def on_step(step, doc):
+            if isinstance(doc, str):
+                doc = ProvDocument.deserialize(content=doc)
+            emit("step", step=step, timings=provenance.timings(doc))
+
+        backend.analysis(spec["projection"], spec.get("layers_dict", {}), grd_json, path,
+                         spec.get("provenance", ["JSON"]), spec.get("max_workers"), engine, table_format,
+                         on_step=on_step)
+    except Exception as e:
+        emit("failed", error=type(e).__name__ + ": " + str(e))
+        raise
+    emit("finished")
+    return path
+
+
+class JobService:
+    """Queue, schedule and serve analysis jobs; the state lives in this process only."""
+
+    def __init__(self, root=None, max_jobs=max_jobs, max_queued=max_queued):
+        self.root = os.path.abspath(root or "jobs")
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.jobs = collections.OrderedDict()
+        self.queues = collections.defaultdict(collections.deque)
+        self.running = collections.Counter()
+        self.last_start = collections.Counter()
+        self.next_id = 1
+
+    async def serve(self, host=host, port=port, ready=None):
+        self.loop = asyncio.get_running_loop()
+        context = multiprocessing.get_context("spawn")
+        self.manager = context.Manager()
+        self.events = self.manager.Queue()
+        self.pool = futures.ProcessPoolExecutor(self.max_jobs, mp_context=context)
+        threading.Thread(target=self._drain, daemon=True).start()
+
+        server = await asyncio.start_server(self._handle, host, port)
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.events.put(None)
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.manager.shutdown()
+
+    # scheduling
+
+    def submit(self, user, spec):
+        if not re.match(r"^[A-Za-z0-9_.-]+$", user or ""):
+            raise ValueError("Invalid user " + repr(user))
+        if "projection" not in spec or not ("grd_json" in spec and "path" in spec or "mask" in spec and "cellsize" in spec):
+            raise ValueError("A spec needs projection and either mask and cellsize or grd_json and path")
+        if spec.get("engine", "saga") not in ("saga", "native"):
+            raise ValueError("Unknown engine " + repr(spec["engine"]))
+        if spec.get("table_format", "csv") not in ("csv", "parquet", "both"):
+            raise ValueError("Unknown table format " + repr(spec["table_format"]))
+        if len(self.queues[user]) >= self.max_queued:
+            raise OverflowError(user + " already has " + str(self.max_queued) + " jobs queued")
+
+        job_id = str(self.next_id)
+        self.next_id += 1
+        path = os.path.abspath(spec.get("path") or os.path.join(self.root, user, job_id))
+        self.jobs[job_id] = {'id': job_id, 'user': user, 'spec': spec, 'path': path, 'state': 'queued',
+                             'submitted': time(), 'started': None, 'finished': None, 'error': None,
+                             'events': [], 'update': asyncio.Event()}
+        self.queues[user].append(job_id)
+        self._schedule()
+        return self.jobs[job_id]
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        if job['state'] != 'queued':
+            return False
+        self.queues[job['user']].remove(job_id)
+        self._event({'job': job_id, 'event': 'cancelled', 'time': time(), 'elapsed': 0})
+        return True
+
+    def _schedule(self):
+        while sum(self.running.values()) < self.max_jobs:
+            waiting = [u for u in self.queues if self.queues[u]]
+            if not waiting:
+                return
+            # the user with the fewest running jobs first, then the one whose
+            # last job started longest ago, so users take turns
+            user = min(waiting, key=lambda u: (self.running[u], self.last_start[u], self.jobs[self.queues[u][0]]['submitted']))
+            job = self.jobs[self.queues[user].popleft()]
+            job['state'] = 'running'
+            job['started'] = self.last_start[user] = time()
+            self.running[user] += 1
+            task = self.loop.run_in_executor(self.pool, run_job, job['id'], job['spec'], job['path'], self.events)
+            task.add_done_callback(partial(self._done, job))
+
+    def _done(self, job, task):
+        self.running[job['user']] -= 1
+        error = None if task.cancelled() else task.exception()
+        if isinstance(error, futures.process.BrokenProcessPool):
+            # a worker died without reporting, the pool has to be replaced
+            self.pool = futures.ProcessPoolExecutor(self.max_jobs, mp_context=multiprocessing.get_context("spawn"))
+            self._event({'job': job['id'], 'event': 'failed', 'time': time(), 'elapsed': 0,
+                         'error': "worker process died"})
+        self._schedule()
+
+    # events from the workers arrive on a manager queue, a thread hands them to the loop
+
+    def _drain(self):
+        while True:
+            try:
+                event = self.events.get()
+            except (EOFError, OSError):
+                return
+            if event is None:
+                return
+            self.loop.call_soon_threadsafe(self._event, event)
+
+    def _event(self, event):
+        job = self.jobs[event['job']]
+        if job['state'] in ('done', 'failed', 'cancelled'):
+            return
+        job['events'].append(event)
+        if event['event'] == 'finished':
+            job['state'], job['finished'] = 'done', event['time']
+        elif event['event'] in ('failed', 'cancelled'):
+            job['state'], job['finished'], job['error'] = event['event'], event['time'], event.get('error')
+        update, job['update'] = job['update'], asyncio.Event()
+        update.set()
+
+    def summary(self, job):
+        steps = {e['step']: e['timings'] for e in job['events'] if e['event'] == 'step'}
+        return {k: job[k] for k in ('id', 'user', 'state', 'path', 'submitted', 'started', 'finished', 'error')} \
+            | {'steps': steps, 'events': len(job['events'])}
+
+    # HTTP
+
+    async def _handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                k, _, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(request) < 2:
+                raise ValueError("Malformed request")
+            status, content_type, payload = await self._route(request[0], request[1], body)
+        except KeyError:
+            status, content_type, payload = 404, 'application/json', {'error': 'no such job'}
+        except OverflowError as e:
+            status, content_type, payload = 429, 'application/json', {'error': str(e)}
+        except ValueError as e:
+            status, content_type, payload = 400, 'application/json', {'error': str(e)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+
+        if content_type == 'application/json':
+            payload = json.dumps(payload).encode()
+        reason = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  409: 'Conflict', 429: 'Too Many Requests'}.get(status, '')
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                      % (status, reason, content_type, len(payload))).encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _route(self, method, target, body):
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [i for i in url.path.split("/") if i]
+        if not parts or parts[0] != "jobs":
+            raise KeyError(url.path)
+
+        if len(parts) == 1:
+            if method == "POST":
+                request = json.loads(body or b"{}")
+                job = self.submit(request.get("user"), request.get("spec") or {})
+                return 201, 'application/json', self.summary(job)
+            if method == "GET":
+                return 200, 'application/json', [self.summary(j) for j in self.jobs.values()
+                                                 if query.get('user') in (None, j['user'])]
+
+        job = self.jobs[parts[1]]
+        if len(parts) == 2 and method == "GET":
+            return 200, 'application/json', self.summary(job)
+        if len(parts) == 2 and method == "DELETE":
+            if not self.cancel(job['id']):
+                return 409, 'application/json', {'error': 'only queued jobs can be cancelled'}
+            return 200, 'application/json', self.summary(job)
+
+        if len(parts) == 3 and parts[2] == "events" and method == "GET":
+            after = int(query.get('after', 0))
+            if len(job['events']) <= after and job['state'] in ('queued', 'running'):
+                try:
+                    await asyncio.wait_for(job['update'].wait(), float(query.get('wait', 30)))
+                except asyncio.TimeoutError:
+                    pass
+            return 200, 'application/json', {'state': job['state'], 'events': job['events'][after:]}
+
+        if len(parts) >= 3 and parts[2] in ("provenance", "files") and method == "GET":
+            if job['state'] != 'done':
+                return 409, 'application/json', {'error': 'job is ' + job['state']}
+            if parts[2] == "provenance":
+                from geogear import provenance
+                doc = await self.loop.run_in_executor(None, provenance.document, job['path'])
+                return 200, 'application/json', json.loads(doc.serialize())
+            output = os.path.realpath(job['path'] + "/output")
+            if len(parts) == 3:
+                return 200, 'application/json', sorted(os.path.relpath(os.path.join(d, f), output)
+                                                        for d, _, files in os.walk(output) for f in files)
+            name = os.path.realpath(os.path.join(output, *parts[3:]))
+            if not name.startswith(output + os.sep) or not os.path.isfile(name):
+                raise KeyError(name)
+            with open(name, 'rb') as f:
+                return 200, 'application/octet-stream', f.read()
+
+        return 405, 'application/json', {'error': method + " " + url.path + " is not supported"}
+
+
+class Client:
+    """Talk to a job service from a notebook or script."""
+
+    def __init__(self, url="http://%s:%d" % (host, port), user=None):
+        self.url = url.rstrip("/")
+        self.user = user or getpass.getuser()
+
+    def _call(self, method, path, **kwargs):
+        response = requests.request(method, self.url + path, **kwargs)
+        if response.status_code >= 400:
+            raise IOError("%s %s: %s" % (method, path, response.json().get('error', response.status_code)))
+        return response
+
+    def alive(self):
+        try:
+            self._call("GET", "/jobs", params={'user': self.user}, timeout=2)
+            return True
+        except (IOError, requests.RequestException):
+            return False
+
+    def submit(self, spec):
+        """Queue spec and return the id of its job."""
+        return self._call("POST", "/jobs", json={'user': self.user, 'spec': spec}).json()['id']
+
+    def status(self, job_id):
+        return self._call("GET", "/jobs/" + job_id).json()
+
+    def jobs(self):
+        return self._call("GET", "/jobs", params={'user': self.user}).json()
+
+    def cancel(self, job_id):
+        return self._call("DELETE", "/jobs/" + job_id).json()
+
+    def events(self, job_id, wait=30):
+        """Yield the events of a job as they come in, until it is done, failed or cancelled."""
+        seen = 0
+        while True:
+            reply = self._call("GET", "/jobs/" + job_id + "/events", params={'after': seen, 'wait': wait},
+                               timeout=wait + 30).json()
+            for event in reply['events']:
+                yield event
+            seen += len(reply['events'])
+            if reply['state'] not in ('queued', 'running') and not reply['events']:
+                return
+
+    def provenance(self, job_id):
+        from prov.model import ProvDocument
+        return ProvDocument.deserialize(content=self._call("GET", "/jobs/" + job_id + "/provenance").text)
+
+    def files(self, job_id):
+        return self._call("GET", "/jobs/" + job_id + "/files").json()
+
+    def download(self, job_id, name, dest):
+        """Copy the output file name of a job to dest."""
+        response = self._call("GET", "/jobs/" + job_id + "/files/" + quote(name), stream=True)
+        with open(dest, 'wb') as f:
+            for block in response.iter_content(2**20):
+                f.write(block)
+        return dest
+
+
+def connect(url=None, start=True, root=None, max_jobs=max_jobs):
+    """Return a client of the service at url, starting one on this host when none answers."""
+
+    client = Client(url or "http://%s:%d" % (host, port))
+    if client.alive() or not start:
+        return client
+    service_port = urlsplit(client.url).port or port
+    subprocess.Popen([sys.executable, "-m", "geogear.service", "--port", str(service_port),
+                      "--max-jobs", str(max_jobs), "--root", os.path.abspath(root or "jobs")],
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    for i in range(50):
+        if client.alive():
+            return client
+        sleep(0.2)
+    raise IOError("The job service did not start on " + client.url)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog="python -m geogear.service", description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=port)
+    parser.add_argument("--max-jobs", type=int, default=max_jobs, help="analyses running at the same time")
+    parser.add_argument("--max-queued", type=int, default=max_queued, help="queued analyses per user")
+    parser.add_argument("--root", default="jobs", help="directory of jobs that do not set their own path")
+    args = parser.parse_args(argv)
+
+    # the service only ever listens on localhost
+    service = JobService(args.root, args.max_jobs, args.max_queued)
+    asyncio.run(service.serve(host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""The native engine checked against SAGA on the synthetic benchmark layers."""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from geogear import benchmark, cache, functions
+
+pytestmark = pytest.mark.skipif(shutil.which("saga_cmd") is None, reason="saga_cmd is not installed")
+
+projection = "EPSG:3035"
+
+
+@pytest.fixture(scope="module")
+def products(tmp_path_factory):
+    """A SAGA grid over the synthetic layers, copied into one product per engine."""
+
+    import geopandas as gpd
+
+    root = str(tmp_path_factory.mktemp("engines"))
+    benchmark.make_data(root + "/data", extent=3000, raster_res=10, classes=4, points=500, polygons=20)
+    mask = gpd.read_file(root + "/data/mask.gpkg").to_crs(projection)
+    enabled = cache.enabled
+    cache.enabled = False
+    try:
+        paths = {}
+        for engine in ("saga", "native"):
+            paths[engine] = os.path.join(root, engine)
+            for i in ("input", "analysis"):
+                os.makedirs(paths[engine] + "/" + i)
+        # both engines work on the same grid, so their cells line up
+        functions.grid(mask, 100, paths["saga"], "saga")
+        shutil.copytree(paths["saga"] + "/output/grid", paths["native"] + "/output/grid")
+        yield root, paths
+    finally:
+        cache.enabled = enabled
+
+
+def _url(root, layer):
+    return "file://" + root + "/data/layers/" + layer
+
+
+def _coverage_table(path):
+    # SAGA numbers its class rasters _0001, _0002, ..., the native engine
+    # names them by class; the synthetic classes are 1 to n, so both agree
+    table = pd.read_csv(path + "/output/coverages/cov_table.csv")
+    table['feature'] = table['feature'].str.replace(r"_0*(\d+)$", r"_\1", regex=True)
+    return table.pivot(index='cell_ID', columns='feature', values='proportion')
+
+
+def test_coverages_match_saga(products):
+    root, paths = products
+    layers = [("landcover.tif", _url(root, "landcover.tif")), ("landuse.gpkg", _url(root, "landuse.gpkg"))]
+    for engine, path in paths.items():
+        functions.coverages(list(layers), projection, path, engine=engine)
+
+    saga = _coverage_table(paths["saga"])
+    native = _coverage_table(paths["native"])
+    assert sorted(saga.columns) == sorted(native.columns)
+    saga, native = saga.align(native, fill_value=0)
+    saga, native = saga.fillna(0), native.fillna(0)
+
+    # raster classes are counted on the same 10 m cells, up to where SAGA
+    # snaps them to the grid
+    raster = [i for i in saga.columns if i.startswith("landcover_")]
+    assert np.abs(native[raster] - saga[raster]).max().max() <= 0.1
+    np.testing.assert_allclose(native[raster].sum(), saga[raster].sum(), rtol=0.02)
+
+    # SAGA burns polygons into 100 m cells first, the native engine
+    # intersects them with the cells, so only the covered area agrees
+    vector = [i for i in saga.columns if i.startswith("landuse_")]
+    assert native[vector].max().max() <= 1
+    np.testing.assert_allclose(native[vector].sum(), saga[vector].sum(), rtol=0.15)
+
+
+def _resample_table(path):
+    table = pd.read_csv(path + "/output/resample/rsmpl_table.csv")
+    return table.pivot(index='cell_ID', columns='feature', values='value')
+
+
+def test_resample_matches_saga(products):
+    import rasterio
+    import rasterio.warp
+
+    root, paths = products
+    # SAGA resamples with the majority of the source cells, which only
+    # settles on a value for layers smoother than the synthetic noise: 300 m
+    # class patches without nodata that cover the western half, class 0
+    # included, and an east-west ramp of 1 per 100 m
+    with rasterio.open(root + "/data/layers/elevation.tif") as src:
+        profile = dict(src.profile, nodata=None)
+    y, x = np.mgrid[0:profile['height'], 0:profile['width']] * 10.0
+    patches = ((x // 300 + y // 300) % 3).astype('uint8')
+    with rasterio.open(root + "/data/layers/patches.tif", 'w', **dict(profile, dtype='uint8', width=profile['width'] // 2)) as dst:
+        dst.write(patches[:, :profile['width'] // 2], 1)
+    with rasterio.open(root + "/data/layers/ramp.tif", 'w', **dict(profile, dtype='float32', nodata=-9999)) as dst:
+        dst.write((x / 100).astype('float32'), 1)
+
+    layers = [("patches.tif", _url(root, "patches.tif")), ("ramp.tif", _url(root, "ramp.tif"))]
+    for engine, path in paths.items():
+        functions.resample(list(layers), projection, path, engine=engine)
+    saga = _resample_table(paths["saga"])
+    native = _resample_table(paths["native"])
+
+    # the native engine takes the mean, SAGA one of the values in the cell,
+    # which differ by less than the ramp rises across a cell
+    both = saga["ramp_rsmpl"].notna() & native["ramp_rsmpl"].notna()
+    assert both.mean() > 0.95
+    assert np.abs(native["ramp_rsmpl"][both] - saga["ramp_rsmpl"][both]).max() <= 2
+
+    # cells past the footprint of the patches are left out, not class 0
+    cells = pd.read_csv(paths["saga"] + "/output/grid/grid.csv").set_index('cell_ID')
+    with rasterio.open(root + "/data/layers/patches.tif") as src:
+        east = rasterio.warp.transform(projection, src.crs, cells['x'].values, cells['y'].values)[0]
+        outside = pd.Series(np.array(east) > src.bounds.right + 100, index=cells.index)
+    classes = native["patches_rsmpl"].reindex(cells.index)
+    assert outside.any() and classes[outside].isna().all()
+    assert classes[~outside].dropna().isin([0, 1, 2]).all()
+
+    inside = ~outside & classes.notna() & saga["patches_rsmpl"].reindex(cells.index).notna()
+    assert (classes[inside] == saga["patches_rsmpl"].reindex(cells.index)[inside]).mean() > 0.9
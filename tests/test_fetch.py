@@ -0,0 +1,127 @@
+"""The layer fetcher against a local HTTP server: resumed, checked, refused and unzipped downloads."""
+
+import io
+import os
+import hashlib
+import zipfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from geogear import cache, fetch
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # files maps a path to its bytes; every GET is logged with its Range header
+    files = {}
+    requests = []
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get('Range')))
+        self._send(True)
+
+    def _send(self, body):
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+        data = self.files[self.path]
+        start = int(self.headers['Range'][len('bytes='):].rstrip('-')) if self.headers.get('Range') else 0
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', '"%s"' % hashlib.md5(data).hexdigest())
+        self.end_headers()
+        if body:
+            self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:%d" % httpd.server_address[1]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(cache, "enabled", False)
+    monkeypatch.setattr(fetch, "sleep", lambda seconds: None)
+    _Handler.files.clear()
+    del _Handler.requests[:]
+
+
+def test_resumes_from_a_partial_file(server, tmp_path):
+    data = os.urandom(3 * 2**16)
+    _Handler.files['/layer.tif'] = data
+    with open(str(tmp_path / "layer.tif.part"), 'wb') as f:
+        f.write(data[:2**16])
+
+    assert fetch.fetch_layer("layer.tif", server + "/layer.tif", str(tmp_path)) == [str(tmp_path / "layer.tif")]
+    assert _Handler.requests == [('/layer.tif', 'bytes=65536-')]
+    assert (tmp_path / "layer.tif").read_bytes() == data
+    assert not (tmp_path / "layer.tif.part").exists()
+
+
+def test_checksum_mismatch_leaves_nothing_behind(server, tmp_path):
+    data = b"not the layer that was asked for"
+    _Handler.files['/layer.tif'] = data
+    wrong = hashlib.sha256(b"the layer").hexdigest()
+
+    with pytest.raises(IOError, match="checksum mismatch"):
+        fetch.fetch_layer("layer.tif", server + "/layer.tif#sha256=" + wrong, str(tmp_path))
+    assert os.listdir(str(tmp_path)) == []
+
+    right = hashlib.sha256(data).hexdigest()
+    fetch.fetch_layer("layer.tif", server + "/layer.tif#sha256=" + right, str(tmp_path))
+    assert (tmp_path / "layer.tif").read_bytes() == data
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        fetch.fetch_layer("missing.tif", server + "/missing.tif", str(tmp_path))
+    assert _Handler.requests == [('/missing.tif', None)]
+
+    failed = fetch.fetch_layers(["missing.tif"], [server + "/missing.tif"], str(tmp_path))
+    assert list(failed) == ["missing.tif"]
+
+
+def test_archives_are_extracted(server, tmp_path):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr("roads.shp", b"shp")
+        z.writestr("roads.dbf", b"dbf")
+        z.writestr("docs/readme.txt", b"readme")
+    _Handler.files['/roads.zip'] = archive.getvalue()
+
+    files = fetch.fetch_layer("roads.zip", server + "/roads.zip", str(tmp_path))
+    assert sorted(os.path.relpath(i, str(tmp_path)) for i in files) == ["docs/readme.txt", "roads.dbf", "roads.shp"]
+    assert (tmp_path / "roads.shp").read_bytes() == b"shp"
+    assert not (tmp_path / "roads.zip").exists()
+
+
+def test_archives_cannot_write_outside_their_directory(server, tmp_path):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        z.writestr("../escaped.txt", b"outside")
+    _Handler.files['/evil.zip'] = archive.getvalue()
+
+    dest = tmp_path / "input"
+    dest.mkdir()
+    with pytest.raises(IOError, match="outside"):
+        fetch.fetch_layer("evil.zip", server + "/evil.zip", str(dest))
+    assert not (tmp_path / "escaped.txt").exists()
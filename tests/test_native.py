@@ -0,0 +1,97 @@
+"""The native raster steps on small handcrafted rasters, without SAGA."""
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+from geogear import functions
+
+projection = "EPSG:3035"
+# a grid of 6 x 8 cells of 100 m and layers of 10 m cells aligned with it
+rows, cols = 6, 8
+origin = (4000000.0, 3000000.0)
+
+
+def _write(path, values, res, dtype, nodata=None):
+    profile = {'driver': 'GTiff', 'height': values.shape[0], 'width': values.shape[1], 'count': 1,
+               'dtype': dtype, 'crs': projection, 'nodata': nodata,
+               'transform': Affine(res, 0, origin[0], 0, -res, origin[1])}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(values.astype(dtype), 1)
+    return path
+
+
+def _read(path):
+    with rasterio.open(path) as src:
+        return src.read(), src.nodata
+
+
+@pytest.fixture
+def grid(tmp_path):
+    return _write(str(tmp_path / "grid.tif"), np.ones((rows, cols)), 100, 'uint8')
+
+
+def _cells(values):
+    # the 10 x 10 layer cells of every grid cell, as (rows, cols, 100)
+    return values.reshape(rows, 10, cols, 10).transpose(0, 2, 1, 3).reshape(rows, cols, 100)
+
+
+def test_fractions_of_a_full_coverage_raster_sum_to_one(grid, tmp_path):
+    classes = np.random.RandomState(0).randint(1, 4, (rows * 10, cols * 10))
+    source = _write(str(tmp_path / "classes.tif"), classes, 10, 'uint8')
+
+    functions._class_fractions(source, grid, str(tmp_path / "cov.tif"), "classes_cov_")
+    fractions, _ = _read(str(tmp_path / "cov.tif"))
+    assert fractions.shape == (3, rows, cols)
+    np.testing.assert_allclose(fractions.sum(axis=0), 1, atol=1e-6)
+    for b in range(3):
+        np.testing.assert_allclose(fractions[b], (_cells(classes) == b + 1).mean(axis=2), atol=1e-6)
+
+
+def test_cells_outside_a_raster_without_nodata_have_no_class(grid, tmp_path):
+    # an integer raster over the western half only, with class 0 in it
+    classes = np.random.RandomState(1).randint(0, 3, (rows * 10, cols * 5))
+    source = _write(str(tmp_path / "west.tif"), classes, 10, 'uint8')
+
+    functions._class_fractions(source, grid, str(tmp_path / "cov.tif"), "west_cov_")
+    fractions, _ = _read(str(tmp_path / "cov.tif"))
+    np.testing.assert_allclose(fractions[:, :, :cols // 2].sum(axis=0), 1, atol=1e-6)
+    assert (fractions[:, :, cols // 2:] == 0).all()
+
+    functions._aggregate_raster(source, grid, str(tmp_path / "rsmpl.tif"))
+    majority, nodata = _read(str(tmp_path / "rsmpl.tif"))
+    assert nodata is not None and nodata not in (0, 1, 2)
+    assert (majority[0, :, cols // 2:] == nodata).all()
+    assert np.isin(majority[0, :, :cols // 2], [0, 1, 2]).all()
+
+
+def test_mode_and_mean_per_cell(grid, tmp_path):
+    # every cell holds its own class in 60 of its 100 layer cells and the
+    # next class in the rest; the ramp rises by 1 from one layer cell to the next
+    own = np.arange(rows * cols).reshape(rows, cols) % 5 + 1
+    classes = np.kron(own, np.ones((10, 10), dtype=int))
+    classes[np.arange(rows * 10) % 10 >= 6] += 1
+    ramp = np.arange(rows * 10 * cols * 10, dtype='float32').reshape(rows * 10, cols * 10)
+    categorical = _write(str(tmp_path / "classes.tif"), classes, 10, 'uint8', 255)
+    continuous = _write(str(tmp_path / "ramp.tif"), ramp, 10, 'float32', -9999)
+
+    functions._aggregate_raster(categorical, grid, str(tmp_path / "mode.tif"))
+    np.testing.assert_array_equal(_read(str(tmp_path / "mode.tif"))[0][0], own)
+    functions._aggregate_raster(continuous, grid, str(tmp_path / "mean.tif"))
+    np.testing.assert_allclose(_read(str(tmp_path / "mean.tif"))[0][0], _cells(ramp).mean(axis=2), rtol=1e-5)
+
+
+@pytest.mark.parametrize("tile_rows, workers", [(1, 1), (2, 3), (4, 2)])
+def test_outputs_do_not_depend_on_the_tile_size(grid, tmp_path, tile_rows, workers):
+    state = np.random.RandomState(2)
+    classes = _write(str(tmp_path / "classes.tif"), state.randint(1, 5, (rows * 10, cols * 10)), 10, 'uint8', 0)
+    values = _write(str(tmp_path / "values.tif"), state.normal(size=(rows * 10, cols * 10)), 10, 'float32', -9999)
+
+    functions._class_fractions(classes, grid, str(tmp_path / "cov.tif"), "cov_")
+    functions._class_fractions(classes, grid, str(tmp_path / "cov_tiled.tif"), "cov_", tile_rows, workers)
+    np.testing.assert_array_equal(_read(str(tmp_path / "cov.tif"))[0], _read(str(tmp_path / "cov_tiled.tif"))[0])
+
+    functions._aggregate_raster(values, grid, str(tmp_path / "mean.tif"))
+    functions._aggregate_raster(values, grid, str(tmp_path / "mean_tiled.tif"), tile_rows, workers)
+    np.testing.assert_array_equal(_read(str(tmp_path / "mean.tif"))[0], _read(str(tmp_path / "mean_tiled.tif"))[0])
@@ -0,0 +1,102 @@
+"""Re-runs of the analysis functions: outputs and tables kept in step with the layers asked for."""
+
+import os
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+from geogear import benchmark, cache, functions
+
+projection = "EPSG:3035"
+
+
+@pytest.fixture(scope="module")
+def data(tmp_path_factory):
+    """The synthetic benchmark layers and a native grid over their mask."""
+
+    import geopandas as gpd
+
+    root = str(tmp_path_factory.mktemp("reruns"))
+    benchmark.make_data(root + "/data", extent=2000, raster_res=10, classes=3, points=300, polygons=10)
+    # a layer whose name starts with the name of another one
+    shutil.copyfile(root + "/data/layers/landcover.tif", root + "/data/layers/soil.tif")
+    shutil.copyfile(root + "/data/layers/landuse.gpkg", root + "/data/layers/soil_cover.gpkg")
+    grid = root + "/grid"
+    os.makedirs(grid + "/input")
+    mask = gpd.read_file(root + "/data/mask.gpkg").to_crs(projection)
+    enabled = cache.enabled
+    cache.enabled = False
+    try:
+        functions.grid(mask, 100, grid, "native")
+        yield root
+    finally:
+        cache.enabled = enabled
+
+
+@pytest.fixture
+def product(data, tmp_path):
+    path = str(tmp_path)
+    for i in ("input", "analysis"):
+        os.makedirs(path + "/" + i)
+    shutil.copytree(data + "/grid/output/grid", path + "/output/grid")
+    return path
+
+
+def _layers(data, *names):
+    return [(i, "file://" + data + "/data/layers/" + i) for i in names]
+
+
+def _manifest(path):
+    with open(path + "/output/coverages/manifest.json") as f:
+        return json.load(f)
+
+
+def test_layers_with_a_common_prefix_keep_their_own_outputs(data, product):
+    functions.coverages(_layers(data, "soil.tif", "soil_cover.gpkg"), projection, product, engine="native")
+
+    layers = _manifest(product)['layers']
+    assert layers['soil']['artifacts'] == ['soil_cov.tif']
+    assert layers['soil_cover']['artifacts'] == ['soil_cover_cov.tif']
+    table = pd.read_csv(product + "/output/coverages/cov_table.csv")
+    assert not table.duplicated(['cell_ID', 'feature']).any()
+
+    # dropping soil leaves the outputs of soil_cover alone
+    functions.coverages(_layers(data, "soil_cover.gpkg"), projection, product, engine="native")
+    assert os.path.exists(product + "/output/coverages/soil_cover_cov.tif")
+    assert not os.path.exists(product + "/output/coverages/soil_cov.tif")
+    table = pd.read_csv(product + "/output/coverages/cov_table.csv")
+    assert table['feature'].str.startswith("soil_cover_cov_").all()
+
+
+def test_tables_follow_layers_across_formats(data, product):
+    table = product + "/output/coverages/cov_table.csv"
+    functions.coverages(_layers(data, "landcover.tif", "landuse.gpkg"), projection, product, engine="native")
+    assert pd.read_csv(table)['feature'].str.startswith("landuse_").any()
+
+    # landuse is dropped while only the Parquet table is written, so the
+    # CSV table of the first run no longer matches the outputs
+    functions.coverages(_layers(data, "landcover.tif"), projection, product, engine="native", table_format="parquet")
+    assert not os.path.exists(table)
+    assert _manifest(product)['tables'] == ["cov_table.parquet"]
+    parquet = pd.read_parquet(product + "/output/coverages/cov_table.parquet")
+    assert not any(i.startswith("landuse_") for i in parquet.columns)
+
+    # back to CSV, the table is rebuilt and not patched from the stale one
+    functions.coverages(_layers(data, "landcover.tif"), projection, product, engine="native")
+    assert _manifest(product)['tables'] == ["cov_table.csv"]
+    rerun = pd.read_csv(table)
+    assert not os.path.exists(product + "/output/coverages/cov_table.parquet")
+
+    fresh = product + "/fresh"
+    for i in ("input", "analysis"):
+        os.makedirs(fresh + "/" + i)
+    shutil.copytree(product + "/output/grid", fresh + "/output/grid")
+    functions.coverages(_layers(data, "landcover.tif"), projection, fresh, engine="native")
+    pd.testing.assert_frame_equal(rerun, pd.read_csv(fresh + "/output/coverages/cov_table.csv"))
+
+    # adding a layer again patches the up to date table
+    functions.coverages(_layers(data, "landcover.tif", "landuse.gpkg"), projection, product, engine="native")
+    assert pd.read_csv(table)['feature'].str.startswith("landuse_").any()
+    assert not pd.read_csv(table).duplicated(['cell_ID', 'feature']).any()